@@ -63,3 +63,80 @@ ALTER TABLE lectureStudentSetting
 ALTER TABLE host
     ADD comment VARCHAR(1024) NULL;
 ALTER TABLE host DROP INDEX ix_host_fqdn;
+
+-- 2026-10-18
+
+DELETE a1 FROM answer a1
+    JOIN answer a2
+        ON a2.studentId = a1.studentId
+       AND a2.lectureId = a1.lectureId
+       AND a2.questionId = a1.questionId
+       AND a2.timeEnd = a1.timeEnd
+       AND a2.answerId < a1.answerId;
+ALTER TABLE answer
+    ADD UNIQUE KEY uniq_answer (studentId, lectureId, questionId, timeEnd);
+
+ALTER TABLE answerSummary
+    ADD maxTimeEnd DATETIME NULL;
+UPDATE answerSummary s SET
+    lecAnswered = (SELECT COUNT(*) FROM answer a WHERE a.lectureId = s.lectureId AND a.studentId = s.studentId),
+    lecCorrect = (SELECT IFNULL(SUM(a.correct), 0) FROM answer a WHERE a.lectureId = s.lectureId AND a.studentId = s.studentId),
+    practiceAnswered = (SELECT IFNULL(SUM(a.practice), 0) FROM answer a WHERE a.lectureId = s.lectureId AND a.studentId = s.studentId),
+    practiceCorrect = (SELECT IFNULL(SUM(a.practice AND a.correct), 0) FROM answer a WHERE a.lectureId = s.lectureId AND a.studentId = s.studentId),
+    maxTimeEnd = (SELECT MAX(a.timeEnd) FROM answer a WHERE a.lectureId = s.lectureId AND a.studentId = s.studentId);
+
+CREATE TABLE `questionCounter` (
+  `questionCounterId` int(11) NOT NULL AUTO_INCREMENT,
+  `questionId` int(11) NOT NULL,
+  `answered` int(11) NOT NULL,
+  `correct` int(11) NOT NULL,
+  PRIMARY KEY (`questionCounterId`),
+  KEY `ix_questionCounter_questionId` (`questionId`),
+  CONSTRAINT `questionCounter_ibfk_1` FOREIGN KEY (`questionId`) REFERENCES `question` (`questionId`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+ALTER TABLE student
+    ADD registered BOOL NOT NULL DEFAULT 0;
+UPDATE student SET registered = EXISTS(
+    SELECT 1 FROM subscription s
+     WHERE s.studentId = student.studentId
+       AND s.hidden = 0
+       AND s.plonePath LIKE '/%/schools-and-classes/%');
+
+CREATE TABLE `tutorial` (
+  `tutorialId` int(11) NOT NULL AUTO_INCREMENT,
+  `hostId` int(11) NOT NULL,
+  `plonePath` varchar(128) NOT NULL,
+  PRIMARY KEY (`tutorialId`),
+  UNIQUE KEY `hostId` (`hostId`,`plonePath`),
+  CONSTRAINT `tutorial_ibfk_1` FOREIGN KEY (`hostId`) REFERENCES `host` (`hostId`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO tutorial (hostId, plonePath)
+    SELECT DISTINCT hostId, LEFT(plonePath, CHAR_LENGTH(plonePath) - CHAR_LENGTH(SUBSTRING_INDEX(plonePath, '/', -1)) - 1)
+      FROM lecture;
+ALTER TABLE lecture
+    ADD tutorialId int(11) NULL,
+    ADD KEY `ix_lecture_tutorialId` (`tutorialId`),
+    ADD CONSTRAINT `lecture_ibfk_2` FOREIGN KEY (`tutorialId`) REFERENCES `tutorial` (`tutorialId`);
+UPDATE lecture l
+    JOIN tutorial t
+        ON t.hostId = l.hostId
+       AND t.plonePath = LEFT(l.plonePath, CHAR_LENGTH(l.plonePath) - CHAR_LENGTH(SUBSTRING_INDEX(l.plonePath, '/', -1)) - 1)
+    SET l.tutorialId = t.tutorialId;
+
+CREATE TABLE `compactAllocation` (
+  `studentId` int(11) NOT NULL,
+  `lectureId` int(11) NOT NULL,
+  `allocationTime` datetime NOT NULL,
+  `questionIds` blob NOT NULL,
+  `historicalIds` blob NOT NULL,
+  PRIMARY KEY (`studentId`,`lectureId`),
+  KEY `lectureId` (`lectureId`),
+  CONSTRAINT `compactAllocation_ibfk_1` FOREIGN KEY (`studentId`) REFERENCES `student` (`studentId`),
+  CONSTRAINT `compactAllocation_ibfk_2` FOREIGN KEY (`lectureId`) REFERENCES `lecture` (`lectureId`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- NB: We don't know when existing rows were deactivated, so start their grace period now
+ALTER TABLE allocation
+    ADD deactivationTime DATETIME NULL;
+UPDATE allocation SET deactivationTime = UTC_TIMESTAMP() WHERE active = 0;
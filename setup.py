@@ -45,6 +45,12 @@ setup(
         [console_scripts]
         replicate_dump = tutorweb.quizdb.script.replication:replicateDump
         replicate_ingest = tutorweb.quizdb.script.replication:replicateIngest
+        answer_summary_check = tutorweb.quizdb.script.maintenance:answerSummaryCheck
+        question_counter_fold = tutorweb.quizdb.script.maintenance:questionCounterFold
+        student_settings_assign = tutorweb.quizdb.script.maintenance:studentSettingsAssign
+        allocation_compact = tutorweb.quizdb.script.maintenance:allocationCompact
+        bundle_purge = tutorweb.quizdb.script.maintenance:bundlePurge
+        class_allocation_prewarm = tutorweb.quizdb.script.maintenance:classAllocationPrewarm
     """,
     include_package_data=True,
     zip_safe=False,
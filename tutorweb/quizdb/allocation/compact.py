@@ -0,0 +1,207 @@
+import calendar
+import datetime
+import random
+import re
+import struct
+import urllib2
+from hashlib import md5
+
+from sqlalchemy.orm.exc import NoResultFound
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
+from .base import Allocation as BaseAllocation, DEFAULT_QUESTION_CAP
+from .original import getQuestionPool, clearQuestionPoolCache, _chooseQuestions, _leastSuitable
+
+
+def packIds(ids):
+    """Pack list of questionIds into a string of 32-bit ints"""
+    return struct.pack('>%dI' % len(ids), *ids)
+
+
+def unpackIds(packed):
+    """Reverse of packIds"""
+    packed = packed or ''
+    return list(struct.unpack('>%dI' % (len(packed) / 4), packed))
+
+
+class CompactAllocation(BaseAllocation):
+    """
+    Allocate questions as OriginalAllocation does, but store them in a
+    single compactAllocation row per student & lecture. Question URIs are
+    derived from the question rather than stored.
+    """
+    def _digest(self, questionId, version):
+        # NB: Include the host key, so students can't make up URIs for questions they weren't given
+        return md5('%s:%d:%d:%d:%s' % (
+            self.dbLec.host.hostKey,
+            self.student.studentId,
+            self.dbLec.lectureId,
+            questionId,
+            version,
+        )).hexdigest()[:12]
+
+    def _questionUrl(self, dbQn):
+        # NB: Include lastUpdate, so URI changes when the question does
+        version = calendar.timegm(dbQn.lastUpdate.timetuple())
+        return u'%s/quizdb-get-question/%d:%d-%d-%s' % (
+            self.urlBase,
+            self.dbLec.lectureId,
+            dbQn.questionId,
+            version,
+            self._digest(dbQn.questionId, version),
+        )
+
+    def _decomposeUrl(self, url, isAdmin=False):
+        """Return the questionId url refers to, or None if it isn't valid"""
+        url = urllib2.unquote(url.rsplit('/', 1)[-1])
+        m = re.match(r'(\d+):(\d+)-(\d+)-([0-9a-f]+)$', url)
+        if not m or int(m.group(1)) != self.dbLec.lectureId:
+            return None
+        if not isAdmin and self._digest(int(m.group(2)), int(m.group(3))) != m.group(4):
+            return None
+        return int(m.group(2))
+
+    def _getDbAllocation(self, lockForUpdate=False):
+        """Get this student's compactAllocation row, or None"""
+        query = (Session.query(db.CompactAllocation)
+            .filter(db.CompactAllocation.studentId == self.student.studentId)
+            .filter(db.CompactAllocation.lectureId == self.dbLec.lectureId))
+        if lockForUpdate:
+            query = query.with_lockmode('update').populate_existing()
+        try:
+            return query.one()
+        except NoResultFound:
+            return None
+
+    def getQuestions(self, uris=None, lockForUpdate=False, isAdmin=False, active=True):
+        if uris is not None:
+            # Any URI we handed out is valid, even if it's no longer allocated
+            uriIds = dict((uri, self._decomposeUrl(uri, isAdmin=isAdmin)) for uri in uris)
+            questionIds = [qnId for qnId in uriIds.values() if qnId is not None]
+        else:
+            dbAlloc = self._getDbAllocation()
+            questionIds = unpackIds(dbAlloc.questionIds) + unpackIds(dbAlloc.historicalIds) if dbAlloc else []
+        if not questionIds:
+            return
+
+        if uris is not None:
+            # Questions could be graded, need everything
+            query = Session.query(db.Question)
+        else:
+            query = Session.query(*db.QuestionRow.columns()).filter(db.Question.onlineOnly == False)
+        query = query.filter(db.Question.questionId.in_(questionIds))
+        if lockForUpdate:
+            query = query.with_lockmode('update')
+        if active is not None:
+            query = query.filter(db.Question.active == active)
+        if uris is not None:
+            dbQns = dict((dbQn.questionId, dbQn) for dbQn in query)
+        else:
+            dbQns = dict((row[0], db.QuestionRow(*row)) for row in query)
+
+        if uris is not None:
+            # Return the URIs we were given, so callers can look them up
+            for uri in uris:
+                if uriIds[uri] in dbQns:
+                    yield (uri, dbQns[uriIds[uri]])
+        else:
+            for questionId in questionIds:
+                if questionId in dbQns:
+                    yield (self._questionUrl(dbQns[questionId]), dbQns[questionId])
+
+    def updateAllocation(self, settings, question_cap=DEFAULT_QUESTION_CAP):
+        # Work out which allocation types we want, as OriginalAllocation
+        allocsByType = dict()
+        self.questionsAllocated = 0
+        hist_sel = float(settings.get('hist_sel', '0'))
+        if hist_sel > 0.001:
+            allocsByType['historical'] = []
+            # Only get half the question cap if there's not much chance of the questions being used
+            if hist_sel < 0.5 and 'question_cap_historical' not in settings:
+                settings['question_cap_historical'] = int(settings.get('question_cap', DEFAULT_QUESTION_CAP)) / 2
+        if hist_sel < 0.999:
+            allocsByType['regular'] = []
+            allocsByType['template'] = []
+
+        # NB: Create the row before locking it, as sync.answers.getAnswerSummary.
+        # Two syncs both locking a missing row then inserting it would deadlock
+        if self._getDbAllocation() is None:
+            Session.execute(db.insertOrSkip(db.CompactAllocation.__table__), dict(
+                studentId=self.student.studentId,
+                lectureId=self.dbLec.lectureId,
+                allocationTime=datetime.datetime.utcnow(),
+            ))
+        dbAlloc = self._getDbAllocation(lockForUpdate=True)
+        questionIds = unpackIds(dbAlloc.questionIds)
+        historicalIds = unpackIds(dbAlloc.historicalIds)
+
+        # Fetch all existing questions, dropping any that have been removed or updated since last time
+        dbQns = dict((row[0], db.QuestionRow(*row)) for row in (Session.query(*db.QuestionRow.columns())
+            .filter(db.Question.questionId.in_(questionIds + historicalIds))
+            .filter(db.Question.active == True)
+            .filter(db.Question.lastUpdate <= dbAlloc.allocationTime))) if questionIds or historicalIds else {}
+        for qnId in questionIds:
+            if qnId in dbQns and dbQns[qnId].defAllocType in allocsByType:
+                allocsByType[dbQns[qnId].defAllocType].append(qnId)
+        for qnId in historicalIds:
+            if qnId in dbQns and 'historical' in allocsByType:
+                allocsByType['historical'].append(qnId)
+
+        for (allocType, allocs) in allocsByType.items():
+            questionCap = int(settings.get('question_cap_' + allocType, settings.get('question_cap', DEFAULT_QUESTION_CAP)))
+
+            # If there's too many allocs, throw some away
+            for i in sorted(random.sample(xrange(len(allocs)), max(len(allocs) - questionCap, 0)), reverse=True):
+                del allocs[i]
+
+            # If there's questions to spare, and requested to do so, reallocate questions
+            if len(allocs) == questionCap and self.reAllocQuestions:
+                if self.targetDifficulty is None:
+                    raise ValueError("Must have a target difficulty to know what to remove")
+
+                # Remove the least likely tenth, based on targetDifficulty
+                for i in sorted(_leastSuitable(
+                        [dbQns[qnId].timesAnswered for qnId in allocs],
+                        [dbQns[qnId].timesCorrect for qnId in allocs],
+                        self.targetDifficulty,
+                        len(allocs) / 10 + 1), reverse=True):
+                    del allocs[i]
+
+            # Assign required questions randomly
+            if len(allocs) < questionCap:
+                chosenIds = _chooseQuestions(
+                    getQuestionPool(self.dbLec, historical=allocType == 'historical').get(
+                        'tw_questiontemplate' if allocType == 'template' else 'tw_latexquestion'),
+                    set(allocs),
+                    questionCap - len(allocs),
+                    targetDifficulty=self.targetDifficulty,
+                )
+                if chosenIds:
+                    for row in (Session.query(*db.QuestionRow.columns())
+                            .filter(db.Question.questionId.in_(chosenIds))
+                            .filter(db.Question.active == True)):
+                        dbQns[row[0]] = db.QuestionRow(*row)
+                    if any(qnId not in dbQns for qnId in chosenIds):
+                        # Pool is out of date, rebuild it next time
+                        clearQuestionPoolCache(self.dbLec.lectureId)
+                    chosenIds = [qnId for qnId in chosenIds if qnId in dbQns]
+                    allocs.extend(chosenIds)
+                    self.questionsAllocated += len(chosenIds)
+
+        # Write back everything in one row. NB: Types we didn't want this time are kept as-is
+        dbAlloc.questionIds = packIds(
+            allocsByType.get('regular', []) + allocsByType.get('template', [])
+            if 'regular' in allocsByType else questionIds
+        )
+        dbAlloc.historicalIds = packIds(allocsByType['historical'] if 'historical' in allocsByType else historicalIds)
+        dbAlloc.allocationTime = datetime.datetime.utcnow()
+        Session.flush()
+
+        for (allocType, allocs) in allocsByType.items():
+            for qnId in allocs:
+                yield (
+                    self._questionUrl(dbQns[qnId]),
+                    allocType,
+                    dbQns[qnId],
+                )
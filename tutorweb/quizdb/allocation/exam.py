@@ -26,7 +26,12 @@ class ExamAllocation(BaseAllocation):
         return None
 
     def getQuestions(self, uris=None, lockForUpdate=False, isAdmin=False, active=True):
-        query = Session.query(db.Question).order_by(db.Question.plonePath)
+        if uris is not None:
+            # Questions could be graded, need everything
+            query = Session.query(db.Question)
+        else:
+            query = Session.query(*db.QuestionRow.columns())
+        query = query.order_by(db.Question.plonePath)
         query = query.filter(db.Question.lectures.contains(self.dbLec))
         # TODO: If you've already answered a question, not allowed to answer it again
         # TODO: Restrict right down to only returning the next question?
@@ -45,6 +50,8 @@ class ExamAllocation(BaseAllocation):
             query = query.filter(db.Question.active == active)
 
         for dbQn in query:
+            if uris is None:
+                dbQn = db.QuestionRow(*dbQn)
             yield (self._questionUrl(dbQn), dbQn)
 
     def updateAllocation(self, settings, question_cap=0):
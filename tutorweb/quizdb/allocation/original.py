@@ -1,30 +1,215 @@
 import datetime
 import random
-import re
+import time
 
-from sqlalchemy.sql import func
+try:
+    import numpy
+except ImportError:
+    # Some of the older EiaS NUCs don't have numpy installed
+    numpy = None
+
+from sqlalchemy import and_, or_, case, func
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import exists
 from z3c.saconfig import Session
 
 from tutorweb.quizdb import db
+from tutorweb.quizdb.utils import LRUCache
 from .base import Allocation as BaseAllocation, DEFAULT_QUESTION_CAP
 
+# Rebuild pools after this many seconds, so timesAnswered / timesCorrect don't get too stale.
+# NB: This is how Zope clients see foldQuestionCounters, which runs elsewhere
+QUESTION_POOL_MAX_AGE = 300
+
+# Questions are indexed by correct ratio in bands of 1/DIFFICULTY_BANDS, i.e. 2%
+DIFFICULTY_BANDS = 50
+
+# Active questions available to allocate, keyed by (lectureId, historical)
+_questionPoolCache = {}
+
+
+# publicId -> (lectureId, questionId, studentId). These don't change, but
+# purgeInactiveAllocations() can delete the allocation from under us
+_publicIdCache = LRUCache(10000)
+
+
+def _lookupPublicIds(publicIds):
+    """Return dict of publicId -> (lectureId, questionId, studentId), for publicIds that exist"""
+    out = {}
+    missing = []
+    for publicId in publicIds:
+        ids = _publicIdCache.get(publicId)
+        if ids is None:
+            missing.append(publicId)
+        else:
+            out[publicId] = ids
+    if out:
+        # NB: Purging happens in another process, so make sure cached allocations
+        # still exist. This only needs the publicId index, not the allocation rows
+        existing = set(publicId for (publicId,) in (Session.query(db.Allocation.publicId)
+            .filter(db.Allocation.publicId.in_(out.keys()))))
+        for publicId in out.keys():
+            if publicId not in existing:
+                _publicIdCache.pop(publicId)
+                del out[publicId]
+    if missing:
+        for (publicId, lectureId, questionId, studentId) in (Session.query(
+                db.Allocation.publicId,
+                db.Allocation.lectureId,
+                db.Allocation.questionId,
+                db.Allocation.studentId,
+            ).filter(db.Allocation.publicId.in_(missing))):
+            out[publicId] = _publicIdCache[publicId] = (lectureId, questionId, studentId)
+    return out
+
+
+def clearQuestionPoolCache(lectureId=None):
+    """Forget cached question pools for lectureId, or all lectures"""
+    for k in _questionPoolCache.keys():
+        if lectureId is None or k[0] == lectureId:
+            _questionPoolCache.pop(k, None)
+
+
+def _difficultyBand(timesAnswered, timesCorrect):
+    """Return the band a question's correct ratio falls in, or None if unanswered"""
+    if not timesAnswered:
+        return None
+    return int(round(float(DIFFICULTY_BANDS) * timesCorrect / timesAnswered))
+
+
+def getQuestionPool(dbLec, historical=False):
+    """
+    Return dict of qnType -> dict(
+        questions=tuple of questionIds,
+        bands=dict of _difficultyBand() -> tuple of questionIds,
+    ) for all active questions in dbLec, or lectures before dbLec if historical
+    """
+    if historical:
+        # Get questions from lectures "before" the current one
+        prevLecs = (Session.query(db.Lecture.lectureId, db.Lecture.lastUpdate)
+            .filter(db.Lecture.tutorialId == dbLec.tutorialId)
+            .filter(db.Lecture.plonePath < dbLec.plonePath)
+            .all())
+        version = tuple(sorted(prevLecs))
+    else:
+        version = dbLec.lastUpdate
+
+    cacheKey = (dbLec.lectureId, historical)
+    if cacheKey in _questionPoolCache:
+        (cachedVersion, builtAt, pool) = _questionPoolCache[cacheKey]
+        if cachedVersion == version and time.time() - builtAt < QUESTION_POOL_MAX_AGE:
+            return pool
+
+    query = (Session.query(db.Question.questionId, db.Question.qnType, db.Question.timesAnswered, db.Question.timesCorrect)
+        .filter(db.Question.active == True))
+    if not historical:
+        query = query.filter(db.Question.lectures.contains(dbLec))
+    elif prevLecs:
+        query = (query.join(db.LectureQuestion)
+            .filter(db.LectureQuestion.lectureId.in_([lectureId for (lectureId, lastUpdate) in prevLecs]))
+            .distinct())
+    else:
+        # First lecture in tutorial, nothing to choose from
+        query = []
+
+    pool = {}
+    for (questionId, qnType, timesAnswered, timesCorrect) in query:
+        if qnType not in pool:
+            pool[qnType] = dict(questions=[], bands={})
+        pool[qnType]['questions'].append(questionId)
+        pool[qnType]['bands'].setdefault(_difficultyBand(timesAnswered, timesCorrect), []).append(questionId)
+    for p in pool.values():
+        p['questions'] = tuple(p['questions'])
+        p['bands'] = dict((k, tuple(v)) for (k, v) in p['bands'].items())
+    _questionPoolCache[cacheKey] = (version, time.time(), pool)
+    return pool
+
+
+def _chooseQuestions(pool, exclude, count, targetDifficulty=None):
+    """
+    Choose up to count questionIds from a getQuestionPool() entry, without
+    replacement and ignoring anything in exclude. If there is a
+    targetDifficulty, questions in the nearest bands are chosen first
+    """
+    if count <= 0 or not pool:
+        return []
+    if targetDifficulty is None:
+        candidates = [qnId for qnId in pool['questions'] if qnId not in exclude]
+        return random.sample(candidates, min(count, len(candidates)))
+
+    # Unanswered questions first, then work outwards from the target band.
+    # NB: targetDifficulty is the student's last grade, so can be well outside 0..1
+    target = min(max(int(round(targetDifficulty * DIFFICULTY_BANDS)), 0), DIFFICULTY_BANDS)
+    out = []
+    for bands in [(None,)] + [set((target - d, target + d)) for d in range(DIFFICULTY_BANDS + 1)]:
+        candidates = [qnId for b in bands for qnId in pool['bands'].get(b, ()) if qnId not in exclude]
+        if len(out) + len(candidates) >= count:
+            return out + random.sample(candidates, count - len(out))
+        out += candidates
+    return out
+
+
+def _leastSuitable(timesAnswered, timesCorrect, targetDifficulty, count):
+    """
+    Return indices of the count questions least suited to targetDifficulty,
+    given lists of their timesAnswered / timesCorrect. Unanswered questions
+    are always suitable
+    """
+    if numpy is not None:
+        answered = numpy.array(timesAnswered, dtype=float)
+        correct = numpy.array(timesCorrect, dtype=float)
+        suitability = numpy.where(
+            answered == 0,
+            1,
+            1 - numpy.abs(targetDifficulty - correct / numpy.maximum(answered, 1)),
+        )
+        return numpy.argsort(suitability, kind='mergesort')[:count].tolist()
+
+    suitability = [
+        1 if nAnswered == 0 else 1 - abs(targetDifficulty - float(nCorrect) / nAnswered)
+        for (nAnswered, nCorrect) in zip(timesAnswered, timesCorrect)
+    ]
+    return sorted(range(len(suitability)), key=lambda k: suitability[k])[:count]
+
+
+def purgeInactiveAllocations(before, batchSize=1000):
+    """
+    Delete allocations made inactive before (datetime) in batches of
+    batchSize, yielding the number of rows deleted after each batch so the
+    caller can commit.
+    """
+    allocTable = db.Allocation.__table__
+    lastId = 0
+    while True:
+        rows = (Session.query(db.Allocation.allocationId, db.Allocation.publicId)
+            .filter(db.Allocation.allocationId > lastId)
+            .filter(db.Allocation.active == False)
+            .filter(db.Allocation.deactivationTime < before)
+            .order_by(db.Allocation.allocationId)
+            .limit(batchSize)
+            .all())
+        if not rows:
+            return
+        ids = [allocationId for (allocationId, publicId) in rows]
+        Session.execute(allocTable.delete().where(allocTable.c.allocationId.in_(ids)))
+        for (allocationId, publicId) in rows:
+            _publicIdCache.pop(publicId)
+        lastId = ids[-1]
+        yield len(ids)
+
 
 class OriginalAllocation(BaseAllocation):
     @classmethod
     def allocFromUri(cls, student, uri, urlBase="/"):
-        # No lecture in URI, so fall back to querying database
+        # No lecture in URI, so look up the allocation
         publicId = uri.rsplit("/", 1)[-1]
-
-        # NB: This isn't very efficient, but in theory it's transitional
-        query = Session.query(db.Question, db.Allocation, db.Lecture) \
-            .join(db.Allocation).join(db.Lecture) \
-            .filter(db.Allocation.publicId == publicId) \
-            .filter(db.Question.active == True)
-        (dbQn, dbAlloc, dbLec) = query.one()
+        ids = _lookupPublicIds([publicId]).get(publicId, None)
+        if ids is None:
+            raise NoResultFound("No allocation %s" % publicId)
 
         return OriginalAllocation(
             student=student,
-            dbLec=dbLec,
+            dbLec=Session.query(db.Lecture).get(ids[0]),
             urlBase=urlBase,
         )
 
@@ -39,8 +224,8 @@ class OriginalAllocation(BaseAllocation):
         # A function that gets all userGeneratedQuestions for an alloc too? Or at least filter what's there
 
         # Get all questions from DB and their allocations
-        dbAllocs = Session.query(db.Question, db.Allocation) \
-            .join(db.Allocation) \
+        dbAllocs = Session.query(db.Allocation.publicId, *db.QuestionRow.columns()) \
+            .join(db.Question, db.Question.questionId == db.Allocation.questionId) \
             .filter(db.Question.active == True) \
             .filter(db.Allocation.active == True) \
             .filter(db.Allocation.lectureId == self.dbLec.lectureId) \
@@ -49,25 +234,48 @@ class OriginalAllocation(BaseAllocation):
             .all()
 
         # Render each question into a dict
-        for (dbQn, dbAlloc) in dbAllocs:
-            yield (self._questionUrl(dbAlloc.publicId), dbQn)
+        for row in dbAllocs:
+            yield (self._questionUrl(row[0]), db.QuestionRow(*row[1:]))
 
     def getQuestions(self, uris=None, lockForUpdate=False, isAdmin=False, active=True):
-        query = Session.query(db.Question, db.Allocation).join(db.Allocation)
+        if uris is not None:
+            # Resolve publicIds without touching the allocation table where possible
+            allocIds = _lookupPublicIds(set(u.rsplit('/', 1)[-1] for u in uris))
+            if not isAdmin:
+                # Ensure we're the right user
+                allocIds = dict(
+                    (publicId, ids) for (publicId, ids) in allocIds.items()
+                    if ids[2] == self.student.studentId
+                )
+            if not allocIds:
+                return
+
+            query = Session.query(db.Question).filter(db.Question.questionId.in_(
+                set(questionId for (lectureId, questionId, studentId) in allocIds.values())
+            ))
+            if lockForUpdate:
+                query = query.with_lockmode('update')
+            if active is not None:
+                query = query.filter(db.Question.active == active)
+            dbQns = dict((dbQn.questionId, dbQn) for dbQn in query)
+
+            for (publicId, (lectureId, questionId, studentId)) in allocIds.items():
+                if questionId in dbQns:
+                    yield (self._questionUrl(publicId), dbQns[questionId])
+            return
+
+        # NB: Questions aren't being graded, so only fetch the columns we need
+        query = (Session.query(db.Allocation.publicId, *db.QuestionRow.columns())
+            .join(db.Question, db.Question.questionId == db.Allocation.questionId))
 
         if lockForUpdate:
             query = query.with_lockmode('update')
 
-        if uris is not None:
-            query = query.filter(db.Allocation.publicId.in_(
-                u.rsplit('/', 1)[-1] for u in uris
-            ))
-        else:
-            # TODO: Use this instead of getAllQuestions
-            query = query.filter(db.Question.lectures.contains(self.dbLec)) \
-                .filter(db.Allocation.lectureId == self.dbLec.lectureId)
-            query = query.filter(db.Question.onlineOnly == False)
-            query = query.filter(db.Question.active == True)
+        # TODO: Use this instead of getAllQuestions
+        query = query.filter(db.Question.lectures.contains(self.dbLec)) \
+            .filter(db.Allocation.lectureId == self.dbLec.lectureId)
+        query = query.filter(db.Question.onlineOnly == False)
+        query = query.filter(db.Question.active == True)
 
         if active is not None:
             query = query.filter(db.Question.active == active)
@@ -75,12 +283,31 @@ class OriginalAllocation(BaseAllocation):
         if not isAdmin:
             query = query.filter(db.Allocation.studentId == self.student.studentId)
 
-        for (dbQn, dbAlloc) in query:
-            yield (self._questionUrl(dbAlloc.publicId), dbQn)
+        for row in query:
+            yield (self._questionUrl(row[0]), db.QuestionRow(*row[1:]))
+
+    def _deactivateAllocations(self, *whereclauses):
+        """Mark this student's active allocations matching whereclauses inactive, return how many were"""
+        allocTable = db.Allocation.__table__
+        query = (allocTable.update()
+            .where(allocTable.c.studentId == self.student.studentId)
+            .where(allocTable.c.lectureId == self.dbLec.lectureId)
+            .where(allocTable.c.active == True))
+        for w in whereclauses:
+            query = query.where(w)
+        result = Session.execute(query.values(active=False, deactivationTime=datetime.datetime.utcnow()))
+
+        if result.rowcount:
+            # Any allocations we have loaded might be out of date
+            for obj in Session.identity_map.values():
+                if isinstance(obj, db.Allocation):
+                    Session.expire(obj, ['active', 'deactivationTime'])
+        return result.rowcount
 
     def updateAllocation(self, settings, question_cap=DEFAULT_QUESTION_CAP):
         # Get all existing allocations from the DB and their questions
         allocsByType = dict()
+        self.questionsAllocated = 0
         hist_sel = float(settings.get('hist_sel', '0'))
         if hist_sel > 0.001:
             allocsByType['historical'] = []
@@ -92,84 +319,108 @@ class OriginalAllocation(BaseAllocation):
             allocsByType['regular'] = []
             allocsByType['template'] = []
 
-        # Fetch all existing allocations, divide by allocType
-        for (dbAlloc, dbQn) in (Session.query(db.Allocation, db.Question)
-                .join(db.Question)
+        # Allocations for questions that have been removed or updated since are stale
+        allocTable = db.Allocation.__table__
+        qnTable = db.Question.__table__
+        self._deactivateAllocations(exists().where(and_(
+            qnTable.c.questionId == allocTable.c.questionId,
+            or_(qnTable.c.active == False, qnTable.c.lastUpdate > allocTable.c.allocationTime),
+        )))
+
+        # NB: Same as Question.defAllocType, in SQL
+        allocTypeExpr = func.coalesce(db.Allocation.allocType, case(
+            [(db.Question.qnType == 'tw_questiontemplate', 'template')],
+            else_='regular',
+        )).label('allocType')
+
+        def allocQuery(*columns):
+            """Query columns of this student's active allocations and their questions"""
+            return (Session.query(*columns)
+                .join(db.Question, db.Question.questionId == db.Allocation.questionId)
                 .filter(db.Allocation.studentId == self.student.studentId)
                 .filter(db.Allocation.active == True)
-                .filter(db.Allocation.lectureId == self.dbLec.lectureId)):
-            if not(dbQn.active) or (dbAlloc.allocationTime < dbQn.lastUpdate):
-                # Question has been removed or is stale
-                dbAlloc.active = False
-            else:
-                # Still around, so save it
-                if (dbAlloc.allocType or dbQn.defAllocType) in allocsByType:
-                    # NB: If hist_sel has changed, we might not want some types any more
-                    allocsByType[dbAlloc.allocType or dbQn.defAllocType].append(dict(alloc=dbAlloc, question=dbQn))
+                .filter(db.Allocation.lectureId == self.dbLec.lectureId))
 
         # Each question type should have at most question_cap questions
-        for (allocType, allocs) in allocsByType.items():
-            questionCap = int(settings.get('question_cap_' + allocType, settings.get('question_cap', DEFAULT_QUESTION_CAP)))
+        questionCaps = dict(
+            (allocType, int(settings.get('question_cap_' + allocType, settings.get('question_cap', DEFAULT_QUESTION_CAP))))
+            for allocType in allocsByType.keys()
+        )
+
+        # Decide what to throw away before fetching the allocations we keep
+        allocCounts = dict(allocQuery(allocTypeExpr, func.count()).group_by(allocTypeExpr))
+        removeIds = []
+        for allocType in allocsByType.keys():
+            questionCap = questionCaps[allocType]
+            # If there's questions to spare, and requested to do so, reallocate questions
+            reAlloc = self.reAllocQuestions and allocCounts.get(allocType, 0) >= questionCap
+            if allocCounts.get(allocType, 0) <= questionCap and not reAlloc:
+                continue
+            if reAlloc and self.targetDifficulty is None:
+                raise ValueError("Must have a target difficulty to know what to remove")
+
+            # NB: Only need the counts from each question to choose
+            rows = (allocQuery(db.Allocation.allocationId, db.Question.timesAnswered, db.Question.timesCorrect)
+                .filter(allocTypeExpr == allocType)
+                .order_by(db.Allocation.allocationId)
+                .all())
 
             # If there's too many allocs, throw some away
-            for i in sorted(random.sample(xrange(len(allocs)), max(len(allocs) - questionCap, 0)), reverse=True):
-                allocs[i]['alloc'].active = False
-                del allocs[i]
+            for i in sorted(random.sample(xrange(len(rows)), max(len(rows) - questionCap, 0)), reverse=True):
+                removeIds.append(rows[i].allocationId)
+                del rows[i]
 
-            # If there's questions to spare, and requested to do so, reallocate questions
-            if len(allocs) == questionCap and self.reAllocQuestions:
-                if self.targetDifficulty is None:
-                    raise ValueError("Must have a target difficulty to know what to remove")
-
-                # Make ranking how likely questions are, based on targetDifficulty
-                suitability = []
-                for a in allocs:
-                    if a['question'].timesAnswered == 0:
-                        # New questions should be added regardless
-                        suitability.append(1)
-                    else:
-                        suitability.append(1 - abs(self.targetDifficulty - float(a['question'].timesCorrect) / a['question'].timesAnswered))
-                ranking = sorted(range(len(allocs)), key=lambda k: suitability[k])
-
-                # Remove the least likely tenth
-                for i in sorted(ranking[0:len(allocs) / 10 + 1], reverse=True):
-                    allocs[i]['alloc'].active = False
-                    del allocs[i]
+            if reAlloc:
+                # Remove the least likely tenth, based on targetDifficulty
+                removeIds.extend(rows[i].allocationId for i in _leastSuitable(
+                    [r.timesAnswered for r in rows],
+                    [r.timesCorrect for r in rows],
+                    self.targetDifficulty,
+                    len(rows) / 10 + 1,
+                ))
+        if removeIds:
+            self._deactivateAllocations(allocTable.c.allocationId.in_(removeIds))
+
+        # Fetch all remaining allocations, divide by allocType
+        for row in allocQuery(db.Allocation.allocationId, db.Allocation.publicId, allocTypeExpr, *db.QuestionRow.columns()):
+            # NB: row has the allocationId / publicId / questionId we need from Allocation
+            if row.allocType in allocsByType:
+                # NB: If hist_sel has changed, we might not want some types any more
+                allocsByType[row.allocType].append(dict(alloc=row, question=db.QuestionRow(*row[3:])))
+
+        for (allocType, allocs) in allocsByType.items():
+            questionCap = questionCaps[allocType]
 
             # Assign required questions randomly
             if len(allocs) < questionCap:
-                query = Session.query(db.Question).filter_by(qnType='tw_questiontemplate' if allocType == 'template' else 'tw_latexquestion').filter_by(active=True)
-                if allocType == 'historical':
-                    # Get questions from lectures "before" the current one
-                    targetQuestions = (Session.query(db.LectureQuestion.questionId)
-                        .join(db.Lecture)
-                        .filter(db.Lecture.plonePath.startswith(re.sub(r'/[^/]+/?$', '/', self.dbLec.plonePath)))
-                        .filter(db.Lecture.plonePath < self.dbLec.plonePath)
-                        .subquery())
-                    query = query.filter(db.Question.questionId.in_(targetQuestions))
-                else:
-                    # Git questions from current lecture
-                    query = query.filter(db.Question.lectures.contains(self.dbLec))
-
-                # Filter out anything already allocated
-                allocIds = [a['alloc'].questionId for a in allocs]
-                if len(allocIds) > 0:
-                    query = query.filter(~db.Question.questionId.in_(allocIds))
-
-                # Give a target difficulty
-                if self.targetDifficulty is not None:
-                    query = query.order_by(func.abs(round(self.targetDifficulty * 50) - func.round((50.0 * db.Question.timesCorrect) / db.Question.timesAnswered)))
-
-                for dbQn in query.order_by(func.random()).limit(max(questionCap - len(allocs), 0)):
+                chosenIds = _chooseQuestions(
+                    getQuestionPool(self.dbLec, historical=allocType == 'historical').get(
+                        'tw_questiontemplate' if allocType == 'template' else 'tw_latexquestion'),
+                    set(a['alloc'].questionId for a in allocs),
+                    questionCap - len(allocs),
+                    targetDifficulty=self.targetDifficulty,
+                )
+
+                dbQns = dict((row[0], db.QuestionRow(*row)) for row in (Session.query(*db.QuestionRow.columns())
+                    .filter(db.Question.questionId.in_(chosenIds))
+                    .filter(db.Question.active == True))) if chosenIds else {}
+                if len(dbQns) < len(chosenIds):
+                    # Pool is out of date, rebuild it next time
+                    clearQuestionPoolCache(self.dbLec.lectureId)
+
+                for questionId in chosenIds:
+                    if questionId not in dbQns:
+                        continue
                     dbAlloc = db.Allocation(
                         studentId=self.student.studentId,
-                        questionId=dbQn.questionId,
+                        questionId=questionId,
                         lectureId=self.dbLec.lectureId,
                         allocationTime=datetime.datetime.utcnow(),
                         allocType='historical' if allocType == 'historical' else None,
                     )
                     Session.add(dbAlloc)
-                    allocs.append(dict(alloc=dbAlloc, question=dbQn, new=True))
+                    allocs.append(dict(alloc=dbAlloc, question=dbQns[questionId], new=True))
+                    self.questionsAllocated += 1
 
         Session.flush()
         for allocType, allocs in allocsByType.items():
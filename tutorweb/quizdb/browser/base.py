@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import re
@@ -17,7 +18,10 @@ from Products.CMFCore.utils import getToolByName
 from Products.Five.browser import BrowserView
 
 from tutorweb.quizdb import db
+from tutorweb.quizdb.config import render_config
+from tutorweb.quizdb.render import renderTeX
 from tutorweb.quizdb.utils import getDbHost, getDbStudent, getDbLecture
+from tutorweb.quizdb.sync.student import getStudentSettings
 
 
 class BrowserViewHelpers(object):
@@ -63,10 +67,23 @@ class BrowserViewHelpers(object):
 
         return getDbLecture(plonePath)
 
+    def getStudentSettings(self, dbLec, student):
+        """Settings for student in dbLec, only worked out once per view"""
+        if getattr(self, '_studentSettings', None) is None:
+            self._studentSettings = {}
+        key = (dbLec.lectureId, student.studentId)
+        if key not in self._studentSettings:
+            self._studentSettings[key] = getStudentSettings(dbLec, student)
+        return self._studentSettings[key]
+
     def texToHTML(self, f):
-        """Encode TeX in f into HTML"""
+        """Encode TeX in f into HTML, re-using any previous render"""
         if not f:
             return f
+        return renderTeX(f, self._transformTeX, cacheDir=render_config.CACHE_DIR)
+
+    def _transformTeX(self, f):
+        """Put f through portal_transforms"""
         if getattr(self, '_pt', None) is None:
             self._pt = getToolByName(self.context, 'portal_transforms')
         return self._pt.convertTo(
@@ -90,6 +107,31 @@ class JSONBrowserView(BrowserView, BrowserViewHelpers):
         """Return dict to be turned into JSON"""
         raise NotImplementedError
 
+    def versionKey(self, data):
+        """
+        Return a string that changes whenever asDict(data) would, or None if
+        the response can't be cached. Should be much cheaper than asDict.
+        """
+        return None
+
+    def notModified(self, data):
+        """
+        Work out ETag for the response (set later, in case asDict fails),
+        return True iff client already has this version
+        """
+        self._etag = None
+        version = self.versionKey(data)
+        if version is None:
+            return False
+        if isinstance(version, unicode):
+            version = version.encode('utf-8')
+        etag = self._etag = '"%s"' % hashlib.sha1(version).hexdigest()
+        ifNoneMatch = self.request.getHeader('If-None-Match', None)
+        return ifNoneMatch is not None and (
+            ifNoneMatch.strip() == '*' or
+            etag in [x.strip() for x in ifNoneMatch.split(',')]
+        )
+
     def __call__(self):
         try:
             # Is there a request body?
@@ -101,8 +143,15 @@ class JSONBrowserView(BrowserView, BrowserViewHelpers):
             else:
                 data = self.request.form
 
+            if self.notModified(data):
+                self.request.response.setStatus(304)
+                self.request.response.setHeader("ETag", self._etag)
+                return ''
+
             out = self.asDict(data)
             self.request.response.setStatus(200)
+            if self._etag:
+                self.request.response.setHeader("ETag", self._etag)
             self.request.response.setHeader("Content-type", "application/json")
             return json.dumps(out)
         except Unauthorized, ex:
@@ -19,9 +19,11 @@ from Products.CMFCore import permissions
 
 from tutorweb.quizdb import db
 from tutorweb.quizdb.allocation.base import Allocation
+from tutorweb.quizdb.bundle import checkBundle, getBundle, setBundle, writeBundle
+from tutorweb.quizdb.config import bundle_config
+from tutorweb.quizdb.sync.questions import cacheQuestionData, getCachedQuestionData
 from .base import JSONBrowserView
 
-from ..sync.student import getStudentSettings
 
 # logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
 
@@ -59,11 +61,22 @@ class QuestionView(JSONBrowserView):
                 out['answer']['correct'].append(i)
         return out
 
-    def getQuestionData(self, dbQn, dbLec):
-        """Fetch dict for question, obsfucating the answer"""
+    def getQuestionData(self, dbQn, dbLec, portalUrl=None):
+        """
+        Fetch dict for question, obsfucating the answer. URLs are for
+        portalUrl, by default the portal of the current request
+        """
         out = None
+        ownPortalUrl = self.portalObject().absolute_url()
+        if portalUrl is None:
+            portalUrl = ownPortalUrl
 
-        def getQuestionDict(plonePath):
+        def getQuestionDict(dbQn):
+            out = getCachedQuestionData(portalUrl, dbQn.plonePath, dbQn.lastUpdate)
+            if out is not None:
+                return out
+
+            plonePath = dbQn.plonePath
             if '?' in plonePath:
                 (plonePath, querystring) = plonePath.split('?', 1)
                 querystring = urlparse.parse_qs(querystring)
@@ -75,7 +88,12 @@ class QuestionView(JSONBrowserView):
                 dataView = self.portalObject().unrestrictedTraverse(str(plonePath) + '/@@data')
             except KeyError:
                 raise NotFound(self, str(plonePath), self.request)
-            return dataView.asDict(querystring)
+            out = dataView.asDict(querystring)
+            cacheQuestionData(ownPortalUrl, dbQn.plonePath, dbQn.lastUpdate, out)
+            if portalUrl != ownPortalUrl:
+                # Rewrite URLs for the portal asked for
+                out = getCachedQuestionData(portalUrl, dbQn.plonePath, dbQn.lastUpdate) or out
+            return out
 
         # Is the student requesting a particular question they've done before?
         if not out and dbQn.qnType == 'tw_questiontemplate' and 'question_id' in self.request.form and 'author_qn' not in self.request.form:
@@ -97,7 +115,7 @@ class QuestionView(JSONBrowserView):
             student = self.getCurrentStudent()
 
             # Fetch value of required settings
-            settings = getStudentSettings(dbLec, student)
+            settings = self.getStudentSettings(dbLec, student)
             setting_values = dict(
                 prob_template_eval=float(settings.get('prob_template_eval', 0.8)),
                 cap_template_qns=int(settings.get('cap_template_qns', 5)),
@@ -151,7 +169,7 @@ class QuestionView(JSONBrowserView):
                     raise BadRequest("No questions for student to review")
             else:
                 # Author a question
-                out = getQuestionDict(dbQn.plonePath)
+                out = getQuestionDict(dbQn)
                 qnUri = self.request.getURL()
                 if '?' in qnUri:
                     qnUri = qnUri.split('?')[0]
@@ -180,7 +198,7 @@ class QuestionView(JSONBrowserView):
 
         # No custom techniques, fetch question @@data
         if not out:
-            out = getQuestionDict(dbQn.plonePath)
+            out = getQuestionDict(dbQn)
 
         # Obsfucate answer
         if 'answer' in out:
@@ -210,19 +228,44 @@ class GetQuestionView(QuestionView):
             self.context,
         )
 
+    def getAllocQuestion(self):
+        """Return (allocation, question) the URL refers to, only looking once"""
+        if getattr(self, '_allocQuestion', None) is None:
+            questionUri = self.request.getURL()
+            alloc = Allocation.allocFromUri(
+                uri=questionUri,
+                student=self.getCurrentStudent(),
+                urlBase=self.portalObject().absolute_url(),
+            )
+            self._allocQuestion = (alloc, alloc.getQuestion(questionUri, isAdmin=self.isAdmin()))
+        return self._allocQuestion
+
+    def versionKey(self, data):
+        if self.questionId is None:
+            return None
+        try:
+            (alloc, dbQn) = self.getAllocQuestion()
+        except (NoResultFound, MultipleResultsFound):
+            # Let asDict report the error
+            return None
+        if not dbQn or dbQn.qnType == 'tw_questiontemplate':
+            # Templates choose something different each time
+            return None
+        return '%s?%s:%d:%s:%s' % (
+            self.request.getURL(),
+            self.request.get('QUERY_STRING', ''),
+            alloc.student.studentId,
+            self.isAdmin(),
+            dbQn.lastUpdate.isoformat(),
+        )
+
     def asDict(self, data):
         if self.questionId is None:
             raise NotFound(self, None, self.request)
-        questionUri = self.request.getURL()
         isAdmin = self.isAdmin()
 
         try:
-            alloc = Allocation.allocFromUri(
-                uri=questionUri,
-                student=self.getCurrentStudent(),
-                urlBase=self.portalObject().absolute_url(),
-            )
-            dbQn = alloc.getQuestion(questionUri, isAdmin=isAdmin)
+            (alloc, dbQn) = self.getAllocQuestion()
             if not dbQn:
                 raise NotFound(self, self.questionId, self.request)
             qnData = self.getQuestionData(dbQn, alloc.dbLec)
@@ -236,16 +279,94 @@ class GetQuestionView(QuestionView):
 
 class GetLectureQuestionsView(QuestionView):
     """Fetch all questions for a lecture"""
+    def wantsBundle(self, data):
+        """True iff the client asked for a bundle, with bundle=1 or bundle=true"""
+        return str(data.get('bundle', '')).lower() in ('1', 'true')
+
+    def questionBundle(self, dbLec, portalUrl=None, rebuild=False):
+        """
+        Return (name, questionIds) of a bundle with every question in dbLec,
+        with URLs for portalUrl (by default the current portal), writing it
+        if need be or rebuild is set. Returns None if bundles aren't
+        configured, or the lecture has questions that can't be bundled.
+        """
+        if not bundle_config.DIR:
+            return None
+        if portalUrl is None:
+            portalUrl = self.portalObject().absolute_url()
+        bundle = None if rebuild else getBundle(dbLec, portalUrl)
+        if bundle is not None and not bundle[0]:
+            return None
+        if bundle is not None and checkBundle(bundle_config.DIR, bundle[0]):
+            return bundle
+
+        dbQns = (Session.query(db.Question)
+            .filter(db.Question.lectures.contains(dbLec))
+            .filter(db.Question.active == True)
+            .all())
+        if any(dbQn.qnType != 'tw_latexquestion' for dbQn in dbQns):
+            # Question templates are different for each student
+            setBundle(dbLec, portalUrl, '')
+            return None
+
+        payloads = {}
+        for dbQn in dbQns:
+            try:
+                payloads[dbQn.questionId] = self.getQuestionData(dbQn, dbLec, portalUrl=portalUrl)
+            except NotFound:
+                pass
+        setBundle(dbLec, portalUrl, writeBundle(bundle_config.DIR, payloads), payloads.keys())
+        return getBundle(dbLec, portalUrl)
+
+    def allQuestions(self):
+        """List of (questionUri, question) allocated to the student, only looking once"""
+        if getattr(self, '_allQuestions', None) is None:
+            dbLec = self.getDbLecture()
+            student = self.getCurrentStudent()
+            alloc = Allocation.allocFor(
+                student=student,
+                dbLec=dbLec,
+                urlBase=self.portalObject().absolute_url(),
+                settings=self.getStudentSettings(dbLec, student),
+            )
+            self._allQuestions = list(alloc.getAllQuestions())
+        return self._allQuestions
+
+    def versionKey(self, data):
+        allQuestions = self.allQuestions()
+        if any(dbQn.qnType == 'tw_questiontemplate' for (_, dbQn) in allQuestions):
+            # Templates choose something different each time
+            return None
+        bundle = self.questionBundle(self.getDbLecture()) if self.wantsBundle(data) else None
+        return '%s:%d:%s:%s' % (
+            self.request.getURL(),
+            self.getCurrentStudent().studentId,
+            bundle[0] if bundle else '',
+            ','.join(sorted(
+                '%s=%d@%s' % (questionUri, dbQn.questionId, dbQn.lastUpdate.isoformat())
+                for (questionUri, dbQn) in allQuestions
+            )),
+        )
+
     def asDict(self, data):
         dbLec = self.getDbLecture()
-        alloc = Allocation.allocFor(
-            student=self.getCurrentStudent(),
-            dbLec=dbLec,
-            urlBase=self.portalObject().absolute_url(),
-        )
+
+        # If the client can use a bundle, just tell it which questions to use from it
+        bundle = self.questionBundle(dbLec) if self.wantsBundle(data) else None
+        if bundle:
+            (bundleName, bundleIds) = bundle
+            return dict(
+                bundle='%s/%s' % (bundle_config.URL.rstrip('/'), bundleName),
+                questions=dict(
+                    (questionUri, dbQn.questionId)
+                    for questionUri, dbQn
+                    in self.allQuestions()
+                    if dbQn.questionId in bundleIds  # i.e. not questions that have gone from Plone
+                ),
+            )
 
         out = {}
-        for questionUri, dbQn in alloc.getAllQuestions():
+        for questionUri, dbQn in self.allQuestions():
             try:
                 out[questionUri] = self.getQuestionData(dbQn, dbLec)
             except NotFound:
@@ -4,6 +4,7 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from z3c.saconfig import Session
 from tutorweb.quizdb import db
+from tutorweb.quizdb.sync.student import updateStudentRegistered
 
 from .base import JSONBrowserView
 
@@ -20,6 +21,7 @@ class SubscriptionView(JSONBrowserView):
         student = self.getCurrentStudent()
 
         # Add any additional subscriptions
+        subsChanged = False
         for lec in toArray(data.get('add_lec', [])):
             ploneLec = self.portalObject().restrictedTraverse(self.lectureUrlToPlonePath(lec))
             ploneTutPath = '/'.join(ploneLec.aq_parent.getPhysicalPath())
@@ -36,6 +38,7 @@ class SubscriptionView(JSONBrowserView):
                     plonePath=ploneTutPath,
                 ))
             Session.flush()
+            subsChanged = True
 
         # Fish out all subscribed tutorials/classes, organised by tutorial
         del_lec = toArray(data.get('del_lec', []))
@@ -47,6 +50,7 @@ class SubscriptionView(JSONBrowserView):
                 # Subscription item vanished, hide it and move on
                 dbSub.hidden = True
                 Session.flush()
+                subsChanged = True
                 continue
             if obj.portal_type == 'tw_tutorial':
                 lectures = (l.getObject() for l in obj.restrictedTraverse('@@folderListing')(portal_type='tw_lecture'))
@@ -63,10 +67,14 @@ class SubscriptionView(JSONBrowserView):
             if next((l for l in lectures if l['uri'] in del_lec), False):
                 dbSub.hidden = True
                 Session.flush()
+                subsChanged = True
             else:
                 subs['children'].append(dict(
                     title=obj.Title(),
                     children=lectures,
                 ))
 
+        if subsChanged:
+            # Student might have gained / lost a class
+            updateStudentRegistered([student.studentId])
         return subs
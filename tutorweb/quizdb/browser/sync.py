@@ -1,11 +1,12 @@
 from AccessControl import Unauthorized
+from zExceptions import BadRequest
 
 from .base import JSONBrowserView
 
 from ..allocation.base import Allocation
 from ..sync.questions import getQuestionAllocation
-from ..sync.answers import parseAnswerQueue
-from ..sync.student import getStudentSettings, SERVERSIDE_SETTINGS
+from ..sync.answers import parseAnswerQueue, getAnswerQueueSummary
+from ..sync.student import getStudentSettingsBatch, SERVERSIDE_SETTINGS
 
 # logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
 
@@ -20,28 +21,37 @@ class SyncTutorialView(JSONBrowserView):
         )
 
         # Fetch a list of all lectures
-        lectureUrls = (
-            l.id + '/quizdb-sync'
+        lectureViews = [
+            (l.id + '/quizdb-sync', self.context.restrictedTraverse(l.id + '/quizdb-sync'))
             for l
             in self.context.restrictedTraverse('@@folderListing')(
                 portal_type='tw_lecture',
                 sort_on='id',
             )
-        )
+        ]
+
+        # Get settings for all lectures in one go
+        if lectureViews:
+            student = self.getCurrentStudent()
+            dbLecs = [view.getDbLecture() for (url, view) in lectureViews]
+            settings = getStudentSettingsBatch(dbLecs, student)
+        else:
+            dbLecs = []
+            settings = {}
 
         return dict(
             uri=self.lectureObjToUrl(self.context),
             title=self.context.title,
             lectures=[
-                self.context.restrictedTraverse(url).asDict(lectureDict.get(url, None))
-                for url
-                in lectureUrls
+                view.asDict(lectureDict.get(url, None), settings=settings[dbLec.lectureId])
+                for ((url, view), dbLec)
+                in zip(lectureViews, dbLecs)
             ],
         )
 
 
 class SyncLectureView(JSONBrowserView):
-    def asDict(self, data):
+    def asDict(self, data, settings=None):
         student = self.getCurrentStudent()
         portalObj = self.portalObject()
         dbLec = self.getDbLecture()
@@ -51,21 +61,31 @@ class SyncLectureView(JSONBrowserView):
         if lecture.get('user', None) and lecture['user'] != student.userName:
             raise Unauthorized('This drill is for user ' + lecture['user'] + ', not ' + student.userName)
 
-        # Get settings for student
-        settings = getStudentSettings(dbLec, student)
+        # Get settings for student, unless SyncTutorialView already did
+        if settings is None:
+            settings = self.getStudentSettings(dbLec, student)
 
         allocObj = Allocation.allocFor(
             student=student,
             dbLec=dbLec,
             urlBase=self.context.portal_url.getPortalObject().absolute_url(),
+            settings=settings,
         )
 
         # Parse answer queue first to update question counts
+        # NB: If the client tells us the last answer it has, only send newer ones back
+        answerQueueSince = lecture.get('answerQueueSince', None)
+        if answerQueueSince is not None:
+            try:
+                answerQueueSince = int(answerQueueSince)
+            except (TypeError, ValueError):
+                raise BadRequest("answerQueueSince should be an answer_time, not %s" % repr(answerQueueSince))
         answerQueue = parseAnswerQueue(
             allocObj,
             lecture.get('answerQueue', []),
             settings,
             studentSettings=lecture.get('settings', []),
+            since=answerQueueSince,
         )
 
         # ... then fetch question lists
@@ -75,7 +95,7 @@ class SyncLectureView(JSONBrowserView):
         )
 
         # Build lecture dict
-        return dict(
+        out = dict(
             uri=self.lectureObjToUrl(self.context),
             user=student.userName,
             question_uri=self.lectureObjToUrl(self.context, 'quizdb-all-questions'),
@@ -86,3 +106,8 @@ class SyncLectureView(JSONBrowserView):
             answerQueue=answerQueue,
             questions=list(questions),
         )
+        if answerQueueSince is not None:
+            # answerQueue isn't complete, add a summary so client can check its copy
+            out['answerQueueSummary'] = getAnswerQueueSummary(dbLec, student)
+            out['answerQueueSince'] = out['answerQueueSummary']['last_answer_time'] or 0
+        return out
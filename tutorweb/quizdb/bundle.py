@@ -0,0 +1,132 @@
+"""
+Bundles of all question data for a lecture, written as static files so
+they can be served without Zope. Bundles are named by their content, so
+an unchanged lecture keeps the same file and clients can cache forever.
+Question data contains absolute URLs, so each portal URL gets its own bundle.
+"""
+import errno
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from StringIO import StringIO
+
+from tutorweb.quizdb.utils import LRUCache
+
+logger = logging.getLogger(__package__)
+
+# (bundle name, questionIds in it) by (portal URL, lectureId, lastUpdate)
+_bundleIndex = LRUCache(1000)
+
+# Portal URLs students have fetched bundles with
+_bundlePortalUrls = LRUCache(100)
+
+# Bundles still in use are touched at most this often (seconds), see purgeBundles
+TOUCH_INTERVAL = 3600
+
+
+def clearBundleIndex():
+    _bundleIndex.clear()
+    _bundlePortalUrls.clear()
+
+
+def _indexKey(dbLec, portalUrl):
+    # NB: MySQL drops microseconds, so do the same to compare before / after reloading
+    return (portalUrl, dbLec.lectureId, dbLec.lastUpdate.replace(microsecond=0))
+
+
+def getBundle(dbLec, portalUrl):
+    """
+    Return (name, questionIds) of dbLec's current bundle for portalUrl,
+    name is '' if it can't have one. None if we don't know
+    """
+    return _bundleIndex.get(_indexKey(dbLec, portalUrl))
+
+
+def setBundle(dbLec, portalUrl, name, questionIds=()):
+    _bundleIndex[_indexKey(dbLec, portalUrl)] = (name, frozenset(questionIds))
+    _bundlePortalUrls[portalUrl] = True
+
+
+def bundlePortalUrls():
+    """Portal URLs that bundles have been written for, i.e. that students use"""
+    return _bundlePortalUrls.keys()
+
+
+def checkBundle(bundleDir, name):
+    """
+    Return True iff bundle name is still in bundleDir, marking it as in use
+    so purgeBundles leaves it alone
+    """
+    path = os.path.join(bundleDir, name)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    if mtime < time.time() - TOUCH_INTERVAL:
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            logger.warn("Cannot touch bundle %s: %s" % (name, e))
+    return True
+
+
+def purgeBundles(bundleDir, before):
+    """
+    Delete bundles in bundleDir that haven't been used since before (unix
+    time), yielding the name of each one deleted
+    """
+    if not os.path.isdir(bundleDir):
+        return
+    for name in os.listdir(bundleDir):
+        if not name.endswith('.json.gz'):
+            continue
+        path = os.path.join(bundleDir, name)
+        try:
+            if os.stat(path).st_mtime >= before:
+                continue
+            os.unlink(path)
+        except OSError as e:
+            # Another client might have just got there
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        yield name
+
+
+def writeBundle(bundleDir, payloads):
+    """
+    Write out dict of questionId -> question data as a gzipped JSON file in
+    bundleDir, return the filename.
+    """
+    content = json.dumps(dict((str(k), v) for (k, v) in payloads.items()), sort_keys=True)
+    name = hashlib.sha1(content).hexdigest() + '.json.gz'
+    path = os.path.join(bundleDir, name)
+    if checkBundle(bundleDir, name):
+        # Already written, by us or another client
+        return name
+
+    # NB: mtime=0 so the same content always compresses to the same file
+    out = StringIO()
+    f = gzip.GzipFile(filename='', mode='wb', fileobj=out, mtime=0)
+    f.write(content)
+    f.close()
+
+    try:
+        if not os.path.isdir(bundleDir):
+            os.makedirs(bundleDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Write to a temporary file first, so nothing serves half a bundle
+    (fd, tmpPath) = tempfile.mkstemp(dir=bundleDir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(out.getvalue())
+    os.chmod(tmpPath, 0644)
+    os.rename(tmpPath, path)
+    return name
@@ -26,3 +26,10 @@ coin_config.RPC_USER = getConfigKey('coin-rpc-user')
 coin_config.RPC_PASS = getConfigKey('coin-rpc-pass')
 coin_config.RPC_WALLETPASS = getConfigKey('coin-rpc-walletpass')
 coin_config.CAPTCHA_KEY = getConfigKey('coin-captcha-key')
+
+render_config = ConfigObject()
+render_config.CACHE_DIR = getConfigKey('render-cache-dir')
+
+bundle_config = ConfigObject()
+bundle_config.DIR = getConfigKey('bundle-dir')
+bundle_config.URL = getConfigKey('bundle-url')
@@ -1,15 +1,18 @@
+import collections
 import random
 from uuid import uuid4
 from hashlib import md5
 from datetime import datetime
 
 from sqlalchemy import Table, UniqueConstraint, ForeignKeyConstraint
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 import sqlalchemy.event
 import sqlalchemy.schema
 import sqlalchemy.types
 from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import Insert
 
 from tutorweb.quizdb import ORMBase, customtypes
 
@@ -18,6 +21,36 @@ def toSql(query):
     return str(query.statement.compile())
 
 
+class InsertOrSkip(Insert):
+    """INSERT that leaves alone rows clashing with a unique key, see insertOrSkip"""
+    pass
+
+
+@compiles(InsertOrSkip)
+def _compileInsertOrSkip(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw)
+
+
+@compiles(InsertOrSkip, 'sqlite')
+def _compileInsertOrSkipSqlite(insert, compiler, **kw):
+    return compiler.visit_insert(insert.prefix_with('OR IGNORE'), **kw)
+
+
+@compiles(InsertOrSkip, 'mysql')
+def _compileInsertOrSkipMysql(insert, compiler, **kw):
+    # NB: Not INSERT IGNORE, that also turns FK violations / truncation into warnings
+    pk = compiler.preparer.quote(insert.table.primary_key.columns.values()[0].name)
+    return compiler.visit_insert(insert, **kw) + ' ON DUPLICATE KEY UPDATE %s = %s' % (pk, pk)
+
+
+def insertOrSkip(table):
+    """
+    INSERT that skips rows clashing with a unique key, any other error still raises.
+    NB: rowcount doesn't say what was skipped, MySQL counts skipped rows as found
+    """
+    return InsertOrSkip(table)
+
+
 class Allocation(ORMBase):
     """Allocation table: Which students are working on which questions"""
     __tablename__ = 'allocation'
@@ -65,6 +98,12 @@ class Allocation(ORMBase):
         nullable=False,
         default=True,
     )
+    deactivationTime = sqlalchemy.schema.Column(
+        # When active was cleared, clients can hold the URI for a while after
+        sqlalchemy.types.DateTime(),
+        nullable=True,
+        default=None,
+    )
     allocType = sqlalchemy.schema.Column(
         # The type of allocation, i.e. historical/template/regular
         sqlalchemy.types.String(64),
@@ -84,6 +123,43 @@ def generatePublicId(mapper, connection, instance):
     )).hexdigest()
 
 
+class CompactAllocation(ORMBase):
+    """Compact allocation table: All questions a student is working on in a lecture, in one row"""
+    __tablename__ = 'compactAllocation'
+    __table_args__ = dict(
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+
+    studentId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        sqlalchemy.schema.ForeignKey('student.studentId'),
+        primary_key=True,
+    )
+    lectureId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        sqlalchemy.schema.ForeignKey('lecture.lectureId'),
+        primary_key=True,
+    )
+    allocationTime = sqlalchemy.schema.Column(
+        sqlalchemy.types.DateTime(),
+        nullable=False,
+        default=datetime.utcnow,
+    )
+    questionIds = sqlalchemy.schema.Column(
+        # Packed array of regular / template questionIds, see allocation.compact
+        sqlalchemy.types.LargeBinary(),
+        nullable=False,
+        default='',
+    )
+    historicalIds = sqlalchemy.schema.Column(
+        # Packed array of questionIds from previous lectures
+        sqlalchemy.types.LargeBinary(),
+        nullable=False,
+        default='',
+    )
+
+
 class Host(ORMBase):
     """Host table: Hosts that run tutorweb"""
     __tablename__ = 'host'
@@ -287,6 +363,33 @@ class Subscription(ORMBase):
     )
 
 
+class Tutorial(ORMBase):
+    """Tutorial table: Plone folder each lecture lives in"""
+    __tablename__ = 'tutorial'
+    __table_args__ = (
+        UniqueConstraint('hostId', 'plonePath'),
+        dict(
+            mysql_engine='InnoDB',
+            mysql_charset='utf8',
+        )
+    )
+
+    tutorialId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        autoincrement=True,
+        primary_key=True,
+    )
+    hostId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        sqlalchemy.schema.ForeignKey('host.hostId'),
+        nullable=False,
+    )
+    plonePath = sqlalchemy.schema.Column(
+        sqlalchemy.types.String(128),
+        nullable=False,
+    )
+
+
 class Lecture(ORMBase):
     """DB -> Plone question lookup table"""
     __tablename__ = 'lecture'
@@ -323,6 +426,12 @@ class Lecture(ORMBase):
         default=0,  # NB: Should ~always jump to 1 when populated
         nullable=False,
     )
+    tutorialId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        sqlalchemy.schema.ForeignKey('tutorial.tutorialId'),
+        nullable=True,
+        index=True,
+    )
     questions = relationship("Question",
         secondary=LectureQuestion.__table__,
         backref="lectures")
@@ -539,6 +648,65 @@ class Question(ORMBase):
         return 'template' if self.qnType == 'tw_questiontemplate' else 'regular'
 
 
+class QuestionRow(collections.namedtuple('QuestionRow', [
+        'questionId',
+        'qnType',
+        'plonePath',
+        'lastUpdate',
+        'timesAnswered',
+        'timesCorrect',
+        ])):
+    """
+    Read-only Question, without the choices needed for grading answers.
+    Query for the columns(), then make one with QuestionRow(*row)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def columns(cls):
+        return [getattr(Question, f) for f in cls._fields]
+
+    # NB: Same as Question
+    @property
+    def onlineOnly(self):
+        return self.qnType == 'tw_questiontemplate'
+
+    @property
+    def defAllocType(self):
+        return 'template' if self.qnType == 'tw_questiontemplate' else 'regular'
+
+
+class QuestionCounter(ORMBase):
+    """Question counter table: Answer counts waiting to be folded into question"""
+    __tablename__ = 'questionCounter'
+    __table_args__ = dict(
+        mysql_engine='InnoDB',
+        mysql_charset='utf8',
+    )
+
+    questionCounterId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        primary_key=True,
+        autoincrement=True,
+    )
+    questionId = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        sqlalchemy.schema.ForeignKey('question.questionId'),
+        nullable=False,
+        index=True,
+    )
+    answered = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        nullable=False,
+        default=0,
+    )
+    correct = sqlalchemy.schema.Column(
+        sqlalchemy.types.Integer(),
+        nullable=False,
+        default=0,
+    )
+
+
 class Student(ORMBase):
     """Student table: Students of quizzes"""
     __tablename__ = 'student'
@@ -571,6 +739,12 @@ class Student(ORMBase):
         nullable=False,
         index=True,
     )
+    registered = sqlalchemy.schema.Column(
+        # Subscribed to a class, so "registered" setting variants apply. See updateStudentRegistered
+        sqlalchemy.types.Boolean(),
+        nullable=False,
+        default=False,
+    )
 
 
 class Answer(ORMBase):
@@ -598,6 +772,8 @@ class Answer(ORMBase):
         ForeignKeyConstraint(
             [lectureId, lectureVersion],
             [LectureGlobalSetting.lectureId, LectureGlobalSetting.lectureVersion]),
+        # A student can only answer a question once at any given moment
+        UniqueConstraint('studentId', 'lectureId', 'questionId', 'timeEnd', name='uniq_answer'),
         __table_args__,
     )
     studentId = sqlalchemy.schema.Column(
@@ -698,6 +874,11 @@ class AnswerSummary(ORMBase):
         nullable=False,
         default=0,
     )
+    maxTimeEnd = sqlalchemy.schema.Column(
+        # timeEnd of the latest answer counted above, NULL if there isn't one
+        sqlalchemy.types.DateTime(),
+        nullable=True,
+    )
 
 
 class DeprecatedLectureSetting(ORMBase):
@@ -0,0 +1,87 @@
+"""
+Cache rendered TeX, so the same text isn't put through portal_transforms
+over and over. Renders are kept in memory, and on disk if a cache directory
+is configured, so all Zope clients can share them.
+
+NB: Misses are rendered in the request thread. portal_transforms isn't safe
+to call from other threads (ZODB connection, getSite and the security
+context are all thread-local), and belongs to the request's ZODB connection
+so can't be handed to another process.
+"""
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+
+from tutorweb.quizdb.utils import LRUCache
+
+logger = logging.getLogger(__package__)
+
+# NB: Increment if the output of the transform changes, to ignore old renders
+RENDER_VERSION = 1
+
+_renderCache = LRUCache(5000)
+
+
+def clearRenderCache():
+    """Forget in-memory renders. Anything on disk is still used"""
+    _renderCache.clear()
+
+
+def _renderKey(tex):
+    """Content-addressed key for tex"""
+    return hashlib.sha1('%d:%s' % (RENDER_VERSION, tex.encode('utf-8'))).hexdigest()
+
+
+def _diskPath(cacheDir, key):
+    return os.path.join(cacheDir, key[:2], key + '.html')
+
+
+def _readDisk(cacheDir, key):
+    try:
+        with open(_diskPath(cacheDir, key), 'rb') as f:
+            return f.read().decode('utf-8')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            logger.warn("Cannot read render cache: %s" % e)
+        return None
+
+
+def _writeDisk(cacheDir, key, html):
+    path = _diskPath(cacheDir, key)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        # Another client might have just made it
+        if e.errno != errno.EEXIST:
+            logger.warn("Cannot write render cache: %s" % e)
+            return
+    try:
+        # Write to a temporary file first, so other clients never see half a file
+        (fd, tmpPath) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(html.encode('utf-8'))
+        os.rename(tmpPath, path)
+    except (IOError, OSError) as e:
+        logger.warn("Cannot write render cache: %s" % e)
+
+
+def renderTeX(tex, renderFn, cacheDir=None):
+    """
+    Return renderFn(tex), using a previous render if there is one. If
+    cacheDir is set, renders are also stored there.
+    """
+    key = _renderKey(tex)
+    html = _renderCache.get(key)
+    if html is not None:
+        return html
+
+    html = _readDisk(cacheDir, key) if cacheDir else None
+    if html is None:
+        html = renderFn(tex)
+        if cacheDir:
+            _writeDisk(cacheDir, key, html)
+    _renderCache[key] = html
+    return html
@@ -83,7 +83,8 @@ def dumpData(stateIn={}):
 
     return dict(
         host=[objDict(r) for r in Session.query(db.Host)],
-        student=[objDict(r) for r in Session.query(db.Student)
+        # NB: registered is worked out by each host, so isn't included
+        student=[dict((k, v) for (k, v) in objDict(r).items() if k != 'registered') for r in Session.query(db.Student)
             .join(matchingStudents, matchingStudents.c.studentId == db.Student.studentId)
             .order_by(db.Student.studentId)
             .distinct()],
@@ -91,7 +92,8 @@ def dumpData(stateIn={}):
             .join(matchingQuestions, matchingQuestions.c.questionId == db.Question.questionId)
             .order_by(db.Question.questionId)
             .distinct()],
-        lecture=[objDict(r) for r in Session.query(db.Lecture)
+        # NB: tutorialId is worked out by each host, so isn't included
+        lecture=[dict((k, v) for (k, v) in objDict(r).items() if k != 'tutorialId') for r in Session.query(db.Lecture)
             .join(matchingLectures, matchingLectures.c.lectureId == db.Lecture.lectureId)
             .order_by(db.Lecture.lectureId)],
         answer=[objDict(r) for r in Session.query(db.Answer)
@@ -7,6 +7,8 @@ from sqlalchemy.orm.exc import NoResultFound
 from z3c.saconfig import Session
 
 from tutorweb.quizdb import db
+from tutorweb.quizdb.sync.answers import checkAnswerSummaries
+from tutorweb.quizdb.utils import getDbTutorial
 
 from Globals import DevelopmentMode
 if DevelopmentMode:
@@ -154,6 +156,7 @@ def ingestData(data):
             dbLecture = db.Lecture(
                 hostId=idMap['hostId'][lecture['hostId']],
                 plonePath=lecture['plonePath'],
+                tutorialId=getDbTutorial(idMap['hostId'][lecture['hostId']], lecture['plonePath']).tutorialId,
             )
             Session.add(dbLecture)
             Session.flush()
@@ -243,6 +246,8 @@ def ingestData(data):
 
     # Filter out answer student/question/timeEnd combinations already stored in DB
     inserts['answer'] = 0
+    answerLectureIds = set()
+    answerStudentIds = set()
     for (dataEntry, dbEntry) in findMissingEntries(
             data['answer'],
             Session.query(db.Answer)
@@ -259,9 +264,16 @@ def ingestData(data):
             dbEntry.coinsAwarded = dataEntry['coinsAwarded']
         else:
             Session.add(db.Answer(**dataEntry))
+            answerLectureIds.add(dataEntry['lectureId'])
+            answerStudentIds.add(dataEntry['studentId'])
             inserts['answer'] += 1
     Session.flush()
 
+    # Summaries are running totals kept up by syncs, add in the answers we just wrote.
+    # NB: Students without a summary get one built from their answers on their next sync
+    if inserts['answer'] > 0:
+        checkAnswerSummaries(lectureIds=answerLectureIds, studentIds=answerStudentIds)
+
     if 'lecture_setting' in data:
         inserts['lecture_setting'] = 0
         for (dataEntry, dbEntry) in findMissingEntries(
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import argparse
+import datetime
+import logging
+import time
+
+from .replication import getApplication
+
+logger = logging.getLogger(__package__)
+
+
+def answerSummaryCheck():
+    parser = argparse.ArgumentParser(description='Rebuild answerSummary rows that disagree with the answer table')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--dry-run',
+        default=False,
+        action='store_true',
+        help='Report drifted summaries, but do not fix them',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        sqllog = logging.getLogger('sqlalchemy.engine')
+        sqllog.addHandler(logging.StreamHandler())
+        sqllog.setLevel(logging.INFO)
+
+    app = getApplication(args.zope_conf)
+    import transaction
+    from ..sync.answers import checkAnswerSummaries
+
+    drifted = checkAnswerSummaries(rebuild=not args.dry_run)
+    for (lectureId, studentId) in drifted:
+        logger.info("answerSummary for lecture %d / student %d has drifted", lectureId, studentId)
+    if args.dry_run:
+        transaction.abort()
+    else:
+        transaction.commit()
+    logger.info("%d summaries %s", len(drifted), "need rebuilding" if args.dry_run else "rebuilt")
+
+
+def questionCounterFold():
+    parser = argparse.ArgumentParser(description='Add pending answer counts to the question table')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        sqllog = logging.getLogger('sqlalchemy.engine')
+        sqllog.addHandler(logging.StreamHandler())
+        sqllog.setLevel(logging.INFO)
+
+    app = getApplication(args.zope_conf)
+    import transaction
+    from ..sync.questions import foldQuestionCounters
+
+    updated = foldQuestionCounters()
+    transaction.commit()
+    logger.info("%d questions updated", updated)
+
+
+def studentSettingsAssign():
+    parser = argparse.ArgumentParser(description='Choose settings for all students of a lecture, instead of as they sync')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--lecture',
+        action='append',
+        help='Plone path of lecture to assign settings for, default all lectures',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        sqllog = logging.getLogger('sqlalchemy.engine')
+        sqllog.addHandler(logging.StreamHandler())
+        sqllog.setLevel(logging.INFO)
+
+    app = getApplication(args.zope_conf)
+    import transaction
+    from z3c.saconfig import Session
+    from tutorweb.quizdb import db
+    from ..sync.student import assignStudentSettings
+
+    query = Session.query(db.Lecture.lectureId).order_by(db.Lecture.lectureId)
+    if args.lecture:
+        query = query.filter(db.Lecture.plonePath.in_(args.lecture))
+    for (lectureId,) in query.all():
+        dbLec = Session.query(db.Lecture).get(lectureId)
+        count = assignStudentSettings(dbLec)
+        transaction.commit()
+        if count:
+            logger.info("%s: %d settings assigned", dbLec.plonePath, count)
+
+
+def _tableSize(tableName):
+    """Return (rows, bytes) for tableName, or None if the DB can't tell us"""
+    from z3c.saconfig import Session
+
+    if Session().bind.dialect.name != 'mysql':
+        return None
+    return Session.execute(
+        "SELECT table_rows, data_length + index_length"
+        " FROM information_schema.tables"
+        " WHERE table_schema = DATABASE() AND table_name = :tableName",
+        dict(tableName=tableName),
+    ).fetchone()
+
+
+def allocationCompact():
+    parser = argparse.ArgumentParser(description='Delete old inactive allocations')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--grace-days',
+        type=int,
+        default=30,
+        help='Keep allocations deactivated in the last GRACE_DAYS, clients might still have them',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='Rows to delete in each transaction',
+    )
+    parser.add_argument(
+        '--pause',
+        type=float,
+        default=0.5,
+        help='Seconds to wait between each batch',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        sqllog = logging.getLogger('sqlalchemy.engine')
+        sqllog.addHandler(logging.StreamHandler())
+        sqllog.setLevel(logging.INFO)
+
+    app = getApplication(args.zope_conf)
+    import transaction
+    from ..allocation.original import purgeInactiveAllocations
+
+    sizeBefore = _tableSize('allocation')
+    deleted = 0
+    for count in purgeInactiveAllocations(
+            datetime.datetime.utcnow() - datetime.timedelta(days=args.grace_days),
+            batchSize=args.batch_size):
+        transaction.commit()
+        deleted += count
+        logger.debug("%d allocations deleted", deleted)
+        time.sleep(args.pause)
+
+    if sizeBefore and sizeBefore[0]:
+        # NB: table stats aren't updated straight away, so estimate from the size before
+        logger.info("%d allocations deleted, approx %d bytes reclaimed", deleted, deleted * sizeBefore[1] / sizeBefore[0])
+    else:
+        logger.info("%d allocations deleted", deleted)
+
+
+def bundlePurge():
+    parser = argparse.ArgumentParser(description='Delete question bundles no longer in use')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--grace-days',
+        type=int,
+        default=7,
+        help='Keep bundles used in the last GRACE_DAYS, clients might still have them',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+
+    app = getApplication(args.zope_conf)
+    from ..bundle import purgeBundles
+    from ..config import bundle_config
+
+    if not bundle_config.DIR:
+        logger.info("bundle-dir not configured, nothing to do")
+        return
+    deleted = 0
+    for name in purgeBundles(bundle_config.DIR, time.time() - args.grace_days * 24 * 60 * 60):
+        logger.debug("Deleted bundle %s", name)
+        deleted += 1
+    logger.info("%d bundles deleted", deleted)
+
+
+def classAllocationPrewarm():
+    parser = argparse.ArgumentParser(description='Allocate questions for all students in a class, before they first sync')
+    parser.add_argument(
+        '--zope-conf',
+        help='Zope configuration file',
+    )
+    parser.add_argument(
+        '--class',
+        dest='classPath',
+        action='append',
+        required=True,
+        help='Plone path of class to allocate questions for',
+    )
+    parser.add_argument(
+        '--pause',
+        type=float,
+        default=0.1,
+        help='Seconds to wait between each student',
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='Output debug messages',
+    )
+    args = parser.parse_args()
+    if args.debug:
+        sqllog = logging.getLogger('sqlalchemy.engine')
+        sqllog.addHandler(logging.StreamHandler())
+        sqllog.setLevel(logging.INFO)
+
+    app = getApplication(args.zope_conf)
+    import transaction
+    from zope.component.hooks import setSite
+    from ..sync.plone import preallocateClass
+
+    for classPath in args.classPath:
+        classObj = app.unrestrictedTraverse(classPath)
+        # NB: Need the site to resolve the class's lecture relations
+        setSite(classObj.portal_url.getPortalObject())
+
+        students = questions = 0
+        for (dbStudent, count) in preallocateClass(classObj):
+            transaction.commit()
+            students += 1
+            questions += count
+            logger.debug("%s: %d questions allocated to %s", classPath, count, dbStudent.userName)
+            time.sleep(args.pause)
+        logger.info("%s: %d questions allocated to %d students", classPath, questions, students)
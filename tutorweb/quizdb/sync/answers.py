@@ -3,12 +3,11 @@ import datetime
 import json
 import logging
 import random
-import re
 import time
 import urlparse
+import uuid
 
-from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import func, and_
 from sqlalchemy.sql import expression
 
 from zope.publisher.interfaces import NotFound
@@ -21,47 +20,109 @@ from tutorweb.quizdb.allocation.base import Allocation
 logger = logging.getLogger(__package__)
 
 
+def answerSummaryTotals():
+    """Aggregate columns to recreate answerSummary values from the answer table"""
+    return (
+        func.count().label('lecAnswered'),
+        func.ifnull(func.sum(db.Answer.correct), 0).label('lecCorrect'),
+        func.ifnull(func.sum(db.Answer.practice), 0).label('practiceAnswered'),
+        func.ifnull(func.sum(expression.case([(db.Answer.practice & db.Answer.correct, 1)], else_=0)), 0).label('practiceCorrect'),
+        func.max(db.Answer.timeEnd).label('maxTimeEnd'),
+    )
+
+
+def rebuildAnswerSummary(dbAnsSummary, totals):
+    """Update counters in dbAnsSummary to match totals, return True iff anything changed"""
+    changed = False
+    for k in ['lecAnswered', 'lecCorrect', 'practiceAnswered', 'practiceCorrect']:
+        if getattr(dbAnsSummary, k) != int(getattr(totals, k)):
+            setattr(dbAnsSummary, k, int(getattr(totals, k)))
+            changed = True
+    if dbAnsSummary.maxTimeEnd != totals.maxTimeEnd:
+        dbAnsSummary.maxTimeEnd = totals.maxTimeEnd
+        changed = True
+    return changed
+
+
 def getAnswerSummary(lectureId, student):
-    """Fetch answerSummary row for student"""
-    try:
-        dbAnsSummary = (Session.query(db.AnswerSummary)
-            .with_lockmode('update')
-            .filter(db.AnswerSummary.lectureId == lectureId)
-            .filter(db.AnswerSummary.studentId == student.studentId)
-            .one())
-    except NoResultFound:
-        dbAnsSummary = db.AnswerSummary(
+    """
+    Fetch answerSummary row for student, locked until the end of the
+    transaction so concurrent syncs for the same student take turns
+    """
+    query = (Session.query(db.AnswerSummary)
+        .filter(db.AnswerSummary.lectureId == lectureId)
+        .filter(db.AnswerSummary.studentId == student.studentId))
+
+    # NB: Create the row before locking it. SELECT ... FOR UPDATE on a missing row
+    # takes a gap lock, and two syncs both doing that then inserting deadlock
+    created = False
+    if query.count() == 0:
+        Session.execute(db.insertOrSkip(db.AnswerSummary.__table__), dict(
             lectureId=lectureId,
             studentId=student.studentId,
             grade=0,
-        )
-        Session.add(dbAnsSummary)
-
-    # Update based on answer table
-    (
-        dbAnsSummary.lecAnswered,
-        dbAnsSummary.lecCorrect,
-        dbAnsSummary.practiceAnswered,
-        dbAnsSummary.practiceCorrect,
-        maxTimeEnd,
-    ) = Session.query(
-        func.count(),
-        func.ifnull(func.sum(db.Answer.correct), 0),
-        func.ifnull(func.sum(db.Answer.practice), 0),
-        func.ifnull(func.sum(expression.case([(db.Answer.practice & db.Answer.correct, 1)], else_=0)), 0),
-        func.max(db.Answer.timeEnd),
-    ).filter(db.Answer.lectureId == lectureId).filter(db.Answer.studentId == student.studentId).one()
-
-    dbAnsSummary.lecAnswered = int(dbAnsSummary.lecAnswered)
-    dbAnsSummary.lecCorrect = int(dbAnsSummary.lecCorrect)
-    dbAnsSummary.practiceAnswered = int(dbAnsSummary.practiceAnswered)
-    dbAnsSummary.practiceCorrect = int(dbAnsSummary.practiceCorrect)
+            gradeHighWaterMark=0,
+        ))
+        created = True
+    dbAnsSummary = query.with_lockmode('update').populate_existing().one()
+
+    if created:
+        # No summary yet (or it's been lost), so build one from the answer table.
+        # After this it gets updated as answers are added, see parseAnswerQueue
+        rebuildAnswerSummary(dbAnsSummary, Session.query(*answerSummaryTotals())
+            .with_lockmode('read')
+            .filter(db.Answer.lectureId == lectureId)
+            .filter(db.Answer.studentId == student.studentId)
+            .one())
+
+    maxTimeEnd = dbAnsSummary.maxTimeEnd
     if not maxTimeEnd:
         maxTimeEnd = datetime.datetime.utcfromtimestamp(0)
 
     return (dbAnsSummary, maxTimeEnd)
 
 
+def checkAnswerSummaries(rebuild=True, lectureIds=None, studentIds=None):
+    """
+    Compare all answerSummary rows with the answer table, return a list of
+    (lectureId, studentId) for any that have drifted. If rebuild is True,
+    also fix them. If lectureIds / studentIds are given, only check those.
+    """
+    totalsQuery = Session.query(db.Answer.lectureId, db.Answer.studentId, *answerSummaryTotals())
+    summaryFilters = []
+    if lectureIds is not None:
+        totalsQuery = totalsQuery.filter(db.Answer.lectureId.in_(lectureIds))
+        summaryFilters.append(db.AnswerSummary.lectureId.in_(lectureIds))
+    if studentIds is not None:
+        totalsQuery = totalsQuery.filter(db.Answer.studentId.in_(studentIds))
+        summaryFilters.append(db.AnswerSummary.studentId.in_(studentIds))
+    totals = (totalsQuery
+        .group_by(db.Answer.lectureId, db.Answer.studentId)
+        .subquery())
+
+    out = []
+    # NB: Outer join, so summaries whose answers have all gone are compared against zero
+    for row in (Session.query(
+                db.AnswerSummary,
+                func.ifnull(totals.c.lecAnswered, 0).label('lecAnswered'),
+                func.ifnull(totals.c.lecCorrect, 0).label('lecCorrect'),
+                func.ifnull(totals.c.practiceAnswered, 0).label('practiceAnswered'),
+                func.ifnull(totals.c.practiceCorrect, 0).label('practiceCorrect'),
+                totals.c.maxTimeEnd,
+            ).outerjoin(totals, and_(
+                totals.c.lectureId == db.AnswerSummary.lectureId,
+                totals.c.studentId == db.AnswerSummary.studentId,
+            ))
+            .filter(*summaryFilters)
+            .order_by(db.AnswerSummary.lectureId, db.AnswerSummary.studentId)):
+        if not rebuild:
+            Session.expunge(row.AnswerSummary)  # NB: Make sure changes don't get written
+        if rebuildAnswerSummary(row.AnswerSummary, row):
+            out.append((row.AnswerSummary.lectureId, row.AnswerSummary.studentId))
+    Session.flush()
+    return out
+
+
 def getCoinAward(dbLec, student, dbAnsSummary, dbQn, a, settings):
     """How many coins does this earn a student?"""
     def crossedGradeBoundary(boundary):
@@ -95,11 +156,9 @@ def getCoinAward(dbLec, student, dbAnsSummary, dbQn, a, settings):
         out += get_award_setting('lecture_aced', "10000")
 
         # Is every other lecture aced?
-        # TODO: Bit ugly relying on plonePath structure here
         siblingLectures = [x[0] for x in Session.query(db.Lecture.lectureId)
-            .filter(db.Lecture.hostId == dbLec.hostId)
+            .filter(db.Lecture.tutorialId == dbLec.tutorialId)
             .filter(db.Lecture.lectureId != dbLec.lectureId)
-            .filter(db.Lecture.plonePath.startswith(re.sub(r'/[^/]+/?$', '/', dbLec.plonePath)))
             .all()]
 
         if (Session.query(db.AnswerSummary)
@@ -149,9 +208,17 @@ def getCoinAward(dbLec, student, dbAnsSummary, dbQn, a, settings):
     return out
 
 
-def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
+def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}, since=None):
+    """
+    Write answers in rawAnswerQueue to the DB, return the student's answers.
+    If since (an answer_time) is given, only return answers from then on,
+    along with anything written this time around. NB: answer_time is only
+    to the second, so answers at since itself are sent again in case another
+    tab wrote one in the same second. The client should drop any it has.
+    """
     dbLec = alloc.dbLec
     student = alloc.student
+    lectureVersion = int(studentSettings['lecture_version']) if 'lecture_version' in studentSettings else None
 
     # Filter nonsense out of answerQueue
     answerQueue = []
@@ -170,30 +237,55 @@ def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
             a,
         ))
 
-    # Lock answers for this lecture/student, to stop any concurrent updates
+    # Lock the student's summary, so another tab / device syncing the same lecture
+    # waits for us to commit. NB: On intial sync we do lots of lectures at once,
+    # creating the entry for every one is wasted effort, and a cause of deadlocks
+    # as we try to sync whole tutorial, so only bother if there's something to write
+    if len(answerQueue) > 0:
+        (dbAnsSummary, maxTimeEnd) = getAnswerSummary(dbLec.lectureId, student)
+        # NB: Locking reads from here on, a plain read could use a snapshot from before
+        # the other sync committed
+        lockmode = 'read'
+    else:
+        lockmode = None
+
+    # Find answers we already have, so we don't bother with them again. NB: This
+    # could miss some another sync has just written, insertOrSkip below catches those
     answerRows = {}
+    answerTimes = set(datetime.datetime.utcfromtimestamp(a['answer_time']) for (_, _, a) in answerQueue)
     for questionId, timeEnd in (Session.query(db.Answer.questionId, db.Answer.timeEnd)
             .filter(db.Answer.studentId == student.studentId)
             .filter(db.Answer.lectureId == dbLec.lectureId)
-            .with_lockmode('update')):  # NB: FOR UPDATE gets us a fresh view of the data, SELECT doesn't necessarily? Who knows.
+            .filter(db.Answer.timeEnd.in_(answerTimes)) if answerTimes else []):
         answerRows['%d:%d' % (questionId, calendar.timegm(timeEnd.timetuple()))] = True
 
     dbQns = dict(alloc.getQuestions(
         uris=[uri for (uri, _, _) in answerQueue],
-        lockForUpdate=True,
         active=None,  # NB: Might be writing historical answers
     ))
 
-    rowsAdded = 0
+    # Fetch all user-generated questions the queue refers to in one query
+    ugQnGuids = set(
+        uuid.UUID(queryString['question_id'][0])
+        for (questionUri, queryString, a) in answerQueue
+        if 'question_id' in queryString
+        and getattr(dbQns.get(questionUri, None), 'qnType', None) == 'tw_questiontemplate'
+    )
+    ugQns = dict(
+        (ugQn.ugQuestionGuid, ugQn)
+        for ugQn
+        in (Session.query(db.UserGeneratedQuestion)
+            .filter(db.UserGeneratedQuestion.ugQuestionGuid.in_(ugQnGuids))
+            if ugQnGuids else [])
+    )
+
+    # Validate the entire queue, working out what rows need to be written
+    validQueue = []
+    ugQnRows = []
+    ugQnSuperseded = []
+    ugAnsRows = []
+    ugAnsStudentAnswers = []
     for (questionUri, queryString, a) in answerQueue:
-        # We have work to do, so get/create the summary
-        # NB: On intial sync we do lots of lectures at once, creating the entry at this
-        # point is wasted effort, and a cause of deadlocks as we try to sync whole tutorial
-        try:
-            dbAnsSummary
-        except NameError:
-            (dbAnsSummary, maxTimeEnd) = getAnswerSummary(dbLec.lectureId, student)
-
         # Fetch question for allocation
         dbQn = dbQns.get(questionUri, None)
         if dbQn is None:
@@ -220,60 +312,58 @@ def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
                 continue
 
             # Find matching ugQn, to make sure there is such a thing
-            try:
-                ugQn = (Session.query(db.UserGeneratedQuestion)
-                    .filter(db.UserGeneratedQuestion.questionId == dbQn.questionId)
-                    .filter(db.UserGeneratedQuestion.ugQuestionGuid == queryString['question_id'][0])
-                    .one())
-            except NoResultFound:
+            ugQn = ugQns.get(uuid.UUID(queryString['question_id'][0]), None)
+            if ugQn is None or ugQn.questionId != dbQn.questionId:
                 raise ValueError("Cannot find matching question for %s" % queryString['question_id'][0])
-            ugAns = db.UserGeneratedAnswer(
-                    studentId=student.studentId,
-                    ugQuestionGuid=ugQn.ugQuestionGuid,
-                    chosenAnswer=a['student_answer'].get('choice', None),
-                    questionRating=a['student_answer'].get('rating', None),
-                    comments=a['student_answer'].get('comments', ""),
-                    studentGrade=a.get('grade_after', None),
-            )
-            Session.add(ugAns)
-            Session.flush()
+            ugAnsRows.append(dict(
+                studentId=student.studentId,
+                ugQuestionGuid=ugQn.ugQuestionGuid,
+                chosenAnswer=a['student_answer'].get('choice', None),
+                questionRating=a['student_answer'].get('rating', None),
+                comments=a['student_answer'].get('comments', ""),
+                studentGrade=a.get('grade_after', None),
+            ))
 
-            # Store GUID of question reviewed
+            # Store GUID of question reviewed, ID of answer gets filled in once written
             a['student_answer'] = dict(
-                uganswer_id=ugAns.ugAnswerId,
+                uganswer_id=None,
                 question_id=ugQn.ugQuestionGuid,
             )
+            ugAnsStudentAnswers.append(a['student_answer'])
 
         elif dbQn.qnType == 'tw_questiontemplate':
             if a.get('student_answer', None) and a['student_answer'].get('text', None):
                 # Write question to database
-                ugQn = db.UserGeneratedQuestion(
+                ugQnRow = dict(
+                    ugQuestionGuid=uuid.uuid4(),
                     studentId=student.studentId,
                     questionId=dbQn.questionId,
                     text=a['student_answer']['text'],
                     explanation=a['student_answer']['explanation'],
+                    superseded=None,
                 )
+                for i in range(0, 10):
+                    # NB: executemany needs the same keys in every row
+                    ugQnRow['choice_%d_answer' % i] = None
+                    ugQnRow['choice_%d_correct' % i] = None
                 for i, c in enumerate(a['student_answer']['choices']):
-                    setattr(ugQn, 'choice_%d_answer' % i, c['answer'])
-                    setattr(ugQn, 'choice_%d_correct' % i, c['correct'])
-                Session.add(ugQn)
+                    ugQnRow['choice_%d_answer' % i] = c['answer']
+                    ugQnRow['choice_%d_correct' % i] = c['correct']
+                ugQnRows.append(ugQnRow)
 
                 # student_answer should contain the ID of our answer
-                Session.flush()
-                a['student_answer'] = dict(question_id=ugQn.ugQuestionGuid)
+                a['student_answer'] = dict(question_id=ugQnRow['ugQuestionGuid'])
 
                 # If this replaces an old question, note this in DB
                 if 'question_id' in queryString:
-                    dbUgQn = (Session.query(db.UserGeneratedQuestion)
-                        .filter(db.UserGeneratedQuestion.ugQuestionGuid == queryString['question_id'][0])
-                        .one())
+                    dbUgQn = ugQns.get(uuid.UUID(queryString['question_id'][0]), None)
+                    if dbUgQn is None or dbUgQn.questionId != dbQn.questionId or dbUgQn.studentId != student.studentId:
+                        raise ValueError("Cannot find matching question for %s" % queryString['question_id'][0])
                     a['correct'] = None # NB: Can't award yourself infinite corrects
-                    (Session.query(db.UserGeneratedQuestion)
-                        .filter(db.UserGeneratedQuestion.ugQuestionId == dbUgQn.ugQuestionId)
-                        .filter(db.UserGeneratedQuestion.questionId == dbQn.questionId)
-                        .filter(db.UserGeneratedQuestion.studentId == student.studentId)
-                        .one()).superseded = ugQn.ugQuestionGuid
-                    Session.flush()
+                    ugQnSuperseded.append(dict(
+                        oldUgQuestionId=dbUgQn.ugQuestionId,
+                        newUgQuestionGuid=ugQnRow['ugQuestionGuid'],
+                    ))
                 else:
                     a['correct'] = True
 
@@ -295,11 +385,52 @@ def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
                 continue
             else:
                 a['correct'] = a['student_answer'] in json.loads(dbQn.correctChoices)
-                if a['correct']:
-                    dbQn.timesCorrect += 1
-            dbQn.timesAnswered += 1  # NB: Do this once we know question is valid
+
+        validQueue.append((dbQn, a))
+
+    # Write any user-generated questions / reviews first, answers refer to them
+    Session.flush()
+    if ugQnRows:
+        Session.execute(db.UserGeneratedQuestion.__table__.insert(), ugQnRows)
+    if ugQnSuperseded:
+        ugQnTable = db.UserGeneratedQuestion.__table__
+        Session.execute(
+            ugQnTable.update()
+                .where(ugQnTable.c.ugQuestionId == expression.bindparam('oldUgQuestionId'))
+                .values(superseded=expression.bindparam('newUgQuestionGuid')),
+            ugQnSuperseded,
+        )
+        for ugQn in ugQns.values():
+            Session.expire(ugQn, ['superseded'])
+    if ugAnsRows:
+        Session.execute(db.UserGeneratedAnswer.__table__.insert(), ugAnsRows)
+        # NB: We hold the summary lock, so the newest of the student's reviews of these
+        # questions are the ones we just wrote, in order. There may be several per question
+        newUgAns = (Session.query(db.UserGeneratedAnswer.ugAnswerId, db.UserGeneratedAnswer.ugQuestionGuid)
+            .filter(db.UserGeneratedAnswer.studentId == student.studentId)
+            .filter(db.UserGeneratedAnswer.ugQuestionGuid.in_(set(r['ugQuestionGuid'] for r in ugAnsRows)))
+            .order_by(db.UserGeneratedAnswer.ugAnswerId.desc())
+            .limit(len(ugAnsRows))
+            .all())
+        for (studentAnswer, (ugAnswerId, ugQuestionGuid)) in zip(ugAnsStudentAnswers, reversed(newUgAns)):
+            if ugQuestionGuid != studentAnswer['question_id']:
+                raise ValueError("Review of %s written concurrently, try again" % studentAnswer['question_id'])
+            studentAnswer['uganswer_id'] = ugAnswerId
+
+    # Work through the queue in order, updating summary and awarding coins
+    newAnswerRows = []
+    qnCounts = {}
+    for (dbQn, a) in validQueue:
+        if dbQn.qnType != 'tw_questiontemplate':
+            # NB: Question counts are only relevant to tw_latexquestions
+            if dbQn.questionId not in qnCounts:
+                qnCounts[dbQn.questionId] = dict(questionId=dbQn.questionId, answered=0, correct=0)
+            qnCounts[dbQn.questionId]['answered'] += 1
+            if a['correct']:
+                qnCounts[dbQn.questionId]['correct'] += 1
 
         # Update student summary rows
+        # NB: These are running totals, checkAnswerSummaries will rebuild them if they drift
         dbAnsSummary.lecAnswered += 1  # NB: Including practice questions is intentional
         if a.get('correct', None):
             dbAnsSummary.lecCorrect += 1
@@ -320,32 +451,79 @@ def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
             if a['grade_after'] > dbAnsSummary.gradeHighWaterMark:
                 dbAnsSummary.gradeHighWaterMark = a['grade_after']
 
-        # Update database with this answer
-        Session.add(db.Answer(
+        timeEnd = datetime.datetime.utcfromtimestamp(a['answer_time'])
+        if dbAnsSummary.maxTimeEnd is None or timeEnd > dbAnsSummary.maxTimeEnd:
+            dbAnsSummary.maxTimeEnd = timeEnd
+
+        newAnswerRows.append(dict(
             lectureId=dbLec.lectureId,
-            lectureVersion=int(studentSettings['lecture_version']) if 'lecture_version' in studentSettings else None,
+            lectureVersion=lectureVersion,
             studentId=student.studentId,
             questionId=dbQn.questionId,
             chosenAnswer=-1 if isinstance(a['student_answer'], dict) else a['student_answer'],
             correct=a.get('correct', None),
             grade=a.get('grade_after', None),
             timeStart=datetime.datetime.utcfromtimestamp(a['quiz_time']),
-            timeEnd=datetime.datetime.utcfromtimestamp(a['answer_time']),
+            timeEnd=timeEnd,
             practice=a.get('practice', False),
             coinsAwarded=coinsAwarded,
             ugQuestionGuid=a['student_answer'].get('question_id', None) if isinstance(a['student_answer'], dict) else None,
         ))
-        rowsAdded += 1
         a['synced'] = True
     Session.flush()
 
+    # Write all answers & question counts in one go
+    rowsAdded = len(newAnswerRows)
+    if newAnswerRows:
+        # NB: Rows we insert get an answerId above anything there now
+        maxAnswerId = Session.query(func.max(db.Answer.answerId)).scalar() or 0
+        Session.execute(db.insertOrSkip(db.Answer.__table__), newAnswerRows)
+
+        # Find out which rows were skipped. NB: Can't use rowcount, MySQL counts those too
+        written = set(
+            '%d:%d' % (questionId, calendar.timegm(timeEnd.timetuple()))
+            for (questionId, timeEnd) in (Session.query(db.Answer.questionId, db.Answer.timeEnd)
+                .filter(db.Answer.studentId == student.studentId)
+                .filter(db.Answer.lectureId == dbLec.lectureId)
+                .filter(db.Answer.answerId > maxAnswerId))
+        )
+        skippedRows = [
+            r for r in newAnswerRows
+            if '%d:%d' % (r['questionId'], calendar.timegm(r['timeEnd'].timetuple())) not in written
+        ]
+        if skippedRows:
+            # Something else got some in first, so our running totals are wrong
+            logger.warn("%d answers for student %s already written, rebuilding summary" % (
+                len(skippedRows),
+                student.userName,
+            ))
+            rowsAdded -= len(skippedRows)
+            for r in skippedRows:
+                if r['questionId'] in qnCounts:
+                    qnCounts[r['questionId']]['answered'] -= 1
+                    if r['correct']:
+                        qnCounts[r['questionId']]['correct'] -= 1
+            qnCounts = dict((k, v) for (k, v) in qnCounts.items() if v['answered'] > 0)
+            rebuildAnswerSummary(dbAnsSummary, Session.query(*answerSummaryTotals())
+                .with_lockmode(lockmode)
+                .filter(db.Answer.lectureId == dbLec.lectureId)
+                .filter(db.Answer.studentId == student.studentId)
+                .one())
+    if qnCounts:
+        # NB: Appended to questionCounter, not question, so we don't contend on popular
+        # questions. foldQuestionCounters adds them to the question table later
+        Session.execute(db.QuestionCounter.__table__.insert(), qnCounts.values())
+
     # Get all previous real answers and send them back.
-    dbAnswers = (Session.query(db.Answer)
+    query = (Session.query(db.Answer)
+        .with_lockmode(lockmode)
         .filter(db.Answer.lectureId == dbLec.lectureId)
-        .filter(db.Answer.studentId == student.studentId)
-        .order_by(db.Answer.timeEnd.desc())
-        .with_lockmode('update')  # NB: Use FOR UPDATE, as otherwise we might get the table state at the start of the transaction
-        .all())
+        .filter(db.Answer.studentId == student.studentId))
+    if since is not None:
+        # Client only wants answers it hasn't seen, including what we just wrote
+        since = min([since] + [calendar.timegm(r['timeEnd'].timetuple()) for r in newAnswerRows])
+        query = query.filter(db.Answer.timeEnd >= datetime.datetime.utcfromtimestamp(since))
+    dbAnswers = query.order_by(db.Answer.timeEnd.desc(), db.Answer.answerId.desc()).all()
     out = [dict(  # NB: Not fully recreating what JS creates, but shouldn't be a problem
         correct=dbAns.correct,
         quiz_time=calendar.timegm(dbAns.timeStart.timetuple()),
@@ -358,10 +536,56 @@ def parseAnswerQueue(alloc, rawAnswerQueue, settings, studentSettings={}):
         synced=True,
     ) for dbAns in reversed(dbAnswers)]
 
-    if len(out) > 8:
+    if since is None:
+        answerCount = len(out)
+        lastGrade = out[-1].get('grade_after', None) if len(out) > 0 else None
+    else:
+        # Not got all the answers, so count & latest grade come from elsewhere
+        answerCount = (Session.query(db.AnswerSummary.lecAnswered)
+            .with_lockmode(lockmode)
+            .filter(db.AnswerSummary.lectureId == dbLec.lectureId)
+            .filter(db.AnswerSummary.studentId == student.studentId)
+            .scalar()) or 0
+        if len(out) > 0:
+            lastGrade = out[-1].get('grade_after', None)
+        else:
+            lastGrade = (Session.query(db.Answer.grade)
+                .with_lockmode(lockmode)
+                .filter(db.Answer.lectureId == dbLec.lectureId)
+                .filter(db.Answer.studentId == student.studentId)
+                .order_by(db.Answer.timeEnd.desc())
+                .limit(1)
+                .scalar())
+
+    if answerCount > 8:
         # Configure a target difficulty
-        alloc.targetDifficulty = out[-1].get('grade_after', None)
+        alloc.targetDifficulty = lastGrade
         # If we've crossed over to the next 10, allocate some different questions
-        alloc.reAllocQuestions= len(out) // 10 > (len(out) - rowsAdded) // 10
+        alloc.reAllocQuestions= answerCount // 10 > (answerCount - rowsAdded) // 10
 
     return out
+
+
+def getAnswerQueueSummary(dbLec, student):
+    """Summary of the student's answers, for clients not receiving the full answerQueue"""
+    dbAnsSummary = (Session.query(db.AnswerSummary)
+        .filter(db.AnswerSummary.lectureId == dbLec.lectureId)
+        .filter(db.AnswerSummary.studentId == student.studentId)
+        .first())
+    if dbAnsSummary is None:
+        return dict(
+            answered=0,
+            correct=0,
+            practice_answered=0,
+            practice_correct=0,
+            grade=0,
+            last_answer_time=None,
+        )
+    return dict(
+        answered=dbAnsSummary.lecAnswered,
+        correct=dbAnsSummary.lecCorrect,
+        practice_answered=dbAnsSummary.practiceAnswered,
+        practice_correct=dbAnsSummary.practiceCorrect,
+        grade=dbAnsSummary.grade,
+        last_answer_time=calendar.timegm(dbAnsSummary.maxTimeEnd.timetuple()) if dbAnsSummary.maxTimeEnd else None,
+    )
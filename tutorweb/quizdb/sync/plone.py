@@ -10,7 +10,13 @@ from z3c.saconfig import Session
 
 from tutorweb.content.schema import IQuestion
 from tutorweb.quizdb import db
-from tutorweb.quizdb.utils import getDbHost, getDbStudent
+from tutorweb.quizdb.allocation.base import Allocation
+from tutorweb.quizdb.allocation.original import clearQuestionPoolCache
+from tutorweb.quizdb.bundle import bundlePortalUrls
+from tutorweb.quizdb.config import bundle_config
+from tutorweb.quizdb.utils import getDbHost, getDbLecture, getDbStudent, getDbTutorial
+from tutorweb.quizdb.sync.questions import cacheQuestionData, isQuestionDataCached
+from tutorweb.quizdb.sync.student import clearLectureSettingsCache, getStudentSettingsBatch, updateStudentRegistered
 
 def syncClassSubscriptions(classObj):
     """
@@ -18,8 +24,10 @@ def syncClassSubscriptions(classObj):
     """
     ploneClassPath = '/'.join(classObj.getPhysicalPath())
 
+    studentIds = []
     for s in (classObj.students or []):
         dbStudent = getDbStudent(s)
+        studentIds.append(dbStudent.studentId)
 
         try:
             dbSub = (Session.query(db.Subscription)
@@ -32,16 +40,57 @@ def syncClassSubscriptions(classObj):
                 plonePath=ploneClassPath,
             ))
         Session.flush()
+    updateStudentRegistered(studentIds)
 
 
 def removeClassSubscriptions(ploneClassPath):
     """
     Remove any subscriptions for the class we're removing
     """
+    studentIds = [studentId for (studentId,) in (Session.query(db.Subscription.studentId)
+                  .filter_by(plonePath=ploneClassPath))]
     dbSub = (Session.query(db.Subscription)
              .filter_by(plonePath=ploneClassPath)
              .delete())
     Session.flush()
+    updateStudentRegistered(studentIds)
+
+
+def preallocateClass(classObj):
+    """
+    Allocate questions for every student in the class, for all the class's
+    lectures, so their first sync doesn't have to. Yields (dbStudent, number
+    of questions newly allocated) after each student is done
+    """
+    dbLecs = []
+    for r in (classObj.lectures or []):
+        lecObj = r.to_object
+        if lecObj is None:
+            continue
+        try:
+            dbLecs.append(getDbLecture('/'.join(lecObj.getPhysicalPath())))
+        except ValueError:
+            # Lecture not published, nothing to allocate yet
+            continue
+    if not dbLecs:
+        return
+
+    for s in (classObj.students or []):
+        dbStudent = getDbStudent(s)
+        allSettings = getStudentSettingsBatch(dbLecs, dbStudent)
+        count = 0
+        for dbLec in dbLecs:
+            settings = allSettings[dbLec.lectureId]
+            allocObj = Allocation.allocFor(
+                student=dbStudent,
+                dbLec=dbLec,
+                settings=settings,
+            )
+            for _ in allocObj.updateAllocation(settings):
+                pass
+            count += allocObj.questionsAllocated
+        Session.flush()
+        yield (dbStudent, count)
 
 
 def syncPloneLecture(lectureObj):
@@ -90,6 +139,9 @@ def syncPloneLecture(lectureObj):
         )
         Session.add(dbLec)
         Session.flush()
+    if dbLec.tutorialId is None:
+        dbLec.tutorialId = getDbTutorial(dbHost.hostId, plonePath).tutorialId
+        Session.flush()
 
     # Fetch current settings object
     globalSettings = lectureObj.unrestrictedTraverse('@@drill-settings').asDict()
@@ -108,6 +160,7 @@ def syncPloneLecture(lectureObj):
                 **values)
             Session.add(dbLgs)
         Session.flush()
+        clearLectureSettingsCache(dbLec.lectureId)
 
     return dbLec
 
@@ -141,6 +194,8 @@ def _ploneQuestionDict(listing):
                 ploneQns['%s?question_id=%s' % (objPath, id)] = dict(
                     qnType='tw_latexquestion',
                     lastUpdate=_toUTCDateTime(l['modified']),
+                    data=data,
+                    querystring=dict(question_id=[str(id)]),
                     correctChoices=[i for (i, x) in enumerate(qn['choices']) if x['correct']],
                     incorrectChoices=[i for (i, x) in enumerate(qn['choices']) if not x['correct']],
                     timesAnswered=qn.get('timesanswered', 0),
@@ -157,6 +212,7 @@ def _ploneQuestionDict(listing):
             ploneQns[objPath] = dict(
                 qnType=l['portal_type'],
                 lastUpdate=_toUTCDateTime(l['modified']),
+                data=data,
                 correctChoices=[i for i, a in enumerate(allChoices) if a['correct']],
                 incorrectChoices=[i for i, a in enumerate(allChoices) if not a['correct']],
                 timesAnswered=getattr(obj, 'timesanswered', 0),
@@ -177,6 +233,7 @@ def syncPloneQuestions(dbLec, lectureObj):
 
     # Sort questions into a dict by path
     ploneQns = _ploneQuestionDict(listing)
+    allQns = dict(ploneQns)
 
     # Get all questions currently in the database
     for dbQn in (Session.query(db.Question).filter(db.Question.lectures.contains(dbLec))):
@@ -222,6 +279,24 @@ def syncPloneQuestions(dbLec, lectureObj):
                 lectures=[dbLec],
             ))
 
+    # Render new / edited questions now, so students don't have to.
+    # NB: Re-render anything edited in the last few seconds too, edits within
+    # the same second have the same lastUpdate
+    portalUrl = lectureObj.portal_url()
+    recent = datetime.datetime.utcnow() - datetime.timedelta(seconds=5)
+    for (path, qn) in allQns.iteritems():
+        if qn['lastUpdate'] < recent and isQuestionDataCached(path, qn['lastUpdate']):
+            continue
+        cacheQuestionData(portalUrl, path, qn['lastUpdate'], qn['data'].asDict(qn.get('querystring', {})))
+
     dbLec.lastUpdate = datetime.datetime.utcnow()
     Session.flush()
+    clearQuestionPoolCache(dbLec.lectureId)
+
+    if bundle_config.DIR:
+        # Write out bundles of new questions for the hostnames students use, so they don't have to
+        # NB: Rebuild, lastUpdate might not have changed if edited within the same second
+        view = lectureObj.unrestrictedTraverse('@@quizdb-all-questions')
+        for portalUrl in bundlePortalUrls():
+            view.questionBundle(dbLec, portalUrl=portalUrl, rebuild=True)
     return True
@@ -1,11 +1,54 @@
+import json
 import logging
 import pytz
 
+from sqlalchemy import func
+from sqlalchemy.sql import expression
+
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
 from tutorweb.quizdb.allocation.base import Allocation
+from tutorweb.quizdb.allocation.original import clearQuestionPoolCache
+from tutorweb.quizdb.utils import LRUCache
 
 # logging.getLogger('sqlalchemy.engine').setLevel(logging.DEBUG)
 logger = logging.getLogger(__package__)
 
+# Serialised question @@data, by (plonePath, lastUpdate)
+_questionDataCache = LRUCache(5000)
+
+# Stands in for the portal URL in cached data. NB: Can't appear in JSON output
+PORTAL_URL_MARKER = '\x00portal_url\x00'
+
+
+def clearQuestionDataCache():
+    _questionDataCache.clear()
+
+
+def _jsonString(s):
+    """s as it would appear inside a JSON string"""
+    return json.dumps(s)[1:-1]
+
+
+def cacheQuestionData(portalUrl, plonePath, lastUpdate, data):
+    """
+    Store @@data dict for question at plonePath (including any querystring),
+    as it was at lastUpdate. URLs in data are relative to portalUrl, and get
+    rewritten to whichever portal URL fetches them again.
+    """
+    _questionDataCache[(plonePath, lastUpdate)] = json.dumps(data).replace(_jsonString(portalUrl), PORTAL_URL_MARKER)
+
+
+def isQuestionDataCached(plonePath, lastUpdate):
+    return (plonePath, lastUpdate) in _questionDataCache
+
+
+def getCachedQuestionData(portalUrl, plonePath, lastUpdate):
+    """Return a copy of previously cached @@data dict, with URLs under portalUrl, or None"""
+    data = _questionDataCache.get((plonePath, lastUpdate))
+    return None if data is None else json.loads(data.replace(PORTAL_URL_MARKER, _jsonString(portalUrl)))
+
 
 def getQuestionAllocation(alloc, settings):
     # Return all active questions
@@ -17,3 +60,50 @@ def getQuestionAllocation(alloc, settings):
             correct=dbQn.timesCorrect,
             online_only=dbQn.onlineOnly,
         )
+
+
+def foldQuestionCounters():
+    """
+    Add questionCounter rows into question.timesAnswered / timesCorrect,
+    return the number of questions updated. Should only be run from one
+    place at a time, e.g. cron
+    """
+    Session.flush()
+    maxId = Session.query(func.max(db.QuestionCounter.questionCounterId)).scalar()
+    if maxId is None:
+        return 0
+
+    qcTable = db.QuestionCounter.__table__
+    # NB: Lock the rows we sum. A sync that took an ID below maxId but hasn't
+    # committed yet is waited for, rather than deleted below without being counted
+    totals = (Session.query(
+            db.QuestionCounter.questionId,
+            func.sum(db.QuestionCounter.answered),
+            func.sum(db.QuestionCounter.correct),
+        )
+        .with_lockmode('update')
+        .filter(db.QuestionCounter.questionCounterId <= maxId)
+        .group_by(db.QuestionCounter.questionId)
+        .all())
+    if totals:
+        qnTable = db.Question.__table__
+        Session.execute(
+            qnTable.update()
+                .where(qnTable.c.questionId == expression.bindparam('qnId'))
+                .values(
+                    timesAnswered=qnTable.c.timesAnswered + expression.bindparam('answered'),
+                    timesCorrect=qnTable.c.timesCorrect + expression.bindparam('correct'),
+                ),
+            [dict(qnId=qnId, answered=int(answered), correct=int(correct)) for (qnId, answered, correct) in totals],
+        )
+    Session.execute(qcTable.delete().where(qcTable.c.questionCounterId <= maxId))
+
+    # Any questions we have loaded are now out of date
+    for obj in Session.identity_map.values():
+        if isinstance(obj, db.Question):
+            Session.expire(obj, ['timesAnswered', 'timesCorrect'])
+    if totals:
+        # Questions may have changed difficulty band.
+        # NB: Only clears pools in this process, everyone else's expire after QUESTION_POOL_MAX_AGE
+        clearQuestionPoolCache()
+    return len(totals)
@@ -4,11 +4,12 @@ try:
     import numpy.random
 except ImportError:
     # Some of the older EiaS NUCs don't have numpy installed
-    pass
+    numpy = None
 
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, or_
 from sqlalchemy.orm.exc import NoResultFound
 
+import transaction
 from z3c.saconfig import Session
 
 from tutorweb.quizdb import db
@@ -36,19 +37,29 @@ SERVERSIDE_SETTINGS = [
 ]
 
 
-def _chooseSettingValue(lgs):
-    """Return a new value according to restrictions in the lgs object"""
+def _chooseSettingValues(lgs, count):
+    """Return count new values according to restrictions in the lgs object, or None"""
     if lgs.key in STRING_SETTINGS and (lgs.shape is not None or lgs.max is not None):
         raise ValueError("Cannot choose random value for setting %s" % lgs.key)
 
     if lgs.shape is not None:
-        # Fetch value according to a gamma function
+        # Fetch values according to a gamma function, redrawing any out of bounds
+        out = [None] * count
+        todo = range(count)
         for i in xrange(10):
-            out = numpy.random.gamma(shape=float(lgs.shape), scale=float(lgs.value))
-            if lgs.max is None or (lgs.min or 0) <= out < lgs.max:
-                if lgs.key in INTEGER_SETTINGS:
-                    out = int(round(out))
-                return str(out)
+            if numpy is not None:
+                draws = numpy.random.gamma(shape=float(lgs.shape), scale=float(lgs.value), size=len(todo))
+            else:
+                draws = [random.gammavariate(float(lgs.shape), float(lgs.value)) for x in todo]
+            rejected = []
+            for (x, draw) in zip(todo, draws):
+                if lgs.max is None or (lgs.min or 0) <= draw < lgs.max:
+                    out[x] = str(int(round(draw)) if lgs.key in INTEGER_SETTINGS else float(draw))
+                else:
+                    rejected.append(x)
+            todo = rejected
+            if not todo:
+                return out
         raise ValueError("Cannot pick value that satisfies shape %f / value %f / min %f / max %f" % (
             lgs.shape,
             lgs.value,
@@ -58,19 +69,46 @@ def _chooseSettingValue(lgs):
 
     if lgs.max is not None:
         # Uniform random choice
-        out = random.uniform(lgs.min or 0, lgs.max)
-        if lgs.key in INTEGER_SETTINGS:
-            out = int(round(out))
-        return str(out)
+        if numpy is not None:
+            draws = numpy.random.uniform(lgs.min or 0, lgs.max, size=count)
+        else:
+            draws = [random.uniform(lgs.min or 0, lgs.max) for x in xrange(count)]
+        return [str(int(round(draw)) if lgs.key in INTEGER_SETTINGS else float(draw)) for draw in draws]
 
     if lgs.variant and lgs.value is not None:
         # We should explicitly note the variant being used
-        return lgs.value
+        return [lgs.value] * count
 
     # Nothing to choose, use default value
     return None
 
 
+def _chooseSettingValue(lgs):
+    """Return a new value according to restrictions in the lgs object"""
+    out = _chooseSettingValues(lgs, 1)
+    return None if out is None else out[0]
+
+
+def _registeredSubscriptions():
+    """Query for studentIds of subscriptions to a class"""
+    return (Session.query(db.Subscription.studentId)
+        .filter_by(hidden=False)
+        .filter(db.Subscription.plonePath.like('/%/schools-and-classes/%')))
+
+
+def updateStudentRegistered(studentIds):
+    """Recalculate Student.registered for studentIds, after their subscriptions change"""
+    studentIds = list(studentIds)
+    if not studentIds:
+        return
+    registered = set(studentId for (studentId,) in (_registeredSubscriptions()
+        .filter(db.Subscription.studentId.in_(studentIds))
+        .distinct()))
+    for dbStudent in Session.query(db.Student).filter(db.Student.studentId.in_(studentIds)):
+        dbStudent.registered = dbStudent.studentId in registered
+    Session.flush()
+
+
 def _variantApplicable(variant, dbStudent):
     """Is this variant applicable to this student?"""
     if not variant:
@@ -78,81 +116,298 @@ def _variantApplicable(variant, dbStudent):
 
     if variant == "registered":
         # Is the student subscribed to a course?
-        return bool(Session.query(db.Subscription)
-                       .filter_by(student=dbStudent)
-                       .filter_by(hidden=False)
-                       .filter(db.Subscription.plonePath.like('/%/schools-and-classes/%'))
-                       .first())
+        return bool(dbStudent.registered)
 
     raise ValueError("Unknown variant %s" % variant)
 
 
-def getStudentSettings(dbLec, dbStudent):
-    """Fetch settings for this lecture, customised for the student"""
-    latestLectureVersion = (Session.query(func.max(db.LectureGlobalSetting.lectureVersion))
-                            .filter_by(lectureId=dbLec.lectureId)
-                           ).one()[0]
+def _variantApplicableStudents(variant, studentIds):
+    """Return the subset of studentIds this variant is applicable to"""
+    if not variant:
+        return set(studentIds)
 
-    # Copy any existing student-specific settings in first
+    if variant == "registered":
+        # Which students are subscribed to a course?
+        return set(studentId for (studentId,) in (Session.query(db.Student.studentId)
+                       .filter(db.Student.studentId.in_(studentIds))
+                       .filter(db.Student.registered == True)))
+
+    raise ValueError("Unknown variant %s" % variant)
+
+
+# Global settings for each lecture, keyed by (lectureId, currentVersion)
+_lectureSettingsCache = {}
+
+
+def clearLectureSettingsCache(lectureId=None):
+    """Forget cached global settings for lectureId, or all lectures"""
+    for k in _lectureSettingsCache.keys():
+        if lectureId is None or k[0] == lectureId:
+            _lectureSettingsCache.pop(k, None)
+
+
+def getLectureSettings(dbLecs):
+    """
+    Return dict of lectureId -> (lectureVersion, global settings) for the
+    latest version of each lecture. Settings are detached copies of
+    LectureGlobalSetting, variants first.
+    """
     out = {}
-    for lss in (Session.query(db.LectureStudentSetting)
-                .filter_by(lectureId=dbLec.lectureId)
-                .filter_by(lectureVersion=latestLectureVersion)
-                .filter_by(student=dbStudent)
-               ):
-        out[lss.key] = lss.value
+    missing = []
+    for dbLec in dbLecs:
+        cacheKey = (dbLec.lectureId, dbLec.currentVersion)
+        if cacheKey in _lectureSettingsCache:
+            out[dbLec.lectureId] = _lectureSettingsCache[cacheKey]
+        else:
+            missing.append(dbLec)
+    if not missing:
+        return out
 
-    # Check all global settings for the lecture
-    variants_applicable = {}
+    # Fetch latest settings for every lecture we don't have yet
+    latest = (Session.query(
+            db.LectureGlobalSetting.lectureId,
+            func.max(db.LectureGlobalSetting.lectureVersion).label('lectureVersion'),
+        )
+        .filter(db.LectureGlobalSetting.lectureId.in_([dbLec.lectureId for dbLec in missing]))
+        .group_by(db.LectureGlobalSetting.lectureId)
+        .subquery())
+    cols = [c.key for c in db.LectureGlobalSetting.__table__.columns]
+    lgsByLecture = dict((dbLec.lectureId, (None, [])) for dbLec in missing)
     for lgs in (Session.query(db.LectureGlobalSetting)
-                .filter_by(lectureId=dbLec.lectureId)
-                .filter_by(lectureVersion=latestLectureVersion)
+                .join(latest, and_(
+                    db.LectureGlobalSetting.lectureId == latest.c.lectureId,
+                    db.LectureGlobalSetting.lectureVersion == latest.c.lectureVersion))
                 .order_by(db.LectureGlobalSetting.key, db.LectureGlobalSetting.variant.desc())  # i.e we want variants first.
                ):
-        # If this setting variant isn't applicable to the student, ignore it.
-        if lgs.variant not in variants_applicable:
-            variants_applicable[lgs.variant] = _variantApplicable(lgs.variant, dbStudent)
-        if not variants_applicable[lgs.variant]:
-            continue
+        lgsByLecture[lgs.lectureId] = (lgs.lectureVersion, lgsByLecture[lgs.lectureId][1])
+        lgsByLecture[lgs.lectureId][1].append(db.LectureGlobalSetting(**dict((c, getattr(lgs, c)) for c in cols)))
 
-        if lgs.key in out:
-            # Already have a current student-overriden setting, ignore this one
-            # NB: This includes the case when a variant has overriden the general case
-            continue
+    for dbLec in missing:
+        (lectureVersion, lgsList) = lgsByLecture[dbLec.lectureId]
+        out[dbLec.lectureId] = (lectureVersion, tuple(lgsList))
 
-        # Find any previous setting, if it was created with the same values copy it
-        old_set = (Session.query(db.LectureGlobalSetting, db.LectureStudentSetting)
+    # NB: Only cache once committed, we might have read settings this transaction
+    # is writing, and an abort would leave us with settings for a version that never was
+    transaction.get().addAfterCommitHook(_fillLectureSettingsCache, args=([
+        ((dbLec.lectureId, dbLec.currentVersion), out[dbLec.lectureId])
+        for dbLec in missing
+    ],))
+    return out
+
+
+def _fillLectureSettingsCache(success, entries):
+    """After-commit hook: Store (cacheKey, settings) entries"""
+    if not success:
+        return
+    for (cacheKey, settings) in entries:
+        # Anything cached for older versions isn't needed any more
+        clearLectureSettingsCache(cacheKey[0])
+        _lectureSettingsCache[cacheKey] = settings
+
+
+def getStudentSettingsBatch(dbLecs, dbStudent):
+    """
+    Fetch settings for several lectures, customised for the student. Returns
+    dict of lectureId -> settings, using the same number of queries however
+    many lectures there are
+    """
+    lecSettings = getLectureSettings(dbLecs)
+    variants_applicable = {}
+    out = dict((dbLec.lectureId, {}) for dbLec in dbLecs)
+
+    # Copy any existing student-specific settings in first
+    versionFilters = [
+        and_(db.LectureStudentSetting.lectureId == lectureId, db.LectureStudentSetting.lectureVersion == lectureVersion)
+        for (lectureId, (lectureVersion, _)) in lecSettings.items()
+        if lectureVersion is not None
+    ]
+    if versionFilters:
+        for lss in (Session.query(db.LectureStudentSetting)
+                    .filter(db.LectureStudentSetting.studentId == dbStudent.studentId)
+                    .filter(or_(*versionFilters))
+                   ):
+            out[lss.lectureId][lss.key] = lss.value
+
+    # Check all global settings for the lecture, find ones the student doesn't have yet
+    pending = []
+    for dbLec in dbLecs:
+        chosen = set(out[dbLec.lectureId].keys())
+        for lgs in lecSettings[dbLec.lectureId][1]:
+            # If this setting variant isn't applicable to the student, ignore it.
+            if lgs.variant not in variants_applicable:
+                variants_applicable[lgs.variant] = _variantApplicable(lgs.variant, dbStudent)
+            if not variants_applicable[lgs.variant]:
+                continue
+
+            if lgs.key in chosen:
+                # Already have a current student-overriden setting, ignore this one
+                # NB: This includes the case when a variant has overriden the general case
+                continue
+            chosen.add(lgs.key)
+            pending.append(lgs)
+
+    # Find latest previous setting for each pending key
+    prior = {}
+    if pending:
+        for (oldLgs, oldLss) in (Session.query(db.LectureGlobalSetting, db.LectureStudentSetting)
                 .join(db.LectureStudentSetting, and_(
                       db.LectureGlobalSetting.lectureId == db.LectureStudentSetting.lectureId,
                       db.LectureGlobalSetting.lectureVersion == db.LectureStudentSetting.lectureVersion,
-                      db.LectureGlobalSetting.key == db.LectureStudentSetting.key))
-                .filter_by(lectureId=dbLec.lectureId)
-                .filter_by(key=lgs.key)
-                .filter_by(variant=lgs.variant)
-                .filter(db.LectureStudentSetting.student == dbStudent)
-                .order_by(db.LectureGlobalSetting.lectureVersion.desc())
-                .first())
+                      db.LectureGlobalSetting.key == db.LectureStudentSetting.key,
+                      # NB: Only copy forward values chosen for the same variant
+                      db.LectureGlobalSetting.variant == db.LectureStudentSetting.variant))
+                .filter(db.LectureGlobalSetting.lectureId.in_(set(lgs.lectureId for lgs in pending)))
+                .filter(db.LectureGlobalSetting.key.in_(set(lgs.key for lgs in pending)))
+                .filter(db.LectureStudentSetting.studentId == dbStudent.studentId)
+                .order_by(db.LectureGlobalSetting.lectureVersion.desc())):
+            prior.setdefault((oldLss.lectureId, oldLss.key, oldLss.variant), (oldLgs, oldLss))
+
+    newRows = []
+    for lgs in pending:
+        latestLectureVersion = lecSettings[lgs.lectureId][0]
+
+        # Find any previous setting, if it was created with the same values copy it
+        old_set = prior.get((lgs.lectureId, lgs.key, lgs.variant), None)
         if old_set and lgs.equivalent(old_set[0]):
-            Session.add(old_set[1].recreate(latestLectureVersion))
-            out[lgs.key] = old_set[1].value
+            newRows.append(dict(
+                lectureId=lgs.lectureId,
+                lectureVersion=latestLectureVersion,
+                studentId=dbStudent.studentId,
+                variant=old_set[1].variant,
+                key=lgs.key,
+                value=old_set[1].value,
+            ))
+            out[lgs.lectureId][lgs.key] = old_set[1].value
             continue
 
         newValue = _chooseSettingValue(lgs)
         if newValue is None:
             # We don't need a customised value, just use the global one.
-            out[lgs.key] = lgs.value
+            out[lgs.lectureId][lgs.key] = lgs.value
         else:
             # Save new value to DB
-            Session.add(db.LectureStudentSetting(
-                lectureId=dbLec.lectureId,
+            newRows.append(dict(
+                lectureId=lgs.lectureId,
                 lectureVersion=latestLectureVersion,
-                student=dbStudent,
+                studentId=dbStudent.studentId,
                 variant=lgs.variant,
                 key=lgs.key,
                 value=newValue,
             ))
-            out[lgs.key] = newValue
-    Session.flush()
+            out[lgs.lectureId][lgs.key] = newValue
+
+    # Write all new / copied settings in one go
+    if newRows:
+        # NB: assignStudentSettings or another sync could have got there first, theirs wins
+        Session.execute(db.insertOrSkip(db.LectureStudentSetting.__table__), newRows)
+        written = set((r['lectureId'], r['lectureVersion'], r['key']) for r in newRows)
+        for lss in (Session.query(db.LectureStudentSetting)
+                    .filter(db.LectureStudentSetting.studentId == dbStudent.studentId)
+                    .filter(db.LectureStudentSetting.lectureId.in_(set(r['lectureId'] for r in newRows)))
+                    .filter(db.LectureStudentSetting.key.in_(set(r['key'] for r in newRows)))
+                   ):
+            if (lss.lectureId, lss.lectureVersion, lss.key) in written:
+                out[lss.lectureId][lss.key] = lss.value
 
-    out['lecture_version'] = str(latestLectureVersion)
+    for dbLec in dbLecs:
+        out[dbLec.lectureId]['lecture_version'] = str(lecSettings[dbLec.lectureId][0])
     return out
+
+
+def getStudentSettings(dbLec, dbStudent):
+    """Fetch settings for this lecture, customised for the student"""
+    return getStudentSettingsBatch([dbLec], dbStudent)[dbLec.lectureId]
+
+
+def assignStudentSettings(dbLec):
+    """
+    Choose settings for the latest version of dbLec for every student that
+    has used the lecture, instead of waiting for each of them to sync.
+    Returns the number of settings written.
+    """
+    (latestLectureVersion, lgsList) = getLectureSettings([dbLec])[dbLec.lectureId]
+    if latestLectureVersion is None:
+        return 0
+    studentIds = [studentId for (studentId,) in (Session.query(db.Allocation.studentId)
+        .filter(db.Allocation.lectureId == dbLec.lectureId)
+        .union(Session.query(db.CompactAllocation.studentId)
+            .filter(db.CompactAllocation.lectureId == dbLec.lectureId)))]
+    if not studentIds:
+        return 0
+
+    # Find settings students already have for this version
+    chosen = dict((studentId, set()) for studentId in studentIds)
+    for (studentId, key) in (Session.query(db.LectureStudentSetting.studentId, db.LectureStudentSetting.key)
+            .filter(db.LectureStudentSetting.lectureId == dbLec.lectureId)
+            .filter(db.LectureStudentSetting.lectureVersion == latestLectureVersion)):
+        if studentId in chosen:
+            chosen[studentId].add(key)
+
+    # Work out which global setting applies to each student, as getStudentSettingsBatch would
+    variants_applicable = {}
+    pending = []
+    for lgs in lgsList:
+        if lgs.variant not in variants_applicable:
+            variants_applicable[lgs.variant] = _variantApplicableStudents(lgs.variant, studentIds)
+        pendingStudents = []
+        for studentId in studentIds:
+            if studentId not in variants_applicable[lgs.variant] or lgs.key in chosen[studentId]:
+                continue
+            chosen[studentId].add(lgs.key)
+            pendingStudents.append(studentId)
+        if pendingStudents:
+            pending.append((lgs, pendingStudents))
+    if not pending:
+        return 0
+
+    # Find latest previous setting for each pending key
+    prior = {}
+    for (oldLgs, oldLss) in (Session.query(db.LectureGlobalSetting, db.LectureStudentSetting)
+            .join(db.LectureStudentSetting, and_(
+                  db.LectureGlobalSetting.lectureId == db.LectureStudentSetting.lectureId,
+                  db.LectureGlobalSetting.lectureVersion == db.LectureStudentSetting.lectureVersion,
+                  db.LectureGlobalSetting.key == db.LectureStudentSetting.key,
+                  # NB: Only copy forward values chosen for the same variant
+                  db.LectureGlobalSetting.variant == db.LectureStudentSetting.variant))
+            .filter(db.LectureGlobalSetting.lectureId == dbLec.lectureId)
+            .filter(db.LectureGlobalSetting.key.in_(set(lgs.key for (lgs, _) in pending)))
+            .order_by(db.LectureGlobalSetting.lectureVersion.desc())):
+        prior.setdefault((oldLss.studentId, oldLss.key, oldLss.variant), (oldLgs, oldLss))
+
+    newRows = []
+    for (lgs, pendingStudents) in pending:
+        # Copy forward any equivalent previous settings
+        toChoose = []
+        for studentId in pendingStudents:
+            old_set = prior.get((studentId, lgs.key, lgs.variant), None)
+            if old_set and lgs.equivalent(old_set[0]):
+                newRows.append(dict(
+                    lectureId=dbLec.lectureId,
+                    lectureVersion=latestLectureVersion,
+                    studentId=studentId,
+                    variant=old_set[1].variant,
+                    key=lgs.key,
+                    value=old_set[1].value,
+                ))
+            else:
+                toChoose.append(studentId)
+
+        # Draw values for everyone else in one go
+        newValues = _chooseSettingValues(lgs, len(toChoose)) if toChoose else None
+        if newValues is None:
+            # We don't need a customised value, just use the global one.
+            continue
+        for (studentId, newValue) in zip(toChoose, newValues):
+            newRows.append(dict(
+                lectureId=dbLec.lectureId,
+                lectureVersion=latestLectureVersion,
+                studentId=studentId,
+                variant=lgs.variant,
+                key=lgs.key,
+                value=newValue,
+            ))
+
+    # NB: Students might sync while we're doing this, theirs wins
+    if newRows:
+        Session.execute(db.insertOrSkip(db.LectureStudentSetting.__table__), newRows)
+    return len(newRows)
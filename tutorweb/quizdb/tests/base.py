@@ -28,6 +28,10 @@ from tutorweb.content.tests.base import (
 from tutorweb.content.tests.base import TestFixture as ContentTestFixture
 from tutorweb.content.tests.base import FunctionalTestCase as ContentFunctionalTestCase
 from tutorweb.quizdb import ORMBase
+from tutorweb.quizdb.allocation.original import clearQuestionPoolCache
+from tutorweb.quizdb.bundle import clearBundleIndex
+from tutorweb.quizdb.sync.questions import clearQuestionDataCache
+from tutorweb.quizdb.sync.student import clearLectureSettingsCache
 
 class TestFixture(ContentTestFixture):
     def setUpZope(self, app, configurationContext):
@@ -218,11 +222,14 @@ class IntegrationTestCase(TestCase, TestHelpers):
     def tearDown(self):
         """Drop all DB tables and recreate"""
         Session().execute("DROP TABLE allocation")
+        Session().execute("DROP TABLE compactAllocation")
         Session().execute("DROP TABLE lecture")
+        Session().execute("DROP TABLE tutorial")
         Session().execute("DROP TABLE lectureGlobalSetting")
         Session().execute("DROP TABLE lectureStudentSetting")
         Session().execute("DROP TABLE lectureQuestions")
         Session().execute("DROP TABLE question")
+        Session().execute("DROP TABLE questionCounter")
         Session().execute("DROP TABLE student")
         Session().execute("DROP TABLE answer")
         Session().execute("DROP TABLE answerSummary")
@@ -230,6 +237,10 @@ class IntegrationTestCase(TestCase, TestHelpers):
         Session().execute("DROP TABLE userGeneratedAnswer")
         Session().execute("DROP TABLE coinAward")
         ORMBase.metadata.create_all(Session().bind)
+        clearLectureSettingsCache()
+        clearQuestionPoolCache()
+        clearQuestionDataCache()
+        clearBundleIndex()
 
     def assertTrue(self, expr, thing=None, msg=None):
         if thing is not None:
@@ -260,11 +271,14 @@ class FunctionalTestCase(ContentFunctionalTestCase, TestHelpers):
 
         # Drop all DB tables & recreate
         Session().execute("DROP TABLE allocation")
+        Session().execute("DROP TABLE compactAllocation")
         Session().execute("DROP TABLE lecture")
+        Session().execute("DROP TABLE tutorial")
         Session().execute("DROP TABLE lectureGlobalSetting")
         Session().execute("DROP TABLE lectureStudentSetting")
         Session().execute("DROP TABLE lectureQuestions")
         Session().execute("DROP TABLE question")
+        Session().execute("DROP TABLE questionCounter")
         Session().execute("DROP TABLE student")
         Session().execute("DROP TABLE answer")
         Session().execute("DROP TABLE answerSummary")
@@ -272,6 +286,10 @@ class FunctionalTestCase(ContentFunctionalTestCase, TestHelpers):
         Session().execute("DROP TABLE userGeneratedAnswer")
         Session().execute("DROP TABLE coinAward")
         ORMBase.metadata.create_all(Session().bind)
+        clearLectureSettingsCache()
+        clearQuestionPoolCache()
+        clearQuestionDataCache()
+        clearBundleIndex()
 
         transaction.commit()
         super(FunctionalTestCase, self).tearDown()
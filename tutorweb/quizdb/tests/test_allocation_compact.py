@@ -0,0 +1,74 @@
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
+
+from .base import FunctionalTestCase
+from .base import USER_A_ID, USER_B_ID
+
+class CompactAllocationTest(FunctionalTestCase):
+    maxDiff = None
+
+    def test_allocation(self):
+        # Shortcut for making answerQueue entries
+        aqTime = [1377000000]
+        def aqEntry(alloc, qnIndex, correct, grade_after, user=USER_A_ID):
+            qnData = self.getJson(alloc['questions'][qnIndex]['uri'], user=user)
+            aqTime[0] += 120
+            return dict(
+                uri=qnData.get('uri', alloc['questions'][qnIndex]['uri']),
+                type='tw_latexquestion',
+                synced=False,
+                correct=correct,
+                student_answer=self.findAnswer(qnData, correct),
+                quiz_time=aqTime[0] - 50,
+                answer_time=aqTime[0] - 20,
+                grade_after=grade_after,
+            )
+
+        # Create a lecture which uses compact allocation
+        lecObj = self.createTestLecture(qnCount=10, lecOpts=lambda i: dict(settings=[
+            dict(key="allocation_method", value="compact"),
+            dict(key="question_cap", value="5"),
+        ]))
+        lecPath = 'http://nohost/' + '/'.join(lecObj.getPhysicalPath())
+        dbLec = lecObj.unrestrictedTraverse('@@quizdb-sync').getDbLecture()
+
+        # Syncing allocates question_cap questions, all within the lecture
+        aAlloc = self.getJson(lecPath + '/@@quizdb-sync', user=USER_A_ID)
+        self.assertEqual(len(aAlloc['questions']), 5)
+        for qn in aAlloc['questions']:
+            self.assertTrue(qn['uri'].startswith('http://nohost/plone/quizdb-get-question/%d:' % dbLec.lectureId))
+
+        # Stored as one row
+        self.assertEqual(Session.query(db.Allocation).count(), 0)
+        self.assertEqual(Session.query(db.CompactAllocation).count(), 1)
+
+        # Syncing again gets the same questions
+        self.assertEqual(
+            sorted(qn['uri'] for qn in self.getJson(lecPath + '/@@quizdb-sync', user=USER_A_ID)['questions']),
+            sorted(qn['uri'] for qn in aAlloc['questions']),
+        )
+
+        # Can fetch all questions, or just the one
+        allQns = self.getJson(aAlloc['question_uri'], user=USER_A_ID)
+        self.assertEqual(sorted(allQns.keys()), sorted(qn['uri'] for qn in aAlloc['questions']))
+        self.assertEqual(
+            self.getJson(aAlloc['questions'][0]['uri'], user=USER_A_ID)['title'],
+            allQns[aAlloc['questions'][0]['uri']]['title'],
+        )
+
+        # B can't use A's URIs, or make them up
+        self.getJson(aAlloc['questions'][0]['uri'], user=USER_B_ID, expectedStatus=404)
+        self.getJson(aAlloc['questions'][0]['uri'][:-1] + 'x', user=USER_A_ID, expectedStatus=404)
+
+        # Can write answers back
+        aAlloc = self.getJson(lecPath + '/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueue=[
+                aqEntry(aAlloc, 0, True, 0.3, user=USER_A_ID),
+                aqEntry(aAlloc, 1, False, 0.2, user=USER_A_ID),
+            ],
+        ))
+        self.assertEqual([a['grade_after'] for a in aAlloc['answerQueue']], [
+            0.3,
+            0.2,
+        ])
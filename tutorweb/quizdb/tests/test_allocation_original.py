@@ -0,0 +1,81 @@
+import random
+import unittest
+
+from tutorweb.quizdb.allocation import original
+from tutorweb.quizdb.allocation.original import _chooseQuestions, _leastSuitable, DIFFICULTY_BANDS
+
+def makePool(bands):
+    """Make a getQuestionPool() entry from dict of band -> questionIds"""
+    return dict(
+        questions=tuple(qnId for qnIds in bands.values() for qnId in qnIds),
+        bands=dict((k, tuple(v)) for (k, v) in bands.items()),
+    )
+
+class ChooseQuestionsTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+
+    def test_noTarget(self):
+        pool = makePool({None: [1, 2], 10: [3, 4], 40: [5, 6]})
+
+        # Distinct questions, nothing from exclude
+        for i in range(20):
+            out = _chooseQuestions(pool, set([1, 5]), 3)
+            self.assertEqual(len(out), 3)
+            self.assertEqual(len(set(out)), 3)
+            self.assertTrue(set(out) <= set([2, 3, 4, 6]))
+
+        # Everything that's left if there's not enough
+        self.assertEqual(sorted(_chooseQuestions(pool, set([1, 2, 3]), 10)), [4, 5, 6])
+
+        # Nothing if there's nothing to choose from, or nothing wanted
+        self.assertEqual(_chooseQuestions(pool, set(), 0), [])
+        self.assertEqual(_chooseQuestions({}, set(), 5), [])
+
+    def test_target(self):
+        pool = makePool({None: [1], 10: [2, 3], 25: [4], 40: [5, 6]})
+
+        # Unanswered first, then the nearest bands
+        self.assertEqual(sorted(_chooseQuestions(pool, set(), 3, targetDifficulty=0.2)), [1, 2, 3])
+        self.assertEqual(sorted(_chooseQuestions(pool, set(), 3, targetDifficulty=0.8)), [1, 5, 6])
+        self.assertEqual(sorted(_chooseQuestions(pool, set([1]), 3, targetDifficulty=0.6)), [4, 5, 6])
+
+        # Only part of a band if that's all we need
+        out = _chooseQuestions(pool, set([1]), 1, targetDifficulty=0.8)
+        self.assertTrue(out == [5] or out == [6])
+
+        # Ends of the range are reachable, and everything comes back if asked for
+        self.assertEqual(sorted(_chooseQuestions(makePool({DIFFICULTY_BANDS: [7]}), set(), 1, targetDifficulty=1.0)), [7])
+        self.assertEqual(sorted(_chooseQuestions(pool, set(), 10, targetDifficulty=0.0)), [1, 2, 3, 4, 5, 6])
+
+
+class LeastSuitableTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = original.numpy
+
+    def tearDown(self):
+        original.numpy = self.numpy
+
+    def test_fallback(self):
+        original.numpy = None
+
+        # Furthest from target first, unanswered questions last
+        self.assertEqual(_leastSuitable([10, 10, 0, 10], [9, 1, 0, 5], 0.2, 2), [0, 3])
+        self.assertEqual(_leastSuitable([10, 10, 0, 10], [9, 1, 0, 5], 0.2, 4), [0, 3, 1, 2])
+        self.assertEqual(_leastSuitable([], [], 0.2, 1), [])
+
+    @unittest.skipIf(original.numpy is None, "numpy not installed")
+    def test_numpyMatchesFallback(self):
+        random.seed(42)
+        for i in range(100):
+            # NB: Plenty of ties, which both should break the same way
+            timesAnswered = [random.choice([0, 1, 5, 10]) for j in range(random.randint(0, 30))]
+            timesCorrect = [random.randint(0, n) for n in timesAnswered]
+            target = random.choice([0.0, 0.1, 0.5, 0.9, 1.0])
+            count = len(timesAnswered) / 10 + 1
+
+            original.numpy = self.numpy
+            withNumpy = _leastSuitable(timesAnswered, timesCorrect, target, count)
+            original.numpy = None
+            withoutNumpy = _leastSuitable(timesAnswered, timesCorrect, target, count)
+            self.assertEqual(withNumpy, withoutNumpy)
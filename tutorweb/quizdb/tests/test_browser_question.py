@@ -1,5 +1,10 @@
 import base64
+import datetime
+import gzip
 import json
+import os
+import shutil
+import tempfile
 import time
 import uuid
 
@@ -7,6 +12,12 @@ import transaction
 from Products.CMFCore.utils import getToolByName
 
 from plone.app.testing import login
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
+from tutorweb.quizdb.config import bundle_config
+from tutorweb.quizdb.sync.questions import cacheQuestionData
+from tutorweb.quizdb.utils import getDbLecture, getDbStudent
 
 from .base import FunctionalTestCase
 from .base import USER_A_ID, USER_B_ID, USER_C_ID, USER_D_ID, MANAGER_ID
@@ -536,3 +547,150 @@ class GetLectureQuestionsViewTest(FunctionalTestCase):
 
         # The allocations are different
         self.assertNotEquals(sorted(allQns1.keys()), sorted(allQns.keys()))
+
+    def test_notModified(self):
+        """Clients that already have the questions get a 304"""
+        def getQuestions(url, etag=None, user=USER_A_ID):
+            browser = self.getBrowser(None, user=user)
+            browser.handleErrors = False
+            browser.raiseHttpErrors = False
+            if etag:
+                browser.addHeader('If-None-Match', etag)
+            browser.open(url)
+            return (browser.headers['Status'][0:3], browser.headers.get('ETag', None))
+
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+        (status, etag) = getQuestions(aAlloc['question_uri'])
+        self.assertEqual(status, '200')
+        self.assertTrue(etag is not None)
+
+        # Asking again with the ETag gets nothing new
+        self.assertEqual(getQuestions(aAlloc['question_uri'], etag=etag), ('304', etag))
+
+        # B has different questions
+        self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_B_ID)
+        self.assertEqual(getQuestions(aAlloc['question_uri'], etag=etag, user=USER_B_ID)[0], '200')
+
+        # Same for individual questions
+        (status, qnEtag) = getQuestions(aAlloc['questions'][0]['uri'])
+        self.assertEqual(status, '200')
+        self.assertNotEqual(qnEtag, etag)
+        self.assertEqual(getQuestions(aAlloc['questions'][0]['uri'], etag=qnEtag), ('304', qnEtag))
+
+        # Change a question, get a new version
+        time.sleep(1)
+        login(self.layer['portal'], MANAGER_ID)
+        for qn in ['qn1', 'qn2']:
+            self.layer['portal']['dept1']['tut1']['lec1'][qn].title = "Unittest D1 T1 L1 %s changed" % qn
+            self.layer['portal']['dept1']['tut1']['lec1'][qn].reindexObject()
+            self.notifyModify(self.layer['portal']['dept1']['tut1']['lec1'][qn])
+        transaction.commit()
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+        (status, newEtag) = getQuestions(aAlloc['question_uri'], etag=etag)
+        self.assertEqual(status, '200')
+        self.assertNotEqual(newEtag, etag)
+
+    def test_cachedQuestionData(self):
+        """Cached question data is served without going to Plone, with URLs for this portal"""
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+
+        # Replace data for each question, as if an editor on another hostname had rendered it
+        dbLec = getDbLecture('/'.join(self.layer['portal']['dept1']['tut1']['lec1'].getPhysicalPath()))
+        for dbQn in Session.query(db.Question).filter(db.Question.lectures.contains(dbLec)):
+            cacheQuestionData('http://editor.example.com/plone', dbQn.plonePath, dbQn.lastUpdate, dict(
+                title=u'Cached %s' % dbQn.plonePath.split('/')[-1],
+                text=u'<img src="http://editor.example.com/plone/dept1/image.png" />',
+            ))
+        transaction.commit()
+
+        allQns = self.getJson(aAlloc['question_uri'], user=USER_A_ID)
+        self.assertEqual(sorted(q['title'] for q in allQns.values()), [u'Cached qn1', u'Cached qn2'])
+        self.assertEqual(set(q['text'] for q in allQns.values()), set([
+            u'<img src="http://nohost/plone/dept1/image.png" />',
+        ]))
+        qn = self.getJson(aAlloc['questions'][0]['uri'], user=USER_A_ID)
+        self.assertTrue(qn['title'].startswith(u'Cached '))
+
+    def test_bundle(self):
+        """Clients can ask for a bundle, which gets updated when questions change"""
+        bundleDir = tempfile.mkdtemp()
+        oldConfig = (bundle_config.DIR, bundle_config.URL)
+        (bundle_config.DIR, bundle_config.URL) = (bundleDir, 'http://static.example.com/bundles/')
+        def restoreConfig():
+            (bundle_config.DIR, bundle_config.URL) = oldConfig
+            shutil.rmtree(bundleDir)
+        self.addCleanup(restoreConfig)
+
+        def getBundle(url):
+            out = self.getJson(url + '?bundle=1', user=USER_A_ID)
+            self.assertTrue(out['bundle'].startswith('http://static.example.com/bundles/'))
+            f = gzip.open(os.path.join(bundleDir, out['bundle'].split('/')[-1]), 'rb')
+            try:
+                return (out['questions'], json.loads(f.read()))
+            finally:
+                f.close()
+
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+
+        # Student has an allocation for a question Plone doesn't have any more
+        lecPath = '/'.join(self.layer['portal']['dept1']['tut1']['lec1'].getPhysicalPath())
+        dbLec = getDbLecture(lecPath)
+        dbQn = db.Question(
+            plonePath=lecPath + '/qnmissing',
+            qnType='tw_latexquestion',
+            lastUpdate=datetime.datetime.utcnow(),
+            correctChoices='[]',
+            incorrectChoices='[]',
+            timesAnswered=0,
+            timesCorrect=0,
+            lectures=[dbLec],
+        )
+        Session.add(dbQn)
+        Session.flush()
+        Session.add(db.Allocation(
+            studentId=getDbStudent(USER_A_ID).studentId,
+            lectureId=dbLec.lectureId,
+            questionId=dbQn.questionId,
+        ))
+        missingId = dbQn.questionId
+        transaction.commit()
+
+        # Bundle has the questions, the client is only told to use ones in the bundle
+        (questions, bundle) = getBundle(aAlloc['question_uri'])
+        self.assertEqual(sorted(bundle[str(x)]['title'] for x in questions.values()), [
+            u'Unittest D1 T1 L1 Q1',
+            u'Unittest D1 T1 L1 Q2',
+        ])
+        self.assertEqual(sorted(questions.values()), sorted(int(x) for x in bundle.keys()))
+        self.assertFalse(missingId in questions.values())
+        self.assertEqual(len(os.listdir(bundleDir)), 1)
+
+        # Bundle responses have their own ETag
+        etags = [
+            self.getBrowser(aAlloc['question_uri'] + qs, user=USER_A_ID).headers['ETag']
+            for qs in ['', '?bundle=1']
+        ]
+        self.assertNotEqual(etags[0], etags[1])
+
+        # Only asking for a bundle gets one, not any old value
+        for qs in ['?bundle=0', '?bundle=false', '?bundle=']:
+            self.assertFalse('bundle' in self.getJson(aAlloc['question_uri'] + qs, user=USER_A_ID))
+        self.assertTrue('bundle' in self.getJson(aAlloc['question_uri'] + '?bundle=true', user=USER_A_ID))
+
+        # Editing a question writes a new bundle for this hostname straight away
+        time.sleep(1)
+        login(self.layer['portal'], MANAGER_ID)
+        self.layer['portal']['dept1']['tut1']['lec1']['qn1'].title = "Unittest D1 T1 L1 Q1 changed"
+        self.layer['portal']['dept1']['tut1']['lec1']['qn1'].reindexObject()
+        self.notifyModify(self.layer['portal']['dept1']['tut1']['lec1']['qn1'])
+        transaction.commit()
+        self.assertEqual(len(os.listdir(bundleDir)), 2)
+
+        # ...which the student gets given after syncing
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+        (questions, bundle) = getBundle(aAlloc['question_uri'])
+        self.assertEqual(sorted(bundle[str(x)]['title'] for x in questions.values()), [
+            u'Unittest D1 T1 L1 Q1 changed',
+            u'Unittest D1 T1 L1 Q2',
+        ])
+        self.assertEqual(len(os.listdir(bundleDir)), 2)
@@ -4,6 +4,10 @@ import uuid
 
 from plone.app.testing import login
 
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
+from ..sync.answers import checkAnswerSummaries
 from .base import IntegrationTestCase, FunctionalTestCase
 from .base import MANAGER_ID
 
@@ -45,6 +49,36 @@ class ReplicationDumpIngestViewTest(FunctionalTestCase):
     def doIngest(self, data, remoteAddr='127.0.0.1'):
         return self.fetchView('ingest', data, remoteAddr)
 
+    def test_answerSummary(self):
+        """Ingested answers are added to existing answer summaries"""
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        lecObj = self.createTestLecture(qnCount=3)
+        student = self.createTestStudent('student0')
+        self.submitAnswers(lecObj, student, [
+            dict(alloc=0, quiz_time=1271010000),
+            dict(alloc=1, quiz_time=1271020000),
+            dict(alloc=2, quiz_time=1272030000),
+        ])
+        dump = self.doDump()
+
+        def getSummary():
+            return (Session.query(db.AnswerSummary.lecAnswered, db.AnswerSummary.maxTimeEnd)
+                .filter_by(studentId=student.studentId)
+                .one())
+
+        # Lose the later answers, as if they were only on another host
+        (Session.query(db.Answer)
+            .filter(db.Answer.timeStart > datetime.datetime.utcfromtimestamp(1271010000))
+            .delete(synchronize_session=False))
+        self.assertEqual(len(checkAnswerSummaries()), 1)
+        self.assertEqual(getSummary(), (1, datetime.datetime.utcfromtimestamp(1271010001)))
+
+        # Ingesting them brings the summary back up to date
+        self.assertEqual(self.doIngest(dump)['answer'], 2)
+        self.assertEqual(getSummary(), (3, datetime.datetime.utcfromtimestamp(1272030001)))
+        self.assertEqual(checkAnswerSummaries(), [])
+
     def test_answers(self):
         portal = self.layer['portal']
         login(portal, MANAGER_ID)
@@ -1244,6 +1244,89 @@ class SyncViewFunctional(FunctionalTestCase):
             (answerQueue[12]['quiz_time'], False),
         ])
 
+    def test_answerQueueSince(self):
+        """Clients can ask for just the answers they haven't seen"""
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID)
+        qns = dict((self.getJson(qn['uri'])['title'], qn) for qn in aAlloc['questions'])
+
+        def answer(time, correct):
+            return dict(
+                synced=False,
+                uri=qns[u'Unittest D1 T1 L1 Q1']['uri'],
+                student_answer=1 if correct else 0,
+                quiz_time=time - 5,
+                answer_time=time,
+                grade_after=0.1,
+            )
+
+        # Full answerQueue comes back without a watermark, and no summary
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueue=[answer(1377000010, True), answer(1377000020, False)],
+        ))
+        self.assertEqual([a['answer_time'] for a in aAlloc['answerQueue']], [1377000010, 1377000020])
+        self.assertFalse('answerQueueSummary' in aAlloc)
+
+        # With a watermark, only get answers from then on back, and a summary of everything
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueueSince=1377000020,
+            answerQueue=[answer(1377000030, True)],
+        ))
+        self.assertEqual([a['answer_time'] for a in aAlloc['answerQueue']], [1377000020, 1377000030])
+        self.assertEqual(aAlloc['answerQueueSince'], 1377000030)
+        self.assertEqual(aAlloc['answerQueueSummary'], dict(
+            answered=3,
+            correct=2,
+            practice_answered=0,
+            practice_correct=0,
+            grade=0.1,
+            last_answer_time=1377000030,
+        ))
+
+        # Answers older than the watermark we just wrote still come back
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueueSince=1377000030,
+            answerQueue=[answer(1377000015, True)],
+        ))
+        self.assertEqual([a['answer_time'] for a in aAlloc['answerQueue']], [1377000015, 1377000020, 1377000030])
+        self.assertEqual(aAlloc['answerQueueSince'], 1377000030)
+        self.assertEqual(aAlloc['answerQueueSummary']['answered'], 4)
+
+        # Nothing new, only the answers at the watermark
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueueSince=1377000030,
+        ))
+        self.assertEqual([a['answer_time'] for a in aAlloc['answerQueue']], [1377000030])
+        self.assertEqual(aAlloc['answerQueueSince'], 1377000030)
+
+        # Another tab answers another question in the same second as the watermark, we still get it
+        self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueueSince=1377000030,
+            answerQueue=[dict(answer(1377000030, False), quiz_time=1377000028, uri=qns[u'Unittest D1 T1 L1 Q2']['uri'])],
+        ))
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueueSince=1377000030,
+        ))
+        self.assertEqual(
+            [(a['quiz_time'], a['answer_time']) for a in aAlloc['answerQueue']],
+            [(1377000025, 1377000030), (1377000028, 1377000030)],
+        )
+        self.assertEqual(aAlloc['answerQueueSummary']['answered'], 5)
+
+        # Nonsense watermarks are rejected
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, expectedStatus=400, body=dict(
+            answerQueueSince='yesterday',
+        ))
+        self.assertEqual(aAlloc['error'], 'BadRequest')
+
+        # Can still get everything by not sending a watermark
+        aAlloc = self.getJson('http://nohost/plone/dept1/tut1/lec1/@@quizdb-sync', user=USER_A_ID, body=dict(
+            answerQueue=[],
+        ))
+        self.assertEqual(
+            [a['answer_time'] for a in aAlloc['answerQueue']],
+            [1377000010, 1377000015, 1377000020, 1377000030, 1377000030],
+        )
+
     def test_lotsofquestions(self):
         """Shouldn't go over the question cap when assigning questions"""
         def createQuestions(obj, count):
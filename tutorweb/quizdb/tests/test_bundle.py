@@ -0,0 +1,62 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tutorweb.quizdb.bundle import checkBundle, purgeBundles, writeBundle
+
+class WriteBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = os.path.join(tempfile.mkdtemp(), 'bundles')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.bundleDir))
+
+    def test_writeBundle(self):
+        payloads = {
+            1: dict(title=u'Question 1', choices=[u'a', u'b']),
+            2: dict(title=u'Question 2', choices=[u'c', u'd']),
+        }
+
+        # Written as gzipped JSON, keyed by questionId
+        name = writeBundle(self.bundleDir, payloads)
+        self.assertTrue(name.endswith('.json.gz'))
+        self.assertEqual(os.listdir(self.bundleDir), [name])
+        f = gzip.open(os.path.join(self.bundleDir, name), 'rb')
+        self.assertEqual(json.loads(f.read()), {
+            u'1': dict(title=u'Question 1', choices=[u'a', u'b']),
+            u'2': dict(title=u'Question 2', choices=[u'c', u'd']),
+        })
+        f.close()
+
+        # Same content gets the same file
+        self.assertEqual(writeBundle(self.bundleDir, dict(payloads.items())), name)
+        self.assertEqual(os.listdir(self.bundleDir), [name])
+
+        # Different content gets a different file
+        payloads[2]['title'] = u'Question 2b'
+        name2 = writeBundle(self.bundleDir, payloads)
+        self.assertNotEqual(name2, name)
+        self.assertEqual(sorted(os.listdir(self.bundleDir)), sorted([name, name2]))
+
+    def test_purgeBundles(self):
+        # Nothing to purge yet
+        self.assertEqual(list(purgeBundles(self.bundleDir, time.time())), [])
+
+        names = [writeBundle(self.bundleDir, {1: dict(title=u'Question %d' % i)}) for i in range(3)]
+        monthAgo = time.time() - 30 * 24 * 60 * 60
+        for name in names:
+            os.utime(os.path.join(self.bundleDir, name), (monthAgo, monthAgo))
+
+        # Checking / rewriting a bundle marks it as in use
+        self.assertTrue(checkBundle(self.bundleDir, names[0]))
+        self.assertEqual(writeBundle(self.bundleDir, {1: dict(title=u'Question 1')}), names[1])
+        self.assertFalse(checkBundle(self.bundleDir, 'not-a-bundle.json.gz'))
+
+        # Only unused bundles get purged
+        self.assertEqual(list(purgeBundles(self.bundleDir, time.time() - 7 * 24 * 60 * 60)), [names[2]])
+        self.assertEqual(sorted(os.listdir(self.bundleDir)), sorted(names[0:2]))
+        self.assertFalse(checkBundle(self.bundleDir, names[2]))
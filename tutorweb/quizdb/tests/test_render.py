@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import unittest
+
+from tutorweb.quizdb.render import renderTeX, clearRenderCache
+
+class RenderTeXTest(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        self.renders = []
+        clearRenderCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+        clearRenderCache()
+
+    def render(self, tex):
+        self.renders.append(tex)
+        return u'<p>%s</p>' % tex
+
+    def test_memory(self):
+        # Only rendered the first time
+        self.assertEqual(renderTeX(u'$x^2$', self.render), u'<p>$x^2$</p>')
+        self.assertEqual(renderTeX(u'$x^2$', self.render), u'<p>$x^2$</p>')
+        self.assertEqual(renderTeX(u'$α$', self.render), u'<p>$α$</p>')
+        self.assertEqual(self.renders, [u'$x^2$', u'$α$'])
+
+        # Forgotten when cleared
+        clearRenderCache()
+        self.assertEqual(renderTeX(u'$x^2$', self.render), u'<p>$x^2$</p>')
+        self.assertEqual(self.renders, [u'$x^2$', u'$α$', u'$x^2$'])
+
+    def test_disk(self):
+        self.assertEqual(renderTeX(u'$α$', self.render, cacheDir=self.cacheDir), u'<p>$α$</p>')
+        self.assertEqual(self.renders, [u'$α$'])
+
+        # Another client (without our memory) can use the render on disk
+        clearRenderCache()
+        self.assertEqual(renderTeX(u'$α$', self.render, cacheDir=self.cacheDir), u'<p>$α$</p>')
+        self.assertEqual(self.renders, [u'$α$'])
+
+        # ...but not if it's using a different directory
+        clearRenderCache()
+        self.assertEqual(renderTeX(u'$α$', self.render), u'<p>$α$</p>')
+        self.assertEqual(self.renders, [u'$α$', u'$α$'])
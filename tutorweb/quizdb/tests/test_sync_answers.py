@@ -1,3 +1,7 @@
+import datetime
+import time
+
+from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
 import transaction
@@ -12,7 +16,8 @@ from tutorweb.content.tests.base import setRelations
 
 from tutorweb.quizdb import db
 from ..allocation.base import Allocation
-from ..sync.answers import getCoinAward, getAnswerSummary, parseAnswerQueue
+from ..sync.answers import getCoinAward, getAnswerSummary, parseAnswerQueue, checkAnswerSummaries
+from ..sync.questions import foldQuestionCounters
 from ..sync.student import getStudentSettings
 from ..utils import getDbLecture, getDbStudent
 
@@ -534,3 +539,228 @@ class GetCoinAwardTest(FunctionalTestCase):
         transaction.commit()
         self.assertEqual(len(aAq), 25)
         self.assertEqual(alloc.reAllocQuestions, True)
+
+
+class ParseAnswerQueueTest(FunctionalTestCase):
+    maxDiff = None
+
+    def test_bulkInsert(self):
+        """Writing the queue costs the same number of statements regardless of length, and time doesn't grow with it"""
+        portal = self.layer['portal']
+        lectureObj = self.createTestLecture(qnCount=5)
+        dbLec = getDbLecture('/'.join(lectureObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+        aAllocs = list(self.allocGetQuestionAllocation(dbLec, dbStudent, {}))
+        transaction.commit()
+
+        aqTime = [1400000000]
+        def aqEntries(count):
+            out = []
+            for i in xrange(count):
+                aqTime[0] += 10
+                out.append(dict(
+                    uri=aAllocs[i % len(aAllocs)]['uri'],
+                    synced=False,
+                    student_answer=1,  # NB: "green" is always correct
+                    quiz_time=aqTime[0] - 5,
+                    answer_time=aqTime[0],
+                    grade_after=0.1,
+                ))
+            return out
+
+        totalAnswers = 0
+        elapsed = {}
+        for count in [10, 100, 1000]:
+            aq = aqEntries(count)
+            self.loghandlers['sqlalchemy'].clear()
+            startTime = time.time()
+            aAq = self.allocParseAnswerQueue(dbLec, dbStudent, aq, {})
+            transaction.commit()
+            elapsed[count] = time.time() - startTime
+            totalAnswers += count
+
+            # Everything got written, and returned
+            self.assertEqual(len(aAq), totalAnswers)
+            self.assertEqual(set(a['correct'] for a in aAq), set([True]))
+
+            # ...but only one INSERT each was needed to do it, question isn't touched
+            self.assertEqual(len([
+                x for x in self.logs()
+                if x.startswith('INSERT OR IGNORE INTO answer ')
+            ]), 1)
+            self.assertEqual(len([
+                x for x in self.logs()
+                if x.startswith('INSERT INTO "questionCounter"')
+            ]), 1)
+            self.assertEqual(len([
+                x for x in self.logs()
+                if x.startswith('UPDATE question SET')
+            ]), 0)
+
+        # Per-answer cost falls as the queue grows, rather than each answer costing a round trip
+        self.assertTrue(
+            elapsed[1000] / 1000 < elapsed[10] / 10,
+            "Per-answer times: %s" % dict((k, v / k) for (k, v) in elapsed.items()),
+        )
+
+        # Question counts add up, once they've been folded in
+        self.assertEqual(
+            sorted((x.timesAnswered, x.timesCorrect) for x in Session.query(db.Question)
+                .filter(db.Question.lectures.contains(dbLec))),
+            [(0, 0), (0, 0), (0, 0), (0, 0), (0, 0)],
+        )
+        self.assertEqual(foldQuestionCounters(), 5)
+        transaction.commit()
+        self.assertEqual(foldQuestionCounters(), 0)
+        self.assertEqual(
+            sorted((x.timesAnswered, x.timesCorrect) for x in Session.query(db.Question)
+                .filter(db.Question.lectures.contains(dbLec))),
+            [(222, 222), (222, 222), (222, 222), (222, 222), (222, 222)],
+        )
+
+    def test_concurrentSync(self):
+        """Answers another tab already wrote are only counted once"""
+        lectureObj = self.createTestLecture(qnCount=2)
+        dbLec = getDbLecture('/'.join(lectureObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+        aAllocs = list(self.allocGetQuestionAllocation(dbLec, dbStudent, {}))
+        transaction.commit()
+
+        # Tab A syncs the first answer
+        aAq = self.allocParseAnswerQueue(dbLec, dbStudent, [
+            dict(uri=aAllocs[0]['uri'], student_answer=1, quiz_time=1000000000, answer_time=1000000010),
+        ], {})
+        transaction.commit()
+
+        # Tab B syncs the same answer, along with a new one
+        aAq = self.allocParseAnswerQueue(dbLec, dbStudent, [
+            dict(uri=aAllocs[0]['uri'], student_answer=1, quiz_time=1000000000, answer_time=1000000010),
+            dict(uri=aAllocs[1]['uri'], student_answer=0, quiz_time=1000000020, answer_time=1000000030),
+        ], {})
+        transaction.commit()
+        self.assertEqual([(a['answer_time'], a['correct']) for a in aAq], [
+            (1000000010, True),
+            (1000000030, False),
+        ])
+
+        # The repeated answer didn't get counted twice
+        self.assertEqual(
+            Session.query(func.sum(db.QuestionCounter.answered), func.sum(db.QuestionCounter.correct)).one(),
+            (2, 1),
+        )
+        self.assertEqual(checkAnswerSummaries(), [])
+
+    def test_unlockedWrite(self):
+        """Answers written by something not taking the summary lock are ignored, not duplicated"""
+        portal = self.layer['portal']
+        lectureObj = self.createTestLecture(qnCount=2)
+        dbLec = getDbLecture('/'.join(lectureObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+        aAllocs = list(self.allocGetQuestionAllocation(dbLec, dbStudent, {}))
+        transaction.commit()
+
+        # Another tab writes the first answer after we looked for existing answers
+        alloc = Allocation.allocFor(student=dbStudent, dbLec=dbLec, urlBase=portal.absolute_url())
+        origGetQuestions = alloc.getQuestions
+        def getQuestions(*args, **kwargs):
+            out = list(origGetQuestions(*args, **kwargs))
+            Session.execute(db.Answer.__table__.insert(), dict(
+                lectureId=dbLec.lectureId,
+                lectureVersion=dbLec.currentVersion,
+                studentId=dbStudent.studentId,
+                questionId=dict(out)[aAllocs[0]['uri']].questionId,
+                chosenAnswer=1,
+                correct=True,
+                timeStart=datetime.datetime.utcfromtimestamp(1000000000),
+                timeEnd=datetime.datetime.utcfromtimestamp(1000000010),
+                practice=False,
+                coinsAwarded=0,
+            ))
+            return out
+        alloc.getQuestions = getQuestions
+
+        aAq = parseAnswerQueue(alloc, [
+            dict(uri=aAllocs[0]['uri'], student_answer=1, quiz_time=1000000000, answer_time=1000000010),
+            dict(uri=aAllocs[1]['uri'], student_answer=0, quiz_time=1000000020, answer_time=1000000030),
+        ], {})
+        transaction.commit()
+
+        # Only one copy of each answer
+        self.assertEqual([(a['answer_time'], a['correct']) for a in aAq], [
+            (1000000010, True),
+            (1000000030, False),
+        ])
+        self.assertEqual(Session.query(db.Answer).filter_by(studentId=dbStudent.studentId).count(), 2)
+
+        # Summary noticed the clash and doesn't count the answer twice
+        dbAnsSummary = (Session.query(db.AnswerSummary)
+            .filter_by(lectureId=dbLec.lectureId)
+            .filter_by(studentId=dbStudent.studentId)
+            .one())
+        self.assertEqual(
+            (dbAnsSummary.lecAnswered, dbAnsSummary.lecCorrect, dbAnsSummary.maxTimeEnd),
+            (2, 1, datetime.datetime.utcfromtimestamp(1000000030)),
+        )
+        self.assertEqual(checkAnswerSummaries(), [])
+
+        # Only the answer we wrote was counted against the question
+        self.assertEqual(
+            Session.query(func.sum(db.QuestionCounter.answered), func.sum(db.QuestionCounter.correct)).one(),
+            (1, 0),
+        )
+
+    def test_checkAnswerSummaries(self):
+        """Summaries are kept as running totals, and can be rebuilt if they drift"""
+        lectureObj = self.createTestLecture(qnCount=2)
+        dbLec = getDbLecture('/'.join(lectureObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+        aAllocs = list(self.allocGetQuestionAllocation(dbLec, dbStudent, {}))
+        transaction.commit()
+
+        def getSummary():
+            dbAnsSummary = (Session.query(db.AnswerSummary)
+                .filter_by(lectureId=dbLec.lectureId)
+                .filter_by(studentId=dbStudent.studentId)
+                .one())
+            return (
+                dbAnsSummary.lecAnswered,
+                dbAnsSummary.lecCorrect,
+                dbAnsSummary.practiceAnswered,
+                dbAnsSummary.practiceCorrect,
+                dbAnsSummary.maxTimeEnd,
+            )
+
+        self.allocParseAnswerQueue(dbLec, dbStudent, [
+            dict(uri=aAllocs[0]['uri'], student_answer=1, quiz_time=1000000000, answer_time=1000000010),
+            dict(uri=aAllocs[1]['uri'], student_answer=0, quiz_time=1000000020, answer_time=1000000030),
+        ], {})
+        self.allocParseAnswerQueue(dbLec, dbStudent, [
+            dict(uri=aAllocs[0]['uri'], student_answer=1, quiz_time=1000000040, answer_time=1000000050, practice=True),
+            dict(uri=aAllocs[1]['uri'], student_answer=1, quiz_time=1000000000, answer_time=1000000005),
+        ], {})
+        transaction.commit()
+        self.assertEqual(getSummary(), (4, 3, 1, 1, datetime.datetime.utcfromtimestamp(1000000050)))
+
+        # Nothing has drifted
+        self.assertEqual(checkAnswerSummaries(), [])
+
+        # Mess up summary, can find it without fixing
+        Session.query(db.AnswerSummary).update(dict(lecAnswered=99, maxTimeEnd=None))
+        transaction.commit()
+        self.assertEqual(checkAnswerSummaries(rebuild=False), [(dbLec.lectureId, dbStudent.studentId)])
+        transaction.commit()
+        self.assertEqual(getSummary(), (99, 3, 1, 1, None))
+
+        # Rebuilding fixes it
+        self.assertEqual(checkAnswerSummaries(), [(dbLec.lectureId, dbStudent.studentId)])
+        transaction.commit()
+        self.assertEqual(getSummary(), (4, 3, 1, 1, datetime.datetime.utcfromtimestamp(1000000050)))
+        self.assertEqual(checkAnswerSummaries(), [])
+
+        # Summaries without any answers left get zeroed
+        Session.query(db.Answer).filter_by(studentId=dbStudent.studentId).delete()
+        transaction.commit()
+        self.assertEqual(checkAnswerSummaries(), [(dbLec.lectureId, dbStudent.studentId)])
+        transaction.commit()
+        self.assertEqual(getSummary(), (0, 0, 0, 0, None))
+        self.assertEqual(checkAnswerSummaries(), [])
@@ -0,0 +1,47 @@
+import datetime
+import json
+
+from z3c.saconfig import Session
+
+from tutorweb.quizdb import db
+from tutorweb.quizdb.sync.questions import getCachedQuestionData
+from tutorweb.quizdb.utils import getDbLecture
+
+from .base import IntegrationTestCase
+
+
+class SyncPloneLectureTest(IntegrationTestCase):
+    def test_tutorial(self):
+        # Lectures in the same tutorial share a tutorial row
+        lecObjs = [self.createTestLecture(qnCount=1)]
+        lecObjs.append(self.createTestLecture(qnCount=1, tutorialObj=lecObjs[0].aq_parent))
+        lecObjs.append(self.createTestLecture(qnCount=1))
+        dbLecs = [getDbLecture('/'.join(l.getPhysicalPath())) for l in lecObjs]
+
+        self.assertEqual(dbLecs[0].tutorialId, dbLecs[1].tutorialId)
+        self.assertNotEqual(dbLecs[0].tutorialId, dbLecs[2].tutorialId)
+        self.assertEqual(
+            [Session.query(db.Tutorial).get(l.tutorialId).plonePath for l in dbLecs],
+            ['/'.join(l.aq_parent.getPhysicalPath()) for l in lecObjs],
+        )
+
+    def test_questionData(self):
+        # Question data is cached as part of syncing
+        lecObj = self.createTestLecture(qnCount=2)
+        portalUrl = self.layer['portal'].absolute_url()
+        dbQns = Session.query(db.Question).filter(db.Question.lectures.contains(
+            getDbLecture('/'.join(lecObj.getPhysicalPath()))
+        )).order_by(db.Question.plonePath).all()
+        self.assertEqual(len(dbQns), 2)
+        for dbQn in dbQns:
+            self.assertEqual(
+                getCachedQuestionData(portalUrl, dbQn.plonePath, dbQn.lastUpdate),
+                json.loads(json.dumps(self.layer['portal'].unrestrictedTraverse(str(dbQn.plonePath) + '/@@data').asDict({}))),
+            )
+
+        # Fetching from another hostname gets URLs for that hostname
+        data = getCachedQuestionData('http://students.example.com/plone', dbQns[0].plonePath, dbQns[0].lastUpdate)
+        self.assertFalse(portalUrl in json.dumps(data))
+
+        # Only for that version of the question
+        self.assertEqual(getCachedQuestionData(portalUrl, dbQns[0].plonePath, datetime.datetime(2000, 1, 1)), None)
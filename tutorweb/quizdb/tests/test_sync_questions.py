@@ -1,4 +1,6 @@
 # -*- coding: utf8 -*-
+import datetime
+
 import transaction
 
 from z3c.relationfield import RelationValue
@@ -8,11 +10,15 @@ from zope.component import getUtility
 from Products.CMFCore.utils import getToolByName
 from plone.app.testing import login
 from plone.namedfile.file import NamedBlobFile
+from z3c.saconfig import Session
 
 from .base import FunctionalTestCase, IntegrationTestCase
 from .base import USER_A_ID, USER_B_ID, USER_C_ID, MANAGER_ID
 
+from tutorweb.quizdb import db
+from ..allocation.original import purgeInactiveAllocations, _lookupPublicIds
 from ..sync.plone import syncPloneQuestions
+from ..sync.questions import foldQuestionCounters
 
 def getAllocation(portal, alloc, user):
     login(portal, USER_A_ID)
@@ -163,6 +169,149 @@ class GetQuestionAllocationTest(FunctionalTestCase):
         self.assertLess(abs(0.01 - statsB['variance']), 0.05)
         self.assertLess(abs(0.01 - statsC['variance']), 0.05)
 
+    def test_targetDifficultyOutOfRange(self):
+        """Grades above 1 still get a full allocation, of the easiest questions"""
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+
+        lectureObj = self.createTestLecture(qnCount=20, qnOpts=lambda i: dict(
+            timesanswered=20,
+            timescorrect=i,
+        ))
+        login(portal, USER_A_ID)
+        dbLec = lectureObj.restrictedTraverse('@@quizdb-sync').getDbLecture()
+        syncPloneQuestions(dbLec, lectureObj)
+
+        allocs = list(self.allocGetQuestionAllocation(dbLec, self.studentA, dict(question_cap=10), targetDifficulty=5.5))
+        self.assertEqual(len(allocs), 10)
+        self.assertEqual(sorted(a['correct'] for a in allocs), range(10, 20))
+
+        # Negative ones get the hardest
+        allocs = list(self.allocGetQuestionAllocation(dbLec, self.studentB, dict(question_cap=10), targetDifficulty=-2))
+        self.assertEqual(len(allocs), 10)
+        self.assertEqual(sorted(a['correct'] for a in allocs), range(0, 10))
+
+    def test_questionPool(self):
+        """Question pools are cached, and rebuilt when the lecture changes"""
+        from ..allocation.original import getQuestionPool
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        lectureObj = self.createTestLecture(qnCount=3)
+        login(portal, USER_A_ID)
+        dbLec = lectureObj.restrictedTraverse('@@quizdb-sync').getDbLecture()
+        syncPloneQuestions(dbLec, lectureObj)
+        dbQnIds = sorted(dbQn.questionId for dbQn in Session.query(db.Question)
+            .filter(db.Question.lectures.contains(dbLec)))
+
+        # Pool has every question, fetched once
+        pool = getQuestionPool(dbLec)
+        self.assertEqual(pool.keys(), ['tw_latexquestion'])
+        self.assertEqual(sorted(pool['tw_latexquestion']['questions']), dbQnIds)
+        self.assertTrue(getQuestionPool(dbLec) is pool)
+
+        # Allocations come from the pool
+        allocs = list(self.allocGetQuestionAllocation(dbLec, self.studentA, dict(question_cap=2)))
+        self.assertEqual(len(allocs), 2)
+        self.assertEqual(len(set(a['uri'] for a in allocs)), 2)
+
+        # Removing a question rebuilds the pool
+        login(portal, MANAGER_ID)
+        self.removeQn(lectureObj, 'qn-0')
+        login(portal, USER_A_ID)
+        dbLec = lectureObj.restrictedTraverse('@@quizdb-sync').getDbLecture()
+        newPool = getQuestionPool(dbLec)
+        self.assertFalse(newPool is pool)
+        self.assertEqual(len(newPool['tw_latexquestion']['questions']), 2)
+        self.assertTrue(set(newPool['tw_latexquestion']['questions']) < set(dbQnIds))
+
+        # So does another process updating the lecture, without clearing our cache
+        dbLec.lastUpdate = dbLec.lastUpdate + datetime.timedelta(seconds=1)
+        Session.flush()
+        self.assertFalse(getQuestionPool(dbLec) is newPool)
+
+    def test_questionPoolFold(self):
+        """Folded answer counts reach pools in other processes once they expire"""
+        from ..allocation import original
+        from ..sync import questions
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        lectureObj = self.createTestLecture(qnCount=3, qnOpts=lambda i: dict(timesanswered=0, timescorrect=0))
+        login(portal, USER_A_ID)
+        dbLec = lectureObj.restrictedTraverse('@@quizdb-sync').getDbLecture()
+        syncPloneQuestions(dbLec, lectureObj)
+        pool = original.getQuestionPool(dbLec)['tw_latexquestion']
+        self.assertEqual(pool['bands'].keys(), [None])
+
+        # Cron folds in some answers, but doesn't clear our pools as it's another process
+        Session.execute(db.QuestionCounter.__table__.insert(), [
+            dict(questionId=questionId, answered=10, correct=10)
+            for questionId in pool['questions']
+        ])
+        origClear = questions.clearQuestionPoolCache
+        questions.clearQuestionPoolCache = lambda lectureId=None: None
+        try:
+            self.assertEqual(foldQuestionCounters(), 3)
+        finally:
+            questions.clearQuestionPoolCache = origClear
+        self.assertEqual(original.getQuestionPool(dbLec)['tw_latexquestion']['bands'].keys(), [None])
+
+        # Once our pool is old enough, it gets rebuilt with the new counts
+        cacheKey = (dbLec.lectureId, False)
+        (version, builtAt, cachedPool) = original._questionPoolCache[cacheKey]
+        original._questionPoolCache[cacheKey] = (version, builtAt - original.QUESTION_POOL_MAX_AGE, cachedPool)
+        self.assertEqual(
+            original.getQuestionPool(dbLec)['tw_latexquestion']['bands'].keys(),
+            [original.DIFFICULTY_BANDS],
+        )
+
+    def test_purgeInactiveAllocations(self):
+        """Only allocations deactivated a while ago get purged"""
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        lectureObj = self.createTestLecture(qnCount=10)
+        login(portal, USER_A_ID)
+        dbLec = lectureObj.restrictedTraverse('@@quizdb-sync').getDbLecture()
+        syncPloneQuestions(dbLec, lectureObj)
+
+        # Allocate everything, then drop the cap so half get deactivated
+        self.assertEqual(len(list(self.allocGetQuestionAllocation(dbLec, self.studentA, dict(question_cap=10)))), 10)
+        self.assertEqual(len(list(self.allocGetQuestionAllocation(dbLec, self.studentA, dict(question_cap=5)))), 5)
+        allocTable = db.Allocation.__table__
+        inactiveIds = sorted(allocationId for (allocationId,) in (Session.query(db.Allocation.allocationId)
+            .filter(db.Allocation.active == False)))
+        self.assertEqual(len(inactiveIds), 5)
+        publicIds = dict(Session.query(db.Allocation.allocationId, db.Allocation.publicId))
+        self.assertEqual(len(_lookupPublicIds(publicIds.values())), 10)  # NB: Now cached
+
+        # All were allocated long ago, but only 2 were deactivated long ago
+        longAgo = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+        Session.execute(allocTable.update().values(allocationTime=longAgo))
+        Session.execute(allocTable.update()
+            .where(allocTable.c.allocationId.in_(inactiveIds[:2]))
+            .values(deactivationTime=longAgo))
+        transaction.commit()
+
+        # Only those get purged, recently deactivated ones survive
+        self.assertEqual(sum(purgeInactiveAllocations(datetime.datetime.utcnow() - datetime.timedelta(days=30))), 2)
+        transaction.commit()
+        self.assertEqual(
+            sorted(allocationId for (allocationId,) in (Session.query(db.Allocation.allocationId)
+                .filter(db.Allocation.active == False))),
+            inactiveIds[2:],
+        )
+        self.assertEqual(Session.query(db.Allocation).filter(db.Allocation.active == True).count(), 5)
+
+        # Purged publicIds don't resolve any more
+        self.assertEqual(
+            sorted(_lookupPublicIds(publicIds[i] for i in inactiveIds).keys()),
+            sorted(publicIds[i] for i in inactiveIds[2:]),
+        )
+
+        # Neither do ones deleted by another process, that we still have cached
+        Session.execute(allocTable.delete().where(allocTable.c.allocationId == inactiveIds[2]))
+        transaction.commit()
+        self.assertEqual(len(_lookupPublicIds(publicIds[i] for i in inactiveIds[2:])), 2)
+
     def test_reAllocQuestions(self):
         """Make sure we can throw away un-needed questions"""
         portal = self.layer['portal']
@@ -421,6 +570,7 @@ Stak sem er í annaðhvort $A$ eða $B$ og er í $C$ en
                 grade_after=0.1,
             ),
         ], {})
+        foldQuestionCounters()
         self.assertEqual(origLec.unrestrictedTraverse('@@question-stats').getStats(), [
             {'id': 'qn1', 'timesAnswered': 1, 'timesCorrect': 1, 'title': 'Unittest D1 T1 L1 Q1', 'url': 'http://nohost/plone/dept1/tut1/lec1/qn1'},
             {'id': 'qn2', 'timesAnswered': 0, 'timesCorrect': 0, 'title': 'Unittest D1 T1 L1 Q2', 'url': 'http://nohost/plone/dept1/tut1/lec1/qn2'},
@@ -1,7 +1,11 @@
+import transaction
+
 from plone.app.testing import login
 
+from z3c.saconfig import Session
+
 from tutorweb.quizdb import db
-from tutorweb.quizdb.sync.student import _chooseSettingValue, getStudentSettings
+from tutorweb.quizdb.sync.student import _chooseSettingValue, assignStudentSettings, getStudentSettings, getStudentSettingsBatch, clearLectureSettingsCache
 from tutorweb.quizdb.utils import getDbStudent, getDbLecture
 
 from tutorweb.content.tests.base import setRelations
@@ -132,6 +136,201 @@ class SyncStudentIntegration(IntegrationTestCase):
         self.assertEqual(settings3['betty']['ut_uniform2'], settings1['betty']['ut_uniform2'])
         self.assertEqual(settings3['clara']['ut_uniform2'], settings1['clara']['ut_uniform2'])
 
+    def test_getStudentSettingsCache(self):
+        lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=[
+            dict(key="ut_static", value="0.9"),
+        ]))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_A_ID))['ut_static'], "0.9")
+
+        # Nothing is cached until the transaction commits
+        lgs = (Session.query(db.LectureGlobalSetting)
+            .filter_by(lectureId=dbLec.lectureId)
+            .filter_by(key="ut_static")
+            .one())
+        lgs.value = "0.8"
+        Session.flush()
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_B_ID))['ut_static'], "0.8")
+        lgs.value = "0.9"
+        Session.flush()
+        transaction.commit()
+
+        # Global settings are cached, so changing the DB underneath us doesn't do anything
+        (Session.query(db.LectureGlobalSetting)
+            .filter_by(lectureId=dbLec.lectureId)
+            .filter_by(key="ut_static")
+            .one()).value = "0.7"
+        Session.flush()
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_A_ID))['ut_static'], "0.9")
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_B_ID))['ut_static'], "0.9")
+
+        # Changing the lecture bumps the version, so we see the new value
+        lecObj.settings = [
+            dict(key="ut_static", value="0.4"),
+        ]
+        self.notifyModify(lecObj)
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_A_ID))['ut_static'], "0.4")
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_B_ID))['ut_static'], "0.4")
+
+        # Forgetting the cache re-reads the DB
+        (Session.query(db.LectureGlobalSetting)
+            .filter_by(lectureId=dbLec.lectureId)
+            .filter_by(lectureVersion=dbLec.currentVersion)
+            .filter_by(key="ut_static")
+            .one()).value = "0.2"
+        Session.flush()
+        clearLectureSettingsCache(dbLec.lectureId)
+        self.assertEqual(getStudentSettings(dbLec, getDbStudent(USER_A_ID))['ut_static'], "0.2")
+
+    def test_getStudentSettingsBatch(self):
+        lecObjs = [self.createTestLecture(qnCount=1, lecOpts=lambda i: dict(settings=[
+            dict(key="ut_static", value=str(x)),
+            dict(key="ut_uniform:max", value="100"),
+        ])) for x in xrange(3)]
+        dbLecs = []
+        for lecObj in lecObjs:
+            self.objectPublish(lecObj)
+            dbLecs.append(getDbLecture('/'.join(lecObj.getPhysicalPath())))
+
+        # Batch gets the same settings as asking one by one
+        batch = getStudentSettingsBatch(dbLecs, getDbStudent(USER_A_ID))
+        self.assertEqual(sorted(batch.keys()), sorted(l.lectureId for l in dbLecs))
+        for (x, dbLec) in enumerate(dbLecs):
+            self.assertEqual(batch[dbLec.lectureId]['ut_static'], str(x))
+            self.assertTrue(float(batch[dbLec.lectureId]['ut_uniform']) < 100)
+            self.assertEqual(batch[dbLec.lectureId], getStudentSettings(dbLec, getDbStudent(USER_A_ID)))
+
+        # Change one lecture, random values get carried over
+        lecObjs[1].settings = [
+            dict(key="ut_static", value="9"),
+            dict(key="ut_uniform:max", value="100"),
+        ]
+        self.notifyModify(lecObjs[1])
+        batch2 = getStudentSettingsBatch(dbLecs, getDbStudent(USER_A_ID))
+        self.assertEqual([batch2[l.lectureId]['ut_static'] for l in dbLecs], ['0', '9', '2'])
+        self.assertEqual(
+            [batch2[l.lectureId]['ut_uniform'] for l in dbLecs],
+            [batch[l.lectureId]['ut_uniform'] for l in dbLecs],
+        )
+        self.assertNotEqual(batch2[dbLecs[1].lectureId]['lecture_version'], batch[dbLecs[1].lectureId]['lecture_version'])
+
+    def test_getStudentSettingsCopyForward(self):
+        def lecSettings(static):
+            return [dict(key="ut_static", value=static)] + [
+                dict(key="ut_uniform%d:max" % i, value="100") for i in xrange(30)
+            ]
+        lecObj = self.createTestLecture(qnCount=1, lecOpts=lambda i: dict(settings=lecSettings("0.9")))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+        settings1 = getStudentSettings(dbLec, dbStudent)
+
+        # Bump lecture version, all random values get copied to the new version
+        lecObj.settings = lecSettings("0.4")
+        self.notifyModify(lecObj)
+        settings2 = getStudentSettings(dbLec, dbStudent)
+        self.assertEqual(settings2['ut_static'], "0.4")
+        self.assertNotEqual(settings2['lecture_version'], settings1['lecture_version'])
+        for i in xrange(30):
+            self.assertEqual(settings2['ut_uniform%d' % i], settings1['ut_uniform%d' % i])
+        self.assertEqual(sorted(
+            (lss.key, lss.value) for lss in Session.query(db.LectureStudentSetting)
+                .filter_by(lectureId=dbLec.lectureId)
+                .filter_by(lectureVersion=int(settings2['lecture_version']))
+                .filter_by(studentId=dbStudent.studentId)
+        ), sorted(
+            (k, v) for (k, v) in settings1.items() if k.startswith('ut_uniform')
+        ))
+
+        # Asking again doesn't write anything new
+        self.assertEqual(getStudentSettings(dbLec, dbStudent), settings2)
+        self.assertEqual(Session.query(db.LectureStudentSetting)
+            .filter_by(lectureId=dbLec.lectureId)
+            .filter_by(studentId=dbStudent.studentId)
+            .count(), 60)
+
+    def test_assignStudentSettings(self):
+        lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=[
+            dict(key="ut_static", value="0.9"),
+            dict(key="ut_uniform:max", value="100"),
+            dict(key="ut_gamma", value="10"),
+            dict(key="ut_gamma:shape", value="2"),
+        ]))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+
+        # A & B have used the lecture, C hasn't
+        for u in [USER_A_ID, USER_B_ID]:
+            list(self.allocGetQuestionAllocation(dbLec, getDbStudent(u), {}))
+        oldSettings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID]]
+
+        # Change uniform setting, assign everyone's values
+        lecObj.settings = [
+            dict(key="ut_static", value="0.9"),
+            dict(key="ut_uniform:min", value="99"),
+            dict(key="ut_uniform:max", value="100"),
+            dict(key="ut_gamma", value="10"),
+            dict(key="ut_gamma:shape", value="2"),
+        ]
+        self.notifyModify(lecObj)
+        self.assertTrue(assignStudentSettings(dbLec) > 0)
+        self.assertEqual(assignStudentSettings(dbLec), 0)
+        self.assertEqual(sorted(
+            (lss.student.userName, lss.key) for lss in Session.query(db.LectureStudentSetting)
+                .filter_by(lectureId=dbLec.lectureId)
+                .filter_by(lectureVersion=dbLec.currentVersion)
+                .filter(db.LectureStudentSetting.key.like('ut_%'))
+        ), [
+            (USER_A_ID, 'ut_gamma'),
+            (USER_A_ID, 'ut_uniform'),
+            (USER_B_ID, 'ut_gamma'),
+            (USER_B_ID, 'ut_uniform'),
+        ])
+
+        # Students get the assigned values, gamma values copied forward
+        newSettings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID]]
+        for (old, new) in zip(oldSettings, newSettings):
+            self.assertEqual(new['ut_gamma'], old['ut_gamma'])
+            self.assertTrue(99 <= float(new['ut_uniform']) < 100)
+
+        # C still gets settings as normal
+        settings = getStudentSettings(dbLec, getDbStudent(USER_C_ID))
+        self.assertTrue(99 <= float(settings['ut_uniform']) < 100)
+
+    def test_getStudentSettingsRace(self):
+        """If settings get assigned while we choose ours, theirs win"""
+        from tutorweb.quizdb.sync import student as studentModule
+        lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=[
+            dict(key="ut_uniform:max", value="100"),
+        ]))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+        dbStudent = getDbStudent(USER_A_ID)
+
+        # assignStudentSettings writes a value after we looked for existing ones
+        origChoose = studentModule._chooseSettingValue
+        def chooseSettingValue(lgs):
+            if lgs.key == 'ut_uniform':
+                Session.execute(db.LectureStudentSetting.__table__.insert(), dict(
+                    lectureId=dbLec.lectureId,
+                    lectureVersion=dbLec.currentVersion,
+                    studentId=dbStudent.studentId,
+                    variant='',
+                    key='ut_uniform',
+                    value='42',
+                ))
+            return origChoose(lgs)
+        studentModule._chooseSettingValue = chooseSettingValue
+        try:
+            settings = getStudentSettings(dbLec, dbStudent)
+        finally:
+            studentModule._chooseSettingValue = origChoose
+        self.assertEqual(settings['ut_uniform'], '42')
+
+        # The same value comes back next time
+        self.assertEqual(getStudentSettings(dbLec, dbStudent)['ut_uniform'], '42')
+
     def test_getStudentSettingsVariants(self):
         # Create lecture that uses settings variants
         lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=[
@@ -157,6 +356,10 @@ class SyncStudentIntegration(IntegrationTestCase):
         setRelations(classObj, 'lectures', [lecObj])
         self.notifyModify(classObj)
         import transaction ; transaction.commit()
+        self.assertEqual(
+            [getDbStudent(u).registered for u in [USER_A_ID, USER_B_ID, USER_C_ID]],
+            [True, False, False],
+        )
 
         # Get settings for A&B students
         settings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID]]
@@ -172,6 +375,10 @@ class SyncStudentIntegration(IntegrationTestCase):
         # Add B&C to the class
         classObj.students = [USER_A_ID, USER_B_ID, USER_C_ID]
         self.notifyModify(classObj)
+        self.assertEqual(
+            [getDbStudent(u).registered for u in [USER_A_ID, USER_B_ID, USER_C_ID]],
+            [True, True, True],
+        )
 
         # Get settings for all students
         settings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID, USER_C_ID]]
@@ -227,3 +434,111 @@ class SyncStudentIntegration(IntegrationTestCase):
             [float(s['ut_uniform']) > 10 for s in settings],
             [True, True, True],  # NB: Random values are kept again.
         )
+
+    def test_getStudentSettingsVariantChange(self):
+        """Values chosen for one variant aren't copied forward to another"""
+        def lecSettings(static):
+            return [
+                dict(key="ut_static", value=static),
+                dict(key="ut_uniform:max", value="10"),
+                dict(key="ut_uniform:registered:min", value="100"),
+                dict(key="ut_uniform:registered:max", value="110"),
+            ]
+        lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=lecSettings("0.9")))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+
+        # A is in a class, B isn't
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        classObj = portal['schools-and-classes'][portal['schools-and-classes'].invokeFactory(
+            type_name="tw_class",
+            id="hard_knocks",
+            title="Unittest Hard Knocks class",
+            lectures=[lecObj],
+            students=[USER_A_ID],
+        )]
+        setRelations(classObj, 'lectures', [lecObj])
+        self.notifyModify(classObj)
+        oldSettings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID]]
+        self.assertEqual(
+            [float(s['ut_uniform']) >= 100 for s in oldSettings],
+            [True, False],
+        )
+
+        # B joins the class, and the lecture gets a new version
+        classObj.students = [USER_A_ID, USER_B_ID]
+        self.notifyModify(classObj)
+        lecObj.settings = lecSettings("0.8")
+        self.notifyModify(lecObj)
+        settings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID]]
+        self.assertNotEqual(settings[1]['lecture_version'], oldSettings[1]['lecture_version'])
+
+        # A keeps their value, B gets a new one from the registered variant
+        self.assertEqual(settings[0]['ut_uniform'], oldSettings[0]['ut_uniform'])
+        self.assertTrue(100 <= float(settings[1]['ut_uniform']) < 110)
+        self.assertEqual(
+            (Session.query(db.LectureStudentSetting.variant)
+                .filter_by(lectureId=dbLec.lectureId)
+                .filter_by(lectureVersion=dbLec.currentVersion)
+                .filter_by(studentId=getDbStudent(USER_B_ID).studentId)
+                .filter_by(key='ut_uniform')
+                .one()),
+            ('registered',),
+        )
+
+    def test_assignStudentSettingsVariants(self):
+        """Assigned values come from the variant each student has now"""
+        def lecSettings(static):
+            return [
+                dict(key="ut_static", value=static),
+                dict(key="ut_uniform:max", value="10"),
+                dict(key="ut_uniform:registered:min", value="100"),
+                dict(key="ut_uniform:registered:max", value="110"),
+            ]
+        lecObj = self.createTestLecture(qnCount=5, lecOpts=lambda i: dict(settings=lecSettings("0.9")))
+        self.objectPublish(lecObj)
+        dbLec = getDbLecture('/'.join(lecObj.getPhysicalPath()))
+
+        # A is in a class, B & C aren't. All have used the lecture
+        portal = self.layer['portal']
+        login(portal, MANAGER_ID)
+        classObj = portal['schools-and-classes'][portal['schools-and-classes'].invokeFactory(
+            type_name="tw_class",
+            id="hard_knocks",
+            title="Unittest Hard Knocks class",
+            lectures=[lecObj],
+            students=[USER_A_ID],
+        )]
+        setRelations(classObj, 'lectures', [lecObj])
+        self.notifyModify(classObj)
+        for u in [USER_A_ID, USER_B_ID, USER_C_ID]:
+            list(self.allocGetQuestionAllocation(dbLec, getDbStudent(u), {}))
+        oldSettings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID, USER_C_ID]]
+        self.assertEqual(
+            [float(s['ut_uniform']) >= 100 for s in oldSettings],
+            [True, False, False],
+        )
+
+        # B joins the class, lecture gets a new version, assign everyone's values
+        classObj.students = [USER_A_ID, USER_B_ID]
+        self.notifyModify(classObj)
+        lecObj.settings = lecSettings("0.8")
+        self.notifyModify(lecObj)
+        self.assertTrue(assignStudentSettings(dbLec) > 0)
+        self.assertEqual(sorted(
+            (lss.student.userName, lss.variant) for lss in Session.query(db.LectureStudentSetting)
+                .filter_by(lectureId=dbLec.lectureId)
+                .filter_by(lectureVersion=dbLec.currentVersion)
+                .filter_by(key='ut_uniform')
+        ), [
+            (USER_A_ID, 'registered'),
+            (USER_B_ID, 'registered'),
+            (USER_C_ID, ''),
+        ])
+
+        # A & C keep their values, B gets a new one from the registered variant
+        settings = [getStudentSettings(dbLec, getDbStudent(u)) for u in [USER_A_ID, USER_B_ID, USER_C_ID]]
+        self.assertEqual(settings[0]['ut_uniform'], oldSettings[0]['ut_uniform'])
+        self.assertTrue(100 <= float(settings[1]['ut_uniform']) < 110)
+        self.assertEqual(settings[2]['ut_uniform'], oldSettings[2]['ut_uniform'])
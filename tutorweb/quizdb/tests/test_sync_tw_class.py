@@ -1,9 +1,12 @@
 import transaction
 from zope.testing.loggingsupport import InstalledHandler
+from z3c.saconfig import Session
 
 from plone.app.testing import login
 
 from tutorweb.content.tests.base import setRelations
+from tutorweb.quizdb import db
+from tutorweb.quizdb.sync.plone import preallocateClass
 from .base import IntegrationTestCase
 from .base import MANAGER_ID, USER_A_ID, USER_B_ID, USER_C_ID
 
@@ -72,3 +75,34 @@ class SyncClassSubscriptionsTest(IntegrationTestCase):
             getSubscriptions(user=USER_B_ID),
             dict(children=[])
         )
+
+    def test_preallocateClass(self):
+        portal = self.layer['portal']
+        lecObjs = [self.createTestLecture(qnCount=5) for i in range(2)]
+
+        # Add class with A & B in it
+        login(portal, MANAGER_ID)
+        classObj = portal['schools-and-classes'][portal['schools-and-classes'].invokeFactory(
+            type_name="tw_class",
+            id="hard_knocks",
+            title="Unittest Hard Knocks class",
+            lectures=lecObjs,
+            students=[USER_A_ID, USER_B_ID],
+        )]
+        setRelations(classObj, 'lectures', lecObjs)
+        self.notifyModify(classObj)
+        self.assertEqual(Session.query(db.Allocation).count(), 0)
+
+        # Each student gets all questions from both lectures
+        self.assertEqual(
+            [(dbStudent.userName, count) for (dbStudent, count) in preallocateClass(classObj)],
+            [(USER_A_ID, 10), (USER_B_ID, 10)],
+        )
+        self.assertEqual(Session.query(db.Allocation).count(), 20)
+
+        # Doing it again doesn't allocate anything new
+        self.assertEqual(
+            [(dbStudent.userName, count) for (dbStudent, count) in preallocateClass(classObj)],
+            [(USER_A_ID, 0), (USER_B_ID, 0)],
+        )
+        self.assertEqual(Session.query(db.Allocation).count(), 20)
@@ -0,0 +1,32 @@
+import unittest
+
+from tutorweb.quizdb.utils import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(3)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        self.assertEqual(cache.get('a'), 1)
+
+        # Adding another item forgets the least recently used, b
+        cache['d'] = 4
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 'x'), 'x')
+        self.assertEqual([k in cache for k in 'abcd'], [True, False, True, True])
+
+        # Setting an existing item makes it most recent
+        cache['c'] = 5
+        cache['e'] = 6
+        self.assertEqual([k in cache for k in 'abcde'], [False, False, True, True, True])
+        self.assertEqual(cache.get('c'), 5)
+
+        # Popping forgets an item
+        self.assertEqual(cache.pop('c'), 5)
+        self.assertEqual(cache.pop('c', 'x'), 'x')
+        self.assertEqual([k in cache for k in 'abcde'], [False, False, False, True, True])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
@@ -1,4 +1,6 @@
+import collections
 import socket
+import threading
 import uuid
 import re
 
@@ -52,6 +54,26 @@ def getDbStudent(username, email=None):
     return dbStudent
 
 
+def getDbTutorial(hostId, lecturePath):
+    """
+    Find / create the tutorial object lecturePath lives in
+    """
+    tutorialPath = re.sub(r'/[^/]+/?$', '', lecturePath)
+    try:
+        dbTut = Session.query(db.Tutorial) \
+            .filter_by(hostId=hostId) \
+            .filter_by(plonePath=tutorialPath) \
+            .one()
+    except NoResultFound:
+        dbTut = db.Tutorial(
+            hostId=hostId,
+            plonePath=tutorialPath,
+        )
+        Session.add(dbTut)
+        Session.flush()
+    return dbTut
+
+
 def getDbLecture(plonePath):
     """
     Find a lecture object corresponding to plonePath
@@ -67,3 +89,48 @@ def getDbLecture(plonePath):
         return dbLec
     except NoResultFound:
         raise ValueError("lecture %s does not exist" % plonePath)
+
+
+class LRUCache(object):
+    """
+    Dict-like cache of at most maxSize items, forgetting the least recently
+    used item when full
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            # Move to the most-recently-used end
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxSize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()